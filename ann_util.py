@@ -0,0 +1,132 @@
+"""
+FAISS index construction for chunk embeddings.
+
+All indexes use inner product over L2-normalized vectors, i.e. cosine
+similarity. Supported index types:
+
+    flat      exact search, 4*d bytes per vector
+    hnsw      graph-based ANN, fast and accurate, ~(4*d + 8*M) bytes per vector
+    ivf_flat  inverted lists, probes nprobe of nlist clusters
+    ivf_pq    inverted lists + product quantization, ~pq_m bytes per vector
+"""
+import math
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+# Corpus sizes (number of vectors) at which "auto" switches index type
+AUTO_THRESHOLDS = (
+    (20_000, "flat"),
+    (200_000, "hnsw"),
+    (1_000_000, "ivf_flat"),
+)
+
+
+def choose_index_type(n: int) -> str:
+    for limit, index_type in AUTO_THRESHOLDS:
+        if n < limit:
+            return index_type
+    return "ivf_pq"
+
+
+def default_nlist(n: int) -> int:
+    # ~4*sqrt(n) clusters, but keep >= 39 training points per cluster
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+
+def default_pq_m(d: int) -> int:
+    """Largest number of sub-quantizers <= d/8 that divides d."""
+    for m in range(max(1, d // 8), 0, -1):
+        if d % m == 0:
+            return m
+    return 1
+
+
+def build_index(
+    vectors: np.ndarray,
+    index_type: str = "auto",
+    nlist: int = None,
+    hnsw_m: int = 32,
+    ef_construction: int = 80,
+    pq_m: int = None,
+    train_size: int = 100_000,
+    seed: int = 0,
+):
+    """
+    Build and fill an index over L2-normalized float32 vectors.
+
+    IVF indexes are trained on a random sample of at most train_size
+    vectors. Returns (index, resolved_index_type).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+    if index_type == "auto":
+        index_type = choose_index_type(n)
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index_type {index_type!r}, expected one of {INDEX_TYPES}")
+
+    if index_type.startswith("ivf") and n < 39:
+        # Too few points to train any clustering
+        index_type = "flat"
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(d)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+    else:
+        nlist = nlist or default_nlist(n)
+        quantizer = faiss.IndexFlatIP(d)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            # 8-bit codes need 256 * 39 training points; use fewer bits below that
+            nbits = min(8, max(1, int(math.log2(max(n // 39, 2)))))
+            index = faiss.IndexIVFPQ(
+                quantizer, d, nlist, pq_m or default_pq_m(d), nbits, faiss.METRIC_INNER_PRODUCT
+            )
+        sample = vectors
+        if n > train_size:
+            rng = np.random.default_rng(seed)
+            sample = vectors[rng.choice(n, train_size, replace=False)]
+        index.train(sample)
+
+    index.add(vectors)
+    return index, index_type
+
+
+def set_search_params(index, nprobe: int = None, ef_search: int = None):
+    """Tune the recall / latency trade-off of an existing index."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe is not None:
+        ivf.nprobe = nprobe
+    if hasattr(index, "hnsw") and ef_search is not None:
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def reconstruct_all(index) -> np.ndarray:
+    """All stored vectors, in id order (approximate for ivf_pq)."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def index_type_of(index) -> str:
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def recall_at_k(exact_ids: np.ndarray, ann_ids: np.ndarray) -> float:
+    """Fraction of the exact top-k neighbours that the ANN search returned."""
+    k = exact_ids.shape[1]
+    hits = sum(len(set(e) & set(a)) for e, a in zip(exact_ids, ann_ids))
+    return hits / (len(exact_ids) * k)
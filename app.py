@@ -1,14 +1,29 @@
+import json
 import os
 import streamlit as st
 import rag_util
+from cache_util import ExtractionCache, AnswerCache, file_hash
 from model import ChatModel
+from entity_util import EntityResolver, EntityLinker
+from bm25_util import BM25Index
+from persist_util import (
+    save_graph,
+    load_graph,
+    graph_exists,
+    graph_version
+)
 from graph_util import (
     GraphExtractor,
-    build_graph_from_chunks,
+    CompactGraphStore,
+    add_documents_to_graph,
+    remove_document_from_graph,
     QueryEntityExtractor,
-    GraphRetriever,
-    build_context_from_chunks
+    pack_context,
+    token_counter
 )
+from retrieval_util import HybridRetriever
+from rerank_util import Reranker
+from trace_util import Trace, tracing, span
 
 # =====================================================
 # App Configuration
@@ -19,11 +34,78 @@ st.set_page_config(
 )
 
 st.title("📚 Graph RAG Assistant")
-st.caption("Graph-first reasoning with FAISS fallback")
+st.caption("Graph reasoning fused with FAISS vector search")
 
 FILES_DIR = "files"
 os.makedirs(FILES_DIR, exist_ok=True)
 
+# PDFs parsed / split in parallel worker processes
+PDF_WORKERS = 4
+
+# Concurrent LLM calls during triple extraction
+EXTRACTION_WORKERS = 8
+EXTRACTION_TIMEOUT = 120  # seconds per LLM call
+# Prompt token budget for packing several chunks into one request (None = off)
+EXTRACTION_PACK_TOKENS = 2048
+
+# Triples already extracted for unchanged chunks are reused across rebuilds
+EXTRACTION_CACHE_PATH = os.path.join("cache", "extraction_cache.sqlite")
+EXTRACTION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# FAISS index: "auto" picks flat / hnsw / ivf_flat / ivf_pq from corpus size
+FAISS_INDEX_TYPE = "auto"
+FAISS_NPROBE = 16      # IVF clusters probed per query
+FAISS_EF_SEARCH = 64   # HNSW candidate list size per query
+
+# Chunk embeddings are cached per model + text hash
+EMBEDDING_CACHE_PATH = os.path.join("cache", "embeddings.sqlite")
+EMBEDDING_BATCH_SIZE = 64
+
+# Last built graph + FAISS index, memory-mapped by every session / worker
+INDEX_DIR = "index"
+GRAPH_DIR = os.path.join(INDEX_DIR, "graph")
+FAISS_DIR = os.path.join(INDEX_DIR, "faiss")
+ALIASES_PATH = os.path.join(INDEX_DIR, "aliases.json")
+ENTITIES_DIR = os.path.join(INDEX_DIR, "entities")
+BM25_DIR = os.path.join(INDEX_DIR, "bm25")
+# Content hash of every indexed PDF, to re-index files replaced under the same name
+SOURCES_PATH = os.path.join(INDEX_DIR, "sources.json")
+
+# Query n-grams at least this close (cosine) to an entity name link to it
+ENTITY_LINK_THRESHOLD = 0.75
+
+# Entity names closer than this (cosine) are merged into one node
+ENTITY_MERGE_THRESHOLD = 0.92
+
+# Answers are reused for questions at least this close (cosine) to a cached
+# one, until they expire or the index is rebuilt
+ANSWER_CACHE_THRESHOLD = 0.93
+ANSWER_CACHE_TTL = 24 * 3600  # seconds
+ANSWER_CACHE_MAX_ENTRIES = 1000
+
+# Context passed to the LLM, in model tokens (graph chunks + FAISS hits)
+CONTEXT_TOKENS = 1024
+
+# Hybrid retrieval: FAISS / BM25 hits per question and how the rankings
+# are fused ("rrf" = reciprocal-rank fusion, "score" = normalized score sum)
+FAISS_K = 8
+BM25_K = 8
+FUSION_METHOD = "rrf"
+FUSION_WEIGHTS = {"graph": 1.0, "faiss": 1.0, "bm25": 1.0}
+
+# Fused candidates are reranked against the question (cosine of the stored
+# chunk vectors, optionally a local cross-encoder) within a time budget
+RERANK_TOP_K = 8
+RERANK_BUDGET_MS = 150
+CROSS_ENCODER_MODEL = None  # e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# LLM requests (extraction, query entities, answers) share one rate limit;
+# 429 / 5xx / connection errors are retried with backoff. Set LLM_BASE_URL
+# in .env to use a self-hosted OpenAI-compatible server instead of the HF API
+LLM_RATE_LIMIT = 4   # requests per second (None = unlimited)
+LLM_BURST = 8
+LLM_MAX_RETRIES = 3
+
 # =====================================================
 # Session State Initialization
 # =====================================================
@@ -36,15 +118,210 @@ if "graph" not in st.session_state:
 if "faiss_db" not in st.session_state:
     st.session_state.faiss_db = None
 
+if "resolver" not in st.session_state:
+    st.session_state.resolver = None
+
+if "linker" not in st.session_state:
+    st.session_state.linker = None
+
+if "lexical" not in st.session_state:
+    st.session_state.lexical = None
+
+# PDF path -> sha256 of the version that is in the index
+if "source_hashes" not in st.session_state:
+    st.session_state.source_hashes = {}
+
+# build_id of the saved graph; cached answers belong to one version
+if "index_version" not in st.session_state:
+    st.session_state.index_version = None
+
+# Kept across questions so its entity matcher is only built once
+if "query_extractor" not in st.session_state:
+    st.session_state.query_extractor = None
+
+# Graph + FAISS retriever of the current index (owns a small thread pool)
+if "hybrid_retriever" not in st.session_state:
+    st.session_state.hybrid_retriever = None
+
+# Keeps the chunk vectors it has scored, per index
+if "reranker" not in st.session_state:
+    st.session_state.reranker = None
+
 # =====================================================
 # Load LLM (once)
 # =====================================================
 @st.cache_resource
 def load_model():
-    return ChatModel(model_id="deepseek-ai/DeepSeek-R1")
+    return ChatModel(
+        model_id="deepseek-ai/DeepSeek-R1",
+        rate_limit=LLM_RATE_LIMIT,
+        burst=LLM_BURST,
+        max_retries=LLM_MAX_RETRIES
+    )
 
 model = load_model()
 
+@st.cache_resource
+def load_encoder():
+    return rag_util.Encoder(
+        model_name="sentence-transformers/all-MiniLM-L12-v2",
+        device="cpu",
+        batch_size=EMBEDDING_BATCH_SIZE,
+        cache_path=EMBEDDING_CACHE_PATH
+    )
+
+@st.cache_resource
+def load_cross_encoder():
+    if CROSS_ENCODER_MODEL is None:
+        return None
+    return rag_util.load_cross_encoder(CROSS_ENCODER_MODEL)
+
+# One token count cache for every question, not a new one per question
+@st.cache_resource
+def load_token_counter():
+    return token_counter(model)
+
+# =====================================================
+# Load saved graph + FAISS index (shared, memory-mapped)
+# =====================================================
+def read_saved_index(mmap=True):
+    if not graph_exists(GRAPH_DIR):
+        return {}
+    embedding_function = load_encoder().embedding_function
+    warnings = []
+    try:
+        graph = load_graph(GRAPH_DIR)
+    except Exception as e:
+        # Nothing can be rebuilt without the graph: start with an empty index
+        print(f"⚠️ Saved graph could not be loaded: {e!r}")
+        return {"index_warnings": [
+            f"⚠️ The saved graph could not be loaded ({e}). "
+            "Upload the PDFs and build the graph again."
+        ]}
+
+    def load_or_rebuild(name, load, rebuild, save):
+        # A part that is missing, from an unknown format version or
+        # inconsistent is rebuilt from the graph and saved again
+        try:
+            return load()
+        except Exception as e:
+            print(f"⚠️ Saved {name} could not be loaded, rebuilding it: {e!r}")
+            warnings.append(f"⚠️ The saved {name} was rebuilt from the graph ({e}).")
+            part = rebuild()
+            save(part)
+            return part
+
+    source_hashes = {}
+    if os.path.exists(SOURCES_PATH):
+        with open(SOURCES_PATH, encoding="utf-8") as f:
+            source_hashes = json.load(f)
+    return {
+        "index_version": graph_version(GRAPH_DIR),
+        "index_warnings": warnings,
+        "graph": graph,
+        "source_hashes": source_hashes,
+        "lexical": load_or_rebuild(
+            "BM25 index",
+            lambda: BM25Index.load(BM25_DIR),
+            lambda: BM25Index().sync(graph),
+            lambda part: part.save(BM25_DIR)
+        ),
+        "faiss_db": load_or_rebuild(
+            "FAISS index",
+            lambda: rag_util.FaissDb.load(
+                FAISS_DIR,
+                embedding_function=embedding_function,
+                mmap=mmap
+            ),
+            lambda: rag_util.FaissDb(
+                docs=rag_util.graph_documents(graph),
+                embedding_function=embedding_function,
+                index_type=FAISS_INDEX_TYPE,
+                nprobe=FAISS_NPROBE,
+                ef_search=FAISS_EF_SEARCH
+            ),
+            lambda part: part.save(FAISS_DIR)
+        ),
+        "resolver": load_or_rebuild(
+            "alias index",
+            lambda: EntityResolver.load(
+                ALIASES_PATH,
+                embedding_function=embedding_function
+            ),
+            lambda: EntityResolver.from_graph(
+                graph,
+                embedding_function=embedding_function,
+                threshold=ENTITY_MERGE_THRESHOLD
+            ),
+            lambda part: part.save(ALIASES_PATH)
+        ),
+        "linker": load_or_rebuild(
+            "entity index",
+            lambda: EntityLinker.load(
+                ENTITIES_DIR,
+                embedding_function=embedding_function
+            ),
+            lambda: EntityLinker(
+                embedding_function,
+                threshold=ENTITY_LINK_THRESHOLD
+            ).sync(graph),
+            lambda part: part.save(ENTITIES_DIR)
+        ),
+    }
+
+# Shared by every session, so never changed in place: an incremental
+# build updates its own copies from read_saved_index(mmap=False)
+@st.cache_resource
+def load_saved_index():
+    return read_saved_index()
+
+if st.session_state.graph is None:
+    for key, value in load_saved_index().items():
+        st.session_state[key] = value
+    for message in st.session_state.get("index_warnings", []):
+        st.warning(message)
+
+# Stage timings of every build / question since startup (no spans kept)
+@st.cache_resource
+def load_metrics():
+    return Trace("app", keep_spans=False)
+
+# Shared by all sessions
+@st.cache_resource
+def load_answer_cache():
+    return AnswerCache(
+        load_encoder().embedding_function,
+        threshold=ANSWER_CACHE_THRESHOLD,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES,
+        ttl=ANSWER_CACHE_TTL
+    )
+
+# =====================================================
+# Helper: Debug panel for one trace
+# =====================================================
+def show_trace(trace, key):
+    with st.expander("🐞 Debug: stage timings"):
+        st.table([
+            {"stage": name, **stats}
+            for name, stats in trace.summary().items()
+        ])
+        if trace.counters:
+            st.json(trace.counters)
+        st.dataframe(trace.spans)
+        col_json, col_prom = st.columns(2)
+        col_json.download_button(
+            "Trace (JSON)",
+            trace.to_json(indent=2),
+            file_name=f"{trace.name}_trace.json",
+            key=f"{key}_json"
+        )
+        col_prom.download_button(
+            "Trace (Prometheus)",
+            trace.to_prometheus(),
+            file_name=f"{trace.name}_trace.prom",
+            key=f"{key}_prom"
+        )
+
 # =====================================================
 # Helper: Save uploaded PDFs
 # =====================================================
@@ -66,43 +343,210 @@ with st.sidebar:
         accept_multiple_files=True
     )
 
+    full_rebuild = st.checkbox(
+        "Full rebuild",
+        value=False,
+        help="Re-index every file instead of only added / removed ones"
+    )
     rebuild = st.button("🔄 Build / Rebuild Graph")
 
+    llm_entity_fallback = st.checkbox(
+        "Ask the LLM for query entities when local linking finds none",
+        value=True
+    )
+
+    think_mode = st.selectbox(
+        "Model reasoning (<think>) while streaming",
+        options=["collapse", "hide", "show"],
+        help="collapse: one placeholder line, the reasoning is shown below the answer"
+    )
+
+    use_answer_cache = st.checkbox(
+        "Reuse answers to the same / similar questions",
+        value=True
+    )
+    cache_stats = load_answer_cache().stats()
+    st.caption(
+        f"Answer cache: {cache_stats['entries']} entries, "
+        f"hit rate {cache_stats['hit_rate']:.0%} "
+        f"({cache_stats['exact_hits']} exact, {cache_stats['semantic_hits']} similar, "
+        f"{cache_stats['misses']} misses)"
+    )
+
+    with st.expander("📈 Pipeline metrics"):
+        metrics_text = load_metrics().to_prometheus()
+        st.code(metrics_text, language="text")
+        st.download_button("Download (Prometheus)", metrics_text, file_name="metrics.prom")
+
 # =====================================================
 # Build Graph + FAISS (ONLY when user clicks rebuild)
 # =====================================================
 if rebuild and uploaded_files:
-    with st.spinner("Building graph and vector index..."):
+    build_trace = Trace("build")
+    with st.spinner("Building graph and vector index..."), tracing(build_trace):
 
         file_paths = [save_file(f) for f in uploaded_files]
+        source_hashes = {path: file_hash(path) for path in file_paths}
+        encoder = load_encoder()
 
-        # Load & split PDFs
-        docs = rag_util.load_and_split_pdfs(
-            file_paths,
-            chunk_size=256
-        )
-
-        # Build FAISS index
-        encoder = rag_util.Encoder(
-            model_name="sentence-transformers/all-MiniLM-L12-v2",
-            device="cpu"
-        )
-
-        faiss_db = rag_util.FaissDb(
-            docs=docs,
-            embedding_function=encoder.embedding_function
+        cache = ExtractionCache(
+            EXTRACTION_CACHE_PATH,
+            max_bytes=EXTRACTION_CACHE_MAX_BYTES
         )
-
-        # Build Knowledge Graph
-        extractor = GraphExtractor(llm=model)
-        graph = build_graph_from_chunks(docs, extractor)
+        extractor = GraphExtractor(llm=model, cache=cache)
+        # Incremental builds start from private, writable copies of the
+        # saved index: the objects of load_saved_index() are shared by all
+        # sessions, which must not see a half-updated index
+        saved = {}
+        if st.session_state.graph is not None and not full_rebuild:
+            saved = read_saved_index(mmap=False)
+
+        if "graph" not in saved:
+            resolver = EntityResolver(
+                embedding_function=encoder.embedding_function,
+                threshold=ENTITY_MERGE_THRESHOLD
+            )
+
+            graph = CompactGraphStore()
+            faiss_db = None
+            linker = None
+            lexical = None
+            new_paths = file_paths
+        else:
+            # Incremental: only touch added / removed / changed files
+            graph = saved["graph"].to_graph_store(compact=True)
+            faiss_db = saved["faiss_db"]
+            resolver = saved["resolver"]
+            linker = saved["linker"]
+            lexical = saved["lexical"]
+
+            # A file re-uploaded under the same name with new content is
+            # removed and indexed again (no hash recorded = changed)
+            indexed = graph.document_sources()
+            known = saved["source_hashes"]
+            stale = {
+                source for source in indexed
+                if source not in source_hashes
+                or known.get(source) != source_hashes[source]
+            }
+            for source in stale:
+                removed = remove_document_from_graph(graph, source)
+                faiss_db.remove(removed)
+
+            new_paths = [
+                p for p in file_paths
+                if p not in indexed or p in stale
+            ]
+
+        # Stream: each PDF is embedded and extracted as soon as it is parsed
+        added_chunks = 0
+        for docs in rag_util.iter_split_pdfs(
+            new_paths,
+            chunk_size=256,
+            max_workers=PDF_WORKERS
+        ):
+            if not docs:
+                continue
+
+            # FAISS index
+            if faiss_db is None:
+                faiss_db = rag_util.FaissDb(
+                    docs=docs,
+                    embedding_function=encoder.embedding_function,
+                    index_type=FAISS_INDEX_TYPE,
+                    nprobe=FAISS_NPROBE,
+                    ef_search=FAISS_EF_SEARCH
+                )
+            else:
+                faiss_db.add_documents(docs)
+
+            # Knowledge Graph
+            added_chunks += len(add_documents_to_graph(
+                graph,
+                docs,
+                extractor,
+                max_workers=EXTRACTION_WORKERS,
+                timeout=EXTRACTION_TIMEOUT,
+                resolver=resolver,
+                pack_tokens=EXTRACTION_PACK_TOKENS
+            ))
+
+        if faiss_db is None:
+            st.error("No text could be extracted from the uploaded PDFs.")
+            st.stop()
+
+        # Chunks whose LLM extraction failed are in the graph without edges
+        extraction_failures = build_trace.counters.get("extraction_failures", 0)
+        if added_chunks and extraction_failures >= added_chunks:
+            st.error(
+                f"❌ Triple extraction failed for all {added_chunks} new chunks "
+                "(see the debug panel for the LLM errors). The saved index was kept."
+            )
+            # Reload the saved index instead of keeping the edgeless chunks
+            st.session_state.graph = None
+            show_trace(build_trace, key="build")
+            st.stop()
+
+        # Embed entity names for local query linking (only new ones)
+        if linker is None:
+            linker = EntityLinker(
+                encoder.embedding_function,
+                threshold=ENTITY_LINK_THRESHOLD
+            )
+        with span("entity_linker_sync"):
+            linker.sync(graph)
+
+        # Lexical (BM25) index over the chunk texts, only new / removed chunks
+        if lexical is None:
+            lexical = BM25Index()
+        with span("bm25_sync"):
+            lexical.sync(graph)
+
+        # Persist so new sessions / restarts skip the rebuild
+        with span("save_index"):
+            save_graph(graph, GRAPH_DIR)
+            faiss_db.save(FAISS_DIR)
+            resolver.save(ALIASES_PATH)
+            linker.save(ENTITIES_DIR)
+            lexical.save(BM25_DIR)
+            with open(SOURCES_PATH, "w", encoding="utf-8") as f:
+                json.dump(source_hashes, f)
+        load_saved_index.clear()
+        st.session_state.index_version = graph_version(GRAPH_DIR)
 
         # Store in session
         st.session_state.graph = graph
         st.session_state.faiss_db = faiss_db
+        st.session_state.resolver = resolver
+        st.session_state.linker = linker
+        st.session_state.lexical = lexical
+        st.session_state.source_hashes = source_hashes
+        # Keep the query extractor: its entity matcher only applies the
+        # entities added / removed by this build on the next question
+        if st.session_state.query_extractor is not None:
+            st.session_state.query_extractor.resolver = resolver
+            st.session_state.query_extractor.linker = linker
+        if st.session_state.hybrid_retriever is not None:
+            st.session_state.hybrid_retriever.close()
+            st.session_state.hybrid_retriever = None
+        st.session_state.reranker = None
         st.session_state.messages = []  # reset chat on rebuild
 
-        st.success("✅ Graph & FAISS index built successfully")
+        if extraction_failures:
+            st.warning(
+                f"⚠️ Triple extraction failed for {extraction_failures} of "
+                f"{added_chunks} new chunks. They are searchable by vector / BM25 "
+                "but have no graph edges; tick Full rebuild to extract them again."
+            )
+        else:
+            st.success("✅ Graph & FAISS index built successfully")
+        st.caption(
+            f"Extraction cache: {cache.hits} hits, {cache.misses} misses"
+        )
+        cache.close()
+
+    load_metrics().merge(build_trace)
+    show_trace(build_trace, key="build")
 
 # =====================================================
 # Chat Interface
@@ -132,61 +576,112 @@ if st.session_state.graph is not None:
         with st.chat_message("user"):
             st.markdown(user_question)
 
-        with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-
-                graph = st.session_state.graph
-                faiss_db = st.session_state.faiss_db
-
-                # ==========================
-                # PHASE 3: Graph RAG
-                # ==========================
-                qe = QueryEntityExtractor(llm=model)
-                query_entities = qe.extract(
-                    user_question,
-                    graph=graph
-                )
-
-                retriever = GraphRetriever(graph)
-                graph_chunk_ids = retriever.retrieve_chunks(
-                    query_entities
-                )
+        question_trace = Trace("question")
+        with st.chat_message("assistant"), tracing(question_trace):
+            answer_cache = load_answer_cache()
+            # Answers are cached per index version: sessions still on the
+            # previous index neither see nor overwrite answers of a rebuild
+            index_version = st.session_state.index_version
+            cached = None
+            if use_answer_cache:
+                with span("answer_cache") as attrs:
+                    cached = answer_cache.get(user_question, version=index_version)
+                    attrs["hit"] = cached is not None
+            graph = st.session_state.graph
+
+            if cached is not None:
+                answer = cached["answer"]
+                query_entities = cached["entities"]
+                st.markdown(answer)
+                if cached["exact"]:
+                    st.caption("⚡ Cached answer")
+                else:
+                    st.caption(
+                        f"⚡ Cached answer to a similar question "
+                        f"(“{cached['cached_question']}”, similarity {cached['similarity']:.2f})"
+                    )
+            else:
+                with st.spinner("Thinking..."):
+
+                    # ==========================
+                    # PHASE 3: Hybrid Graph + FAISS retrieval
+                    # ==========================
+                    if st.session_state.query_extractor is None:
+                        st.session_state.query_extractor = QueryEntityExtractor(
+                            llm=model,
+                            resolver=st.session_state.resolver,
+                            linker=st.session_state.linker
+                        )
+                    qe = st.session_state.query_extractor
+                    qe.llm_fallback = llm_entity_fallback
+
+                    if st.session_state.hybrid_retriever is None:
+                        st.session_state.hybrid_retriever = HybridRetriever(
+                            graph,
+                            st.session_state.faiss_db,
+                            query_extractor=qe,
+                            faiss_k=FAISS_K,
+                            method=FUSION_METHOD,
+                            weights=FUSION_WEIGHTS,
+                            lexical=st.session_state.lexical,
+                            lexical_k=BM25_K
+                        )
+
+                    # FAISS search runs while the entities are extracted
+                    # and the graph is walked; both rankings are fused
+                    chunks, query_entities = st.session_state.hybrid_retriever.retrieve(
+                        user_question
+                    )
 
-                graph_context = build_context_from_chunks(
-                    graph,
-                    graph_chunk_ids
-                )
+                    if st.session_state.reranker is None:
+                        st.session_state.reranker = Reranker(
+                            load_encoder().embedding_function,
+                            vectors=st.session_state.faiss_db.chunk_vectors,
+                            cross_encoder=load_cross_encoder(),
+                            top_k=RERANK_TOP_K,
+                            budget_ms=RERANK_BUDGET_MS
+                        )
+                    chunks = st.session_state.reranker.rerank(user_question, chunks)
+
+                    with span("build_context"):
+                        final_context, _ = pack_context(
+                            chunks,
+                            CONTEXT_TOKENS,
+                            load_token_counter()
+                        )
 
                 # ==========================
-                # Hybrid Graph + FAISS fallback
+                # LLM Answer (streamed)
                 # ==========================
-                MIN_GRAPH_CHUNKS = 1
-                MIN_CONTEXT_CHARS = 400
-
-                use_faiss = (
-                    len(graph_chunk_ids) < MIN_GRAPH_CHUNKS or
-                    len(graph_context) < MIN_CONTEXT_CHARS
+                stream = model.stream(
+                    question=user_question,
+                    context=final_context,
+                    max_new_tokens=300,
+                    think=think_mode
                 )
+                st.write_stream(stream)
+                answer = stream.answer or stream.error or ""
 
-                final_context = graph_context
+                if stream.ttft is not None:
+                    first_answer = (
+                        f"{stream.first_answer:.2f}s" if stream.first_answer is not None else "–"
+                    )
+                    st.caption(
+                        f"⏱️ First token {stream.ttft:.2f}s · "
+                        f"first answer token {first_answer} · "
+                        f"total {stream.elapsed:.2f}s"
+                    )
+                if stream.reasoning and think_mode != "show":
+                    with st.expander("💭 Model reasoning"):
+                        st.markdown(stream.reasoning)
 
-                if use_faiss:
-                    faiss_context = faiss_db.similarity_search(
+                if answer and stream.error is None:
+                    answer_cache.put(
                         user_question,
-                        k=3
+                        answer,
+                        version=index_version,
+                        entities=query_entities
                     )
-                    final_context = graph_context + "\n\n" + faiss_context
-
-                # ==========================
-                # LLM Answer
-                # ==========================
-                answer = model.generate(
-                    question=user_question,
-                    context=final_context,
-                    max_new_tokens=300
-                )
-
-                st.markdown(answer)
 
         # Store assistant message
         st.session_state.messages.append(
@@ -197,10 +692,13 @@ if st.session_state.graph is not None:
         # Explainability
         # -------------------------------
         with st.expander("🔍 Graph Reasoning Path"):
-            for s, r, o in graph.edges:
-                if s in query_entities:
+            for s in query_entities:
+                for r, o in graph.neighbors(s):
                     st.write(f"{s} → {r} → {o}")
 
+        load_metrics().merge(question_trace)
+        show_trace(question_trace, key="question")
+
 else:
     st.info(
         "⬅️ Upload PDFs and click **Build / Rebuild Graph** to start."
@@ -0,0 +1,313 @@
+"""
+Batch question answering over the saved graph + FAISS index.
+
+Questions are read from a JSONL file (one object per line, e.g. the
+format of requests.jsonl) or a plain text file (one question per line),
+and one JSON line per answer is streamed to the output as soon as it is
+ready. Within a batch, identical questions and identical entity sets are
+only looked up once, all FAISS lookups share one index.search call (run
+while the query entities are extracted), and LLM calls run concurrently on
+max_workers threads.
+
+Run:
+    python batch_query.py questions.jsonl -o answers.jsonl
+    python batch_query.py questions.txt --workers 16 --no-llm-entities
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from graph_util import GraphRetriever, pack_context, token_counter
+from retrieval_util import faiss_ranking, fused_chunks
+from trace_util import span
+
+# Written by app.py (graph/, faiss/, aliases.json, entities/)
+INDEX_DIR = "index"
+
+QUESTION_FIELDS = ("question", "query", "body", "title")
+ID_FIELDS = ("id", "question_id", "request_id")
+
+
+def read_questions(path: str, question_field: str = None):
+    """
+    Yields {"id": ..., "question": ...} for every non-empty line.
+
+    JSONL lines use question_field, or the first of QUESTION_FIELDS that
+    is present; other lines are taken verbatim as the question. Lines
+    without an id field are numbered from 1.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = line
+            if not isinstance(record, dict):
+                yield {"id": line_no, "question": line}
+                continue
+
+            fields = (question_field,) if question_field else QUESTION_FIELDS
+            question = next((record[k] for k in fields if record.get(k)), None)
+            if question is None:
+                raise ValueError(f"{path}:{line_no}: no question field {fields}")
+            qid = next((record[k] for k in ID_FIELDS if k in record), line_no)
+            yield {"id": qid, "question": question}
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def answer_questions(
+    questions,
+    model,
+    graph,
+    faiss_db,
+    query_extractor,
+    k: int = 8,
+    max_workers: int = 8,
+    batch_size: int = 256,
+    max_new_tokens: int = 300,
+    context_tokens: int = 1024,
+    method: str = "rrf",
+    weights=None,
+    lexical=None,
+    reranker=None,
+):
+    """
+    Answer many questions with the app.py pipeline.
+
+    questions: strings or {"id", "question"} dicts (see read_questions)
+    k: FAISS hits per question, fused with the graph chunks
+    max_workers: concurrent LLM calls (entity extraction and answers)
+    batch_size: questions held in memory at once
+    context_tokens / method / weights: see pack_context and
+        retrieval_util.fuse
+    lexical: optional BM25Index, fused as a third ranking
+    reranker: optional rerank_util.Reranker applied to the fused chunks
+
+    Yields one result dict per question, in completion order.
+    """
+    retriever = GraphRetriever(graph)
+    count_tokens = token_counter(model)
+    # Build the entity indexes once, before worker threads share them
+    query_extractor.matcher(graph).find("")
+    if query_extractor.linker is not None:
+        query_extractor.linker.sync(graph)
+
+    def extract(question):
+        return query_extractor.extract(question, graph=graph)
+
+    def generate(question, context):
+        return model.generate(question=question, context=context, max_new_tokens=max_new_tokens)
+
+    items = (
+        q if isinstance(q, dict) else {"id": i, "question": q}
+        for i, q in enumerate(questions, start=1)
+    )
+    retrieved = {}  # entity tuple -> scored graph chunk ids
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for batch in _batches(items, batch_size):
+            unique = list(dict.fromkeys(item["question"] for item in batch))
+
+            # 1️⃣ FAISS for the whole batch, one search call in the background
+            faiss_future = pool.submit(faiss_db.batch_similarity_search_with_score, unique, k)
+
+            # 2️⃣ Query entities (LLM calls only for questions not linked locally)
+            entities = dict(zip(unique, pool.map(extract, unique)))
+
+            # 3️⃣ Graph retrieval, once per distinct entity set
+            for ents in set(map(tuple, entities.values())):
+                if ents not in retrieved:
+                    retrieved[ents] = retriever.retrieve_scored_chunks(list(ents))
+
+            # 4️⃣ Fuse the rankings and pack the context
+            contexts = {}
+            faiss_chunks = {}
+            for question, hits in zip(unique, faiss_future.result()):
+                faiss_hits, documents = faiss_ranking(hits)
+                faiss_chunks[question] = [chunk_id for chunk_id, _ in faiss_hits]
+                rankings = {"graph": retrieved[tuple(entities[question])], "faiss": faiss_hits}
+                if lexical is not None:
+                    with span("bm25_search", k=k):
+                        rankings["bm25"] = lexical.search(question, k=k)
+                chunks = fused_chunks(
+                    graph,
+                    rankings,
+                    documents,
+                    method,
+                    weights,
+                )
+                if reranker is not None:
+                    chunks = reranker.rerank(question, chunks)
+                contexts[question], _ = pack_context(chunks, context_tokens, count_tokens)
+
+            # 5️⃣ Answers, streamed as they complete
+            waiting = {}
+            for item in batch:
+                waiting.setdefault(item["question"], []).append(item)
+            futures = {
+                pool.submit(generate, question, contexts[question]): question
+                for question in unique
+            }
+            for future in as_completed(futures):
+                question = futures[future]
+                try:
+                    answer, error = future.result(), None
+                except Exception as e:
+                    answer, error = None, str(e)
+                for item in waiting[question]:
+                    yield {
+                        "id": item["id"],
+                        "question": question,
+                        "answer": answer,
+                        "error": error,
+                        "entities": entities[question],
+                        "graph_chunks": [
+                            chunk_id for chunk_id, _ in retrieved[tuple(entities[question])]
+                        ],
+                        "faiss_chunks": faiss_chunks[question],
+                    }
+
+
+def load_index(embedding_function, index_dir: str = INDEX_DIR):
+    """
+    Graph, FAISS index, resolver, linker and BM25 index saved by app.py.
+    Parts other than the graph that cannot be loaded (missing, unknown
+    format version) are rebuilt in memory from the graph.
+    """
+    import rag_util
+    from bm25_util import BM25Index
+    from entity_util import EntityResolver, EntityLinker
+    from persist_util import load_graph
+
+    graph = load_graph(os.path.join(index_dir, "graph"))
+
+    def load_or_rebuild(name, load, rebuild):
+        try:
+            return load()
+        except Exception as e:
+            print(f"Saved {name} could not be loaded, rebuilding it: {e!r}", file=sys.stderr)
+            return rebuild()
+
+    return (
+        graph,
+        load_or_rebuild(
+            "FAISS index",
+            lambda: rag_util.FaissDb.load(os.path.join(index_dir, "faiss"), embedding_function),
+            lambda: rag_util.FaissDb(rag_util.graph_documents(graph), embedding_function),
+        ),
+        load_or_rebuild(
+            "alias index",
+            lambda: EntityResolver.load(os.path.join(index_dir, "aliases.json"), embedding_function),
+            lambda: EntityResolver.from_graph(graph, embedding_function),
+        ),
+        load_or_rebuild(
+            "entity index",
+            lambda: EntityLinker.load(os.path.join(index_dir, "entities"), embedding_function),
+            lambda: EntityLinker(embedding_function).sync(graph),
+        ),
+        load_or_rebuild(
+            "BM25 index",
+            lambda: BM25Index.load(os.path.join(index_dir, "bm25")),
+            lambda: BM25Index().sync(graph),
+        ),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("input", help="JSONL or text file with one question per line")
+    parser.add_argument("-o", "--output", help="output JSONL (default: stdout)")
+    parser.add_argument("--question-field", help="JSONL field holding the question")
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    parser.add_argument("--workers", type=int, default=8, help="concurrent LLM calls")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("-k", type=int, default=8, help="FAISS chunks per question")
+    parser.add_argument("--context-tokens", type=int, default=1024)
+    parser.add_argument("--fusion", choices=["rrf", "score"], default="rrf")
+    parser.add_argument("--no-bm25", action="store_true", help="fuse graph + FAISS only")
+    parser.add_argument("--rerank", type=int, default=8, metavar="K",
+                        help="keep the K best chunks by reranking (0 = off)")
+    parser.add_argument("--rerank-budget-ms", type=float, default=150)
+    parser.add_argument("--cross-encoder", help="local cross-encoder model for reranking")
+    parser.add_argument("--rate-limit", type=float, metavar="RPS",
+                        help="max LLM requests per second (default: unlimited)")
+    parser.add_argument("--no-llm-entities", action="store_true",
+                        help="never ask the LLM for query entities")
+    args = parser.parse_args()
+
+    # Imported here: loads torch, transformers and the HF client
+    import rag_util
+    from graph_util import QueryEntityExtractor
+    from model import ChatModel
+    from rerank_util import Reranker
+
+    model = ChatModel(
+        model_id="deepseek-ai/DeepSeek-R1",
+        rate_limit=args.rate_limit,
+        pool_size=max(args.workers, 1)
+    )
+    encoder = rag_util.Encoder(
+        model_name="sentence-transformers/all-MiniLM-L12-v2",
+        device="cpu"
+    )
+    graph, faiss_db, resolver, linker, lexical = load_index(encoder.embedding_function, args.index_dir)
+    query_extractor = QueryEntityExtractor(
+        llm=model,
+        resolver=resolver,
+        linker=linker,
+        llm_fallback=not args.no_llm_entities
+    )
+
+    reranker = None
+    if args.rerank:
+        reranker = Reranker(
+            encoder.embedding_function,
+            vectors=faiss_db.chunk_vectors,
+            cross_encoder=rag_util.load_cross_encoder(args.cross_encoder) if args.cross_encoder else None,
+            top_k=args.rerank,
+            budget_ms=args.rerank_budget_ms,
+        )
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    start = time.perf_counter()
+    count = 0
+    try:
+        for result in answer_questions(
+            read_questions(args.input, args.question_field),
+            model,
+            graph,
+            faiss_db,
+            query_extractor,
+            k=args.k,
+            max_workers=args.workers,
+            batch_size=args.batch_size,
+            context_tokens=args.context_tokens,
+            method=args.fusion,
+            lexical=None if args.no_bm25 else lexical,
+            reranker=reranker,
+        ):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{count} questions in {elapsed:.1f}s", file=sys.stderr)
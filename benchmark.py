@@ -0,0 +1,894 @@
+"""
+Offline benchmarks for the Graph RAG pipeline.
+
+No network, no HF token: the LLM is replaced by FakeLLM, which sleeps for a
+fixed latency and returns deterministic triples.
+
+Run:
+    python benchmark.py                 # all offline benchmarks
+    python benchmark.py extraction      # just one
+    python benchmark.py retrieval --sizes 1e3 1e5 1e7   # graph sizes in edges
+    python benchmark.py bm25 --sizes 1e4 1e5            # corpus sizes in chunks
+    python benchmark.py --out today.jsonl --compare baseline.jsonl
+    python benchmark.py encoder         # needs the MiniLM model (downloaded once)
+    python benchmark.py streaming       # needs huggingface_hub / transformers installed
+    python benchmark.py llm_client      # LLMClient against a local stub server
+
+Every result is one JSON line; the first line describes the machine. With
+--compare, rows are matched to the baseline by their parameters and every
+metric that got worse by more than --tolerance is reported (exit code 1).
+"""
+import argparse
+import contextlib
+import hashlib
+import inspect
+import json
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from graph_util import (
+    GraphExtractor,
+    GraphStore,
+    CompactGraphStore,
+    QueryEntityExtractor,
+    GraphRetriever,
+    build_graph_from_chunks,
+    build_context_from_chunks,
+    parse_json_array,
+    strip_reasoning,
+    valid_triples
+)
+from bm25_util import BM25Index
+from stub_util import FakeStreamingClient, StubChatServer
+
+
+class FakeChunk:
+    """Minimal stand-in for a langchain Document."""
+
+    def __init__(self, page_content, source="synthetic.pdf", page=0):
+        self.page_content = page_content
+        self.metadata = {"source": source, "page": page}
+
+
+class FakeLLM:
+    """
+    Deterministic mock of ChatModel.generate with a fixed latency.
+
+    Extraction prompts get a chain of RELATED_TO triples between the
+    entity_N / concept_N names after "Text:" (packed prompts get one such
+    list per <chunk id="...">). Query entity prompts get a non-JSON reply, so QueryEntityExtractor takes its matcher fallback,
+    unless entity_json=True.
+    """
+
+    _NAME = re.compile(r"\b(?:entity|concept)[_ ]\d+\b")
+    _CHUNK = re.compile(r'<chunk id="([^"]+)">\n(.*?)\n</chunk>', re.S)
+
+    def __init__(self, latency=0.05, entity_json=False):
+        self.latency = latency
+        self.entity_json = entity_json
+        self.calls = 0
+
+    def generate(self, question, context=None, max_new_tokens=250):
+        self.calls += 1
+        time.sleep(self.latency)
+        if "Question:" in question:
+            names = self._NAME.findall(question.rsplit("Question:", 1)[1])
+            if self.entity_json:
+                return json.dumps(names)
+            return "The key entities are: " + ", ".join(names)
+
+        packed = self._CHUNK.findall(question)
+        if packed:
+            return json.dumps({tag: self._triples(text) for tag, text in packed})
+        return json.dumps(self._triples(question.rsplit("Text:", 1)[-1]))
+
+    def _triples(self, text):
+        # Derive triples from the chunk so results depend on it
+        names = self._NAME.findall(text)
+        return [
+            {"subject": names[i], "relation": "RELATED_TO", "object": names[i + 1]}
+            for i in range(len(names) - 1)
+        ]
+
+
+class FakeEmbeddings:
+    """Deterministic bag-of-words embedding (hashed words, unit length)."""
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def embed_query(self, text):
+        import numpy as np
+
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            vec[int(hashlib.md5(word.strip("?.,!").encode()).hexdigest(), 16) % self.dim] += 1.0
+        return (vec / max(np.linalg.norm(vec), 1e-12)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+
+def make_chunks(n, n_entities=None, mentions=4, filler=30, seed=0):
+    """
+    n synthetic chunks of about filler + 2 * mentions words. Each one
+    mentions random entity_N / concept_N names (N < n_entities, default n).
+    """
+    rng = random.Random(seed)
+    n_entities = n_entities or max(n, 2)
+    chunks = []
+    for i in range(n):
+        words = [f"word{rng.randrange(500)}" for _ in range(filler)]
+        for _ in range(mentions):
+            kind = rng.choice(("entity", "concept"))
+            words.insert(rng.randrange(len(words) + 1), f"{kind}_{rng.randrange(n_entities)}")
+        chunks.append(FakeChunk(" ".join(words) + ".", source=f"doc_{i // 100}.pdf", page=i))
+    return chunks
+
+
+# =====================================
+# Triple extraction: sequential vs concurrent
+# =====================================
+def bench_extraction(n_chunks=64, latency=0.05, worker_counts=(1, 4, 8, 16),
+                     pack_sizes=(None, 2048), seed=0):
+    chunks = make_chunks(n_chunks, seed=seed)
+    results = []
+    baseline = None
+
+    for pack_tokens in pack_sizes:
+        for workers in worker_counts:
+            llm = FakeLLM(latency=latency)
+            start = time.perf_counter()
+            graph = build_graph_from_chunks(
+                chunks, GraphExtractor(llm=llm), max_workers=workers,
+                pack_tokens=pack_tokens
+            )
+            elapsed = time.perf_counter() - start
+
+            # Neither concurrency nor packing may change the graph
+            if baseline is None:
+                baseline = (graph.edges, dict(graph.chunk_entity_map))
+            assert (graph.edges, dict(graph.chunk_entity_map)) == baseline
+
+            results.append({
+                "bench": "extraction",
+                "chunks": n_chunks,
+                "latency_s": latency,
+                "workers": workers,
+                "pack_tokens": pack_tokens,
+                "llm_requests": llm.calls,
+                "seconds": round(elapsed, 4),
+                "chunks_per_s": round(n_chunks / elapsed, 2),
+            })
+
+    return results
+
+
+# =====================================
+# Graph memory: GraphStore vs CompactGraphStore
+# =====================================
+def fill_graph(graph, n_chunks, triples_per_chunk=10, n_entities=20000, seed=0):
+    rng = random.Random(seed)
+    for i in range(n_chunks):
+        chunk_id = f"chunk_{i}"
+        graph.add_node(
+            chunk_id, "Chunk",
+            text=f"synthetic chunk {i} " * 14,
+            source=f"doc_{i // 500}.pdf",
+            page=i % 40
+        )
+        for _ in range(triples_per_chunk):
+            s = f"entity {rng.randrange(n_entities)}"
+            # Half the objects are entities too, so multi-hop paths exist
+            kind = rng.choice(("entity", "concept"))
+            o = f"{kind} {rng.randrange(n_entities)}"
+            graph.add_node(s, "Entity")
+            graph.add_node(o, kind.capitalize())
+            graph.add_edge(s, "RELATED_TO", o, chunk_id=chunk_id)
+            graph.add_edge(chunk_id, "MENTIONS", s, chunk_id=chunk_id)
+            graph.add_entity_chunk(s, chunk_id)
+    return graph
+
+
+def make_graph(n_edges, store=CompactGraphStore, triples_per_chunk=10, seed=0):
+    """Random graph with about n_edges edges (2 per triple: RELATED_TO + MENTIONS)."""
+    n_chunks = max(1, n_edges // (2 * triples_per_chunk))
+    n_entities = max(50, n_edges // 20)
+    return fill_graph(store(), n_chunks, triples_per_chunk, n_entities, seed)
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        "p50_ms": round(1000 * pick(0.5), 4),
+        "p95_ms": round(1000 * pick(0.95), 4),
+    }
+
+
+# =====================================
+# Extraction output parsing: old regex vs tolerant parser
+# =====================================
+def _regex_triples(response):
+    # What GraphExtractor did before parse_json_array
+    match = re.search(r"\[\s*{.*?}\s*\]", response, re.DOTALL)
+    try:
+        return valid_triples(json.loads(match.group())) if match else []
+    except ValueError:
+        return []
+
+
+def bench_extraction_parse(n_responses=2000, triples=10, reasoning_words=200):
+    answer = json.dumps([
+        {"subject": f"entity_{i}", "relation": "RELATED_TO", "object": f"concept_{i}"}
+        for i in range(triples)
+    ], indent=2)
+    # A reasoning trace that drafts a (wrong) array before the answer
+    thinking = " ".join(f"thought_{i}" for i in range(reasoning_words))
+    draft = '[{"subject": "entity_0", "relation": "MAYBE", "object": "concept_0"}]'
+    responses = {
+        "json": answer,
+        "reasoning": f"<think>\n{thinking}\n{draft}\n</think>\n\n{answer}",
+        "fenced": f"Here are the facts:\n```json\n{answer}\n```",
+        # cut off by max_tokens in the middle of the last triple
+        "truncated": answer[:answer.rfind("{") + 20],
+    }
+    results = []
+    for kind, response in responses.items():
+        timings = {}
+        for name, parse in (
+            ("regex", _regex_triples),
+            ("parser", lambda r: valid_triples(parse_json_array(strip_reasoning(r))[0])),
+        ):
+            start = time.perf_counter()
+            for _ in range(n_responses):
+                found = parse(response)
+            timings[name] = ((time.perf_counter() - start) * 1000, len(found))
+        results.append({
+            "bench": "extraction_parse",
+            "response": kind,
+            "responses": n_responses,
+            "completion_chars": len(response),
+            "triples": triples - (kind == "truncated"),
+            "regex_triples": timings["regex"][1],
+            "parser_triples": timings["parser"][1],
+            "regex_ms": round(timings["regex"][0], 2),
+            "parser_ms": round(timings["parser"][0], 2),
+        })
+    return results
+
+
+# =====================================
+# Query path on synthetic graphs: entity fallback, retrieval, context
+# =====================================
+def bench_retrieval(sizes=(1e3, 1e4, 1e5), n_queries=200, max_hops=(1, 2), seed=0):
+    results = []
+    for size in sizes:
+        n_edges = int(float(size))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        graph = make_graph(n_edges, seed=seed)
+        build_seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        rng = random.Random(seed)
+        entities = sorted(graph.nodes_of_type("Entity"))
+        queries = [rng.sample(entities, min(len(entities), rng.randint(1, 3))) for _ in range(n_queries)]
+        questions = [
+            "How are " + " and ".join(q) + f" related to concept {rng.randrange(1000)}?"
+            for q in queries
+        ]
+        base = {"bench": "retrieval", "target_edges": n_edges,
+                "edges": len(graph.edges), "nodes": len(graph.nodes)}
+
+        # QueryEntityExtractor: LLM reply is not JSON -> Aho-Corasick fallback
+        qe = QueryEntityExtractor(llm=FakeLLM(latency=0))
+        start = time.perf_counter()
+        qe.matcher(graph).find("")
+        matcher_seconds = time.perf_counter() - start
+        samples = []
+        found = 0
+        for question in questions:
+            start = time.perf_counter()
+            found += len(qe.extract(question, graph=graph))
+            samples.append(time.perf_counter() - start)
+        results.append({
+            **base, "stage": "query_entity_fallback",
+            "matcher_build_seconds": round(matcher_seconds, 4),
+            "entities_per_query": round(found / n_queries, 2),
+            **_percentiles(samples),
+        })
+
+        retriever = GraphRetriever(graph)
+        for hops in max_hops:
+            retrieve, context = [], []
+            n_chunks = 0
+            for q in queries:
+                start = time.perf_counter()
+                chunk_ids = retriever.retrieve_chunks(q, max_hops=hops)
+                middle = time.perf_counter()
+                build_context_from_chunks(graph, chunk_ids)
+                context.append(time.perf_counter() - middle)
+                retrieve.append(middle - start)
+                n_chunks += len(chunk_ids)
+            results.append({
+                **base, "stage": "retrieve_chunks", "max_hops": hops,
+                "chunks_per_query": round(n_chunks / n_queries, 1),
+                **_percentiles(retrieve),
+            })
+            results.append({
+                **base, "stage": "build_context", "max_hops": hops,
+                **_percentiles(context),
+            })
+
+        results.append({
+            **base, "stage": "graph_build",
+            "build_seconds": round(build_seconds, 3),
+            "peak_mib": round(peak / 2**20, 1),
+        })
+    return results
+
+
+# =====================================
+# BM25 lexical index: build time, size and query latency
+# =====================================
+def bench_bm25(sizes=(1e4, 1e5), n_queries=200, seed=0):
+    results = []
+    for size in sizes:
+        n = int(float(size))
+        chunks = make_chunks(n, seed=seed)
+
+        start = time.perf_counter()
+        index = BM25Index()
+        index.add((f"chunk_{i}", c.page_content) for i, c in enumerate(chunks))
+        build_seconds = time.perf_counter() - start
+        postings_bytes = sum(
+            getattr(index, name).nbytes for name in ("offsets", "doc_ids", "tfs", "doc_len")
+        )
+
+        # 1-3 rare names plus a common filler word, like a real question
+        rng = random.Random(seed)
+        questions = [
+            " ".join(
+                [f"{rng.choice(('entity', 'concept'))}_{rng.randrange(n)}"
+                 for _ in range(rng.randint(1, 3))]
+                + [f"word{rng.randrange(500)}"]
+            )
+            for _ in range(n_queries)
+        ]
+        samples = []
+        for question in questions:
+            start = time.perf_counter()
+            index.search(question, k=10)
+            samples.append(time.perf_counter() - start)
+
+        results.append({
+            "bench": "bm25",
+            "chunks": n,
+            "terms": len(index.terms),
+            "postings": len(index.doc_ids),
+            "build_seconds": round(build_seconds, 3),
+            "postings_mib": round(postings_bytes / 2**20, 1),
+            **_percentiles(samples),
+        })
+    return results
+
+
+def bench_graph_memory(n_chunks=20000):
+    results = []
+    for cls in (GraphStore, CompactGraphStore):
+        tracemalloc.start()
+        start = time.perf_counter()
+        graph = fill_graph(cls(), n_chunks)
+        elapsed = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append({
+            "bench": "graph_memory",
+            "store": cls.__name__,
+            "chunks": n_chunks,
+            "edges": len(graph.edges),
+            "mib": round(current / 2**20, 1),
+            "build_seconds": round(elapsed, 3),
+        })
+    return results
+
+
+# =====================================
+# Encoder throughput on CPU per batch size
+# =====================================
+def bench_encoder(n_chunks=512, batch_sizes=(8, 32, 64, 128), num_threads=None):
+    # Imported here: loads torch + sentence-transformers
+    import rag_util
+
+    encoder = rag_util.Encoder(device="cpu", num_threads=num_threads)
+    texts = [chunk.page_content * 8 for chunk in make_chunks(n_chunks)]
+    encoder.embedding_function.encode(texts[:8])  # warm-up
+
+    results = []
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        encoder.embedding_function.encode(texts, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        results.append({
+            "bench": "encoder",
+            "chunks": n_chunks,
+            "batch_size": batch_size,
+            "seconds": round(elapsed, 4),
+            "chunks_per_s": round(n_chunks / elapsed, 2),
+        })
+    return results
+
+
+# =====================================
+# Streaming answers: time to first token per <think> mode
+# =====================================
+def bench_streaming(reasoning_words=200, answer_words=80, token_latency=0.005):
+    # Imported here: model.py needs huggingface_hub + transformers
+    from model import ChatModel, THINK_MODES
+
+    client = FakeStreamingClient(reasoning_words, answer_words, token_latency=token_latency)
+    llm = ChatModel(client=client)
+    results = []
+
+    start = time.perf_counter()
+    llm.generate("question", context="context")
+    blocking = time.perf_counter() - start
+
+    for think in THINK_MODES:
+        stream = llm.stream("question", context="context", think=think)
+        first_visible = None
+        start = time.perf_counter()
+        for _ in stream:
+            if first_visible is None:
+                first_visible = time.perf_counter() - start
+        results.append({
+            "bench": "streaming",
+            "think": think,
+            "chunks": stream.chunks,
+            "ttft_s": round(stream.ttft, 4),
+            "first_visible_s": round(first_visible, 4),
+            "first_answer_s": round(stream.first_answer, 4),
+            "total_s": round(stream.elapsed, 4),
+            "blocking_generate_s": round(blocking, 4),
+        })
+    return results
+
+
+# =====================================
+# LLM client: pooled connections, coalescing, rate limit, 429 retries
+# =====================================
+def bench_llm_client(n_requests=64, latency=0.05, workers=16, rate_limit=50, fail_every=8):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from llm_util import HTTPChatClient, LLMClient
+
+    scenarios = [
+        # (name, distinct prompts, requests/s, 429 every Nth request)
+        ("distinct", True, None, 0),
+        ("identical", False, None, 0),
+        ("rate_limited", True, rate_limit, 0),
+        ("throttled_429", True, None, fail_every),
+        ("async", True, None, 0),
+    ]
+    results = []
+    for name, distinct, rate, fail in scenarios:
+        with StubChatServer(latency=latency, fail_every=fail) as server:
+            client = LLMClient(
+                HTTPChatClient(server.url, pool_size=workers),
+                rate=rate,
+                burst=rate and 4,
+                backoff=0.01,
+                max_workers=workers,
+            )
+            prompts = [f"question {i if distinct else 0}" for i in range(n_requests)]
+
+            def ask(prompt):
+                return client.chat_completion(
+                    messages=[{"role": "user", "content": prompt}], max_tokens=50
+                )
+
+            async def ask_all():
+                return await asyncio.gather(*(
+                    client.achat_completion(messages=[{"role": "user", "content": p}], max_tokens=50)
+                    for p in prompts
+                ))
+
+            start = time.perf_counter()
+            if name == "async":
+                answers = asyncio.run(ask_all())
+            else:
+                # Waves of one request per worker: identical prompts of a
+                # wave overlap, so the coalesced count does not depend on timing
+                answers = []
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    for i in range(0, n_requests, workers):
+                        answers.extend(pool.map(ask, prompts[i:i + workers]))
+            elapsed = time.perf_counter() - start
+
+        assert all(a["choices"][0]["message"]["content"] for a in answers)
+        stats = client.stats()
+        results.append({
+            "bench": "llm_client",
+            "scenario": name,
+            "requests": n_requests,
+            "workers": workers,
+            "latency_s": latency,
+            "rate_limit": rate,
+            "fail_every": fail,
+            "upstream_requests": server.requests,
+            "rejected_429": server.rejected,
+            "retries": stats["retries"],
+            "coalesced": stats["coalesced"],
+            "total_s": round(elapsed, 4),
+            "requests_per_s": round(n_requests / elapsed, 1),
+        })
+    return results
+
+
+# =====================================
+# Answer cache: lookup latency per hit kind
+# =====================================
+def bench_answer_cache(n_entries=1000, n_lookups=500, threshold=0.8):
+    from cache_util import AnswerCache
+
+    cache = AnswerCache(FakeEmbeddings(), threshold=threshold, max_entries=n_entries)
+    questions = [
+        f"what does entity_{i} say about concept_{i % 17} and topic_{i % 5}"
+        for i in range(n_entries)
+    ]
+    for i, q in enumerate(questions):
+        cache.put(q, f"answer {i}")
+
+    lookups = {
+        "exact": [q.upper() + "?" for q in questions[:n_lookups]],
+        "semantic": [q.replace("what does", "tell me what") for q in questions[:n_lookups]],
+        "miss": [f"unrelated question number {i}" for i in range(n_lookups)],
+    }
+    results = []
+    for kind, batch in lookups.items():
+        cache.reset_stats()
+        start = time.perf_counter()
+        for q in batch:
+            cache.get(q)
+        elapsed = time.perf_counter() - start
+        results.append({
+            "bench": "answer_cache",
+            "entries": n_entries,
+            "lookup": kind,
+            "ms_per_lookup": round(1000 * elapsed / n_lookups, 4),
+            **cache.stats(),
+        })
+    return results
+
+
+# =====================================
+# Reranking: cosine over stored chunk vectors, cold vs warm vector cache
+# =====================================
+def bench_rerank(candidate_counts=(50, 500), n_queries=100, top_k=8, seed=0):
+    import numpy as np
+    from rerank_util import Reranker
+
+    embeddings = FakeEmbeddings()
+    chunks = [
+        {"chunk_id": f"chunk_{i}", "text": c.page_content}
+        for i, c in enumerate(make_chunks(max(candidate_counts), seed=seed))
+    ]
+    # Stand-in for FaissDb.chunk_vectors: vectors computed once at ingestion
+    stored = {
+        c["chunk_id"]: v
+        for c, v in zip(chunks, np.asarray(embeddings.embed_documents([c["text"] for c in chunks]),
+                                           dtype=np.float32))
+    }
+
+    def vectors(chunk_ids):
+        found = [cid for cid in chunk_ids if cid in stored]
+        return found, np.stack([stored[cid] for cid in found])
+
+    rng = random.Random(seed)
+    results = []
+    for n in candidate_counts:
+        questions = [
+            f"what links entity_{rng.randrange(n)} and concept_{rng.randrange(n)}"
+            for _ in range(n_queries)
+        ]
+        for cache in ("cold", "warm"):
+            reranker = Reranker(embeddings, vectors=vectors, top_k=top_k, budget_ms=1e6)
+            if cache == "warm":
+                reranker.rerank(questions[0], chunks[:n])
+            samples = []
+            for question in questions:
+                if cache == "cold":
+                    reranker._cache.clear()
+                start = time.perf_counter()
+                reranker.rerank(question, chunks[:n])
+                samples.append(time.perf_counter() - start)
+            results.append({
+                "bench": "rerank",
+                "candidates": n,
+                "top_k": top_k,
+                "vector_cache": cache,
+                **_percentiles(samples),
+            })
+    return results
+
+
+# =====================================
+# ANN index types: recall@k vs latency against exact search
+# =====================================
+def make_vectors(n, d=384, n_clusters=200, seed=0):
+    """Clustered unit vectors (iid noise has no neighbourhood structure)."""
+    import faiss
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, d)).astype(np.float32)
+    vectors = centers[rng.integers(n_clusters, size=n)]
+    vectors += 0.35 * rng.standard_normal((n, d)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def bench_ann(n=20000, d=384, n_queries=200, k=10):
+    import faiss
+    from ann_util import build_index, set_search_params, recall_at_k
+
+    vectors = make_vectors(n + n_queries, d)
+    base, queries = vectors[:n], vectors[n:]
+
+    configs = [("flat", {})]
+    configs += [("hnsw", {"ef_search": ef}) for ef in (16, 64, 128)]
+    configs += [("ivf_flat", {"nprobe": p}) for p in (1, 8, 32)]
+    configs += [("ivf_pq", {"nprobe": p}) for p in (8, 32)]
+
+    results = []
+    exact = None
+    built = {}
+    for index_type, params in configs:
+        if index_type not in built:
+            start = time.perf_counter()
+            built[index_type] = build_index(base, index_type)[0]
+            build_seconds = time.perf_counter() - start
+        index = set_search_params(built[index_type], **params)
+
+        start = time.perf_counter()
+        _, ids = index.search(queries, k)
+        elapsed = time.perf_counter() - start
+        if exact is None:
+            exact = ids
+
+        results.append({
+            "bench": "ann",
+            "vectors": n,
+            "dim": d,
+            "index": index_type,
+            **params,
+            "build_seconds": round(build_seconds, 3),
+            "ms_per_query": round(1000 * elapsed / n_queries, 4),
+            f"recall_at_{k}": round(recall_at_k(exact, ids), 4),
+            "bytes_per_vector": round(len(faiss.serialize_index(index)) / n, 1),
+        })
+    return results
+
+
+BENCHMARKS = {
+    "extraction": bench_extraction,
+    "extraction_parse": bench_extraction_parse,
+    "retrieval": bench_retrieval,
+    "bm25": bench_bm25,
+    "graph_memory": bench_graph_memory,
+    "ann": bench_ann,
+    "answer_cache": bench_answer_cache,
+    "rerank": bench_rerank,
+    "encoder": bench_encoder,
+    "streaming": bench_streaming,
+    "llm_client": bench_llm_client,
+}
+
+# Run by default; the others need model downloads
+OFFLINE = ["extraction", "extraction_parse", "retrieval", "bm25", "graph_memory", "ann", "answer_cache", "rerank",
+           "llm_client"]
+
+# Command line option -> benchmark keyword argument (passed where accepted)
+OPTIONS = {
+    "sizes": "sizes",
+    "chunks": "n_chunks",
+    "queries": "n_queries",
+    "latency": "latency",
+    "seed": "seed",
+}
+
+
+def environment():
+    """First output row: enough to tell whether two runs are comparable."""
+    env = {
+        "bench": "env",
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    try:
+        env["commit"] = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        env["commit"] = None
+    for module in ("numpy", "faiss"):
+        try:
+            env[module] = __import__(module).__version__
+        except ImportError:
+            env[module] = None
+    return env
+
+
+def _unit(key):
+    if key.endswith("_per_s"):
+        return None
+    if key.endswith("_ms") or key.startswith("ms_"):
+        return "ms"
+    if "seconds" in key or key.endswith("_s"):
+        return "s"
+    return None
+
+
+# Input parameters of each benchmark's rows. Rows with the same values are
+# compared; every other number in a row is a metric
+ROW_KEYS = {
+    "extraction": ("chunks", "latency_s", "workers", "pack_tokens"),
+    "extraction_parse": ("response", "responses"),
+    "retrieval": ("target_edges", "stage", "max_hops"),
+    "bm25": ("chunks",),
+    "graph_memory": ("store", "chunks"),
+    "ann": ("vectors", "dim", "index", "nprobe", "ef_search"),
+    "answer_cache": ("entries", "lookup"),
+    "rerank": ("candidates", "top_k", "vector_cache"),
+    "encoder": ("chunks", "batch_size"),
+    "streaming": ("think",),
+    "llm_client": ("scenario", "requests", "workers", "latency_s", "rate_limit", "fail_every"),
+}
+
+LOWER_IS_BETTER = {"bytes_per_vector", "upstream_requests", "retries", "llm_requests"}
+HIGHER_IS_BETTER = {"hit_rate", "coalesced"}
+
+
+def metric_direction(key, bench=None):
+    """
+    +1 if higher is better, -1 if lower is better, 0 for outputs that should
+    not change either way (counts such as parser_triples or
+    chunks_per_query), None for the row's input parameters.
+    """
+    if key == "bench" or key in ROW_KEYS.get(bench, ()):
+        return None
+    if key.endswith("_per_s") or key.startswith("recall") or key in HIGHER_IS_BETTER:
+        return 1
+    if _unit(key) or key.endswith("mib") or key in LOWER_IS_BETTER:
+        return -1
+    return 0
+
+
+# Timing differences below these are noise, whatever the ratio
+NOISE_FLOOR = {"ms": 0.25, "s": 1e-3}
+
+
+def _identity(row):
+    bench = row.get("bench")
+    return json.dumps(
+        {"bench": bench, **{k: row.get(k) for k in ROW_KEYS.get(bench, ())}}, sort_keys=True
+    )
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def compare(rows, baseline_rows, tolerance=0.2):
+    """
+    Compare a run with a baseline, for the benchmarks present in the run.
+
+    Returns (regressions, unmatched): (bench, params, metric, baseline,
+    current, change) for every metric that got worse by more than
+    tolerance (or changed at all, for direction-0 outputs), and
+    (bench, params, "baseline" / "current") for rows found in only one of
+    the two runs.
+    """
+    rows = [r for r in rows if r.get("bench") != "env"]
+    ran = {r["bench"] for r in rows}
+    baseline = {
+        _identity(r): r for r in baseline_rows
+        if r.get("bench") != "env" and r.get("bench") in ran
+    }
+    current = {_identity(r) for r in rows}
+    unmatched = [
+        (r["bench"], key, "baseline") for key, r in baseline.items() if key not in current
+    ]
+
+    regressions = []
+    for row in rows:
+        old = baseline.get(_identity(row))
+        if old is None:
+            unmatched.append((row["bench"], _identity(row), "current"))
+            continue
+        for key, value in row.items():
+            direction = metric_direction(key, row["bench"])
+            before = old.get(key)
+            if direction is None or not _number(value) or not _number(before) or value == before:
+                continue
+            if abs(value - before) < NOISE_FLOOR.get(_unit(key), 0):
+                continue
+            change = (value - before) / abs(before) if before else math.copysign(math.inf, value)
+            worse = abs(change) if direction == 0 else -direction * change
+            if worse > tolerance:
+                regressions.append((row["bench"], _identity(row), key, before, value, change))
+    return regressions, unmatched
+
+
+def _kwargs(fn, args):
+    accepted = inspect.signature(fn).parameters
+    kwargs = {}
+    for option, param in OPTIONS.items():
+        value = getattr(args, option)
+        if value is not None and param in accepted:
+            kwargs[param] = value
+    return kwargs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("names", nargs="*",
+                        help="any of %s (default: %s)" % (", ".join(BENCHMARKS), " ".join(OFFLINE)))
+    parser.add_argument("--sizes", nargs="+", type=float,
+                        help="graph sizes in edges for 'retrieval' (e.g. 1e3 1e5 1e7), "
+                             "chunks for 'bm25'")
+    parser.add_argument("--chunks", type=int, help="synthetic chunks for 'extraction'")
+    parser.add_argument("--queries", type=int, help="queries per graph size")
+    parser.add_argument("--latency", type=float, help="mock LLM latency in seconds")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--out", help="also write the JSON lines to this file")
+    parser.add_argument("--compare", help="baseline JSONL from an earlier --out")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative change counted as a regression (default 0.2)")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    rows = [environment()]
+    print(json.dumps(rows[0]), flush=True)
+    for name in args.names or OFFLINE:
+        fn = BENCHMARKS[name]
+        # Progress prints of the pipeline go to stderr, stdout stays JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            results = fn(**_kwargs(fn, args))
+        for row in results:
+            rows.append(row)
+            print(json.dumps(row), flush=True)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline_rows = [json.loads(line) for line in f if line.strip()]
+        regressions, unmatched = compare(rows, baseline_rows, args.tolerance)
+        for bench, params, key, before, after, change in regressions:
+            print(f"REGRESSION {bench} {key}: {before} -> {after} ({change:+.0%}) {params}",
+                  file=sys.stderr)
+        for bench, params, only_in in unmatched:
+            print(f"UNMATCHED {bench}: row only in the {only_in} run {params}", file=sys.stderr)
+        print(f"{len(regressions)} regression(s), {len(unmatched)} unmatched row(s) "
+              f"vs {args.compare}", file=sys.stderr)
+        sys.exit(1 if regressions or unmatched else 0)
@@ -0,0 +1,228 @@
+"""
+In-process BM25 index over chunk texts, for exact terms (rare names,
+formulas, acronyms) that sentence embeddings tend to miss.
+
+Postings are kept in CSR form: the postings of term t are
+doc_ids[offsets[t]:offsets[t + 1]] with their term frequencies in tfs.
+A query only touches the postings of its own terms, so its cost does not
+grow with the number of chunks.
+
+Layout of a saved index directory:
+
+    meta.json                     format version, k1, b, vocabulary (term order)
+                                  and chunk ids
+    offsets.npy                   int64, one entry per term + 1
+    doc_ids.npy / tfs.npy         int32 / uint16 postings
+    doc_len.npy                   int32 tokens per chunk
+
+Arrays are opened with mmap_mode="r" and copied into memory before the
+index is changed or saved. save() writes a new version of the directory
+(persist_util.write_version), so a mapped index is never overwritten.
+"""
+import json
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+from persist_util import write_version, current_version, check_version
+
+FORMAT_VERSION = 1
+
+_TOKEN = re.compile(r"\w+")
+
+# Too common to carry any signal; dropping them keeps the postings short
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from had has have how if in into
+is it its not of on or so such than that the their then there these they this
+to was were what when where which who why will with would
+""".split())
+
+
+def tokenize(text: str):
+    """Lowercased word tokens (NFKC folded), stopwords dropped."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return [t for t in _TOKEN.findall(text) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    BM25 (Okapi) over chunk texts, kept in sync with a graph's Chunk nodes.
+
+        index = BM25Index().sync(graph)
+        index.search("Navier-Stokes equation", k=10)  # [(chunk_id, score)]
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms = {}       # term -> term id
+        self.chunk_ids = []   # doc id -> chunk id
+        self._docs = {}       # chunk id -> doc id
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.zeros(0, dtype=np.int32)
+        self.tfs = np.zeros(0, dtype=np.uint16)
+        self.doc_len = np.zeros(0, dtype=np.int32)
+        self._norm = None
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self._docs
+
+    def _materialize(self):
+        # Loaded arrays are read-only maps of files a later save replaces
+        for name in ("offsets", "doc_ids", "tfs", "doc_len"):
+            value = getattr(self, name)
+            if isinstance(value, np.memmap):
+                setattr(self, name, np.array(value))
+
+    def _postings(self):
+        """(term id, doc id, tf) arrays of the whole index."""
+        term_of = np.repeat(
+            np.arange(len(self.offsets) - 1, dtype=np.int32), np.diff(self.offsets)
+        )
+        return term_of, np.asarray(self.doc_ids), np.asarray(self.tfs)
+
+    def _rebuild(self, term_of, doc_ids, tfs, chunk_ids, doc_len):
+        order = np.lexsort((doc_ids, term_of))
+        self.offsets = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_of, minlength=len(self.terms)), out=self.offsets[1:])
+        self.doc_ids = doc_ids[order].astype(np.int32)
+        self.tfs = tfs[order].astype(np.uint16)
+        self.chunk_ids = chunk_ids
+        self._docs = {cid: i for i, cid in enumerate(chunk_ids)}
+        self.doc_len = np.asarray(doc_len, dtype=np.int32)
+        self._norm = None
+
+    def add(self, chunks):
+        """Index (chunk_id, text) pairs; chunk ids already indexed are skipped."""
+        new_terms, new_docs, new_tfs, new_len, new_ids = [], [], [], [], []
+        seen = set()
+        doc = len(self.chunk_ids)
+        for chunk_id, text in chunks:
+            if chunk_id in self._docs or chunk_id in seen:
+                continue
+            seen.add(chunk_id)
+            tokens = tokenize(text)
+            counts = {}
+            for tok in tokens:
+                term = self.terms.setdefault(tok, len(self.terms))
+                counts[term] = counts.get(term, 0) + 1
+            new_terms.extend(counts)
+            new_tfs.extend(min(tf, 65535) for tf in counts.values())
+            new_docs.extend([doc] * len(counts))
+            new_len.append(len(tokens))
+            new_ids.append(chunk_id)
+            doc += 1
+        if not new_ids:
+            return []
+
+        self._materialize()
+        term_of, doc_ids, tfs = self._postings()
+        self._rebuild(
+            np.concatenate([term_of, np.asarray(new_terms, dtype=np.int32)]),
+            np.concatenate([doc_ids, np.asarray(new_docs, dtype=np.int32)]),
+            np.concatenate([tfs, np.asarray(new_tfs, dtype=np.uint16)]),
+            self.chunk_ids + new_ids,
+            np.concatenate([self.doc_len, np.asarray(new_len, dtype=np.int32)]),
+        )
+        return new_ids
+
+    def remove(self, chunk_ids):
+        """Drop the given chunks; returns the ids that were indexed."""
+        removed = [c for c in dict.fromkeys(chunk_ids) if c in self._docs]
+        if not removed:
+            return []
+        doomed = [self._docs[c] for c in removed]
+        keep = np.ones(len(self.chunk_ids), dtype=bool)
+        keep[doomed] = False
+        self._materialize()
+        # old doc id -> new doc id
+        remap = np.cumsum(keep, dtype=np.int64) - 1
+
+        term_of, doc_ids, tfs = self._postings()
+        alive = keep[doc_ids]
+        self._rebuild(
+            term_of[alive],
+            remap[doc_ids[alive]],
+            tfs[alive],
+            [cid for cid, k in zip(self.chunk_ids, keep) if k],
+            np.asarray(self.doc_len)[keep],
+        )
+        return removed
+
+    def sync(self, graph):
+        """Index Chunk nodes added to graph and drop the ones it no longer has."""
+        chunk_ids = graph.nodes_of_type("Chunk")
+        current = set(chunk_ids)
+        self.remove([c for c in self.chunk_ids if c not in current])
+        self.add(
+            (cid, graph.nodes[cid].get("text") or "")
+            for cid in chunk_ids if cid not in self._docs
+        )
+        return self
+
+    def _doc_norm(self):
+        # k1 * (1 - b + b * len / avg len), per document
+        if self._norm is None:
+            doc_len = np.asarray(self.doc_len, dtype=np.float32)
+            avg = doc_len.mean() if len(doc_len) else 1.0
+            self._norm = self.k1 * (1 - self.b + self.b * doc_len / max(avg, 1.0))
+        return self._norm
+
+    def search(self, query: str, k: int = 10):
+        """Top-k (chunk_id, score) pairs, best first."""
+        n = len(self.chunk_ids)
+        terms = {self.terms[t] for t in tokenize(query) if t in self.terms}
+        if not n or not terms:
+            return []
+        norm = self._doc_norm()
+
+        ids, contribs = [], []
+        for term in terms:
+            start, end = self.offsets[term], self.offsets[term + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end].astype(np.float32)
+            df = end - start
+            idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+            ids.append(docs)
+            contribs.append(idf * tf * (self.k1 + 1) / (tf + norm[docs]))
+
+        docs, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contribs))
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.chunk_ids[int(docs[i])], float(scores[i])) for i in top]
+
+    def save(self, path: str):
+        self._materialize()
+        with write_version(path) as target:
+            self._write(target)
+
+    def _write(self, path: str):
+        terms = sorted(self.terms, key=self.terms.get)
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": FORMAT_VERSION, "k1": self.k1, "b": self.b,
+                       "terms": terms, "chunk_ids": self.chunk_ids}, f)
+        for name in ("offsets", "doc_ids", "tfs", "doc_len"):
+            np.save(os.path.join(path, f"{name}.npy"), np.asarray(getattr(self, name)))
+
+    @classmethod
+    def load(cls, path: str):
+        path = current_version(path)
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        check_version("BM25 index", meta.get("version"), (FORMAT_VERSION,))
+        index = cls(k1=meta["k1"], b=meta["b"])
+        index.terms = {t: i for i, t in enumerate(meta["terms"])}
+        index.chunk_ids = meta["chunk_ids"]
+        index._docs = {cid: i for i, cid in enumerate(index.chunk_ids)}
+        for name in ("offsets", "doc_ids", "tfs", "doc_len"):
+            setattr(index, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        return index
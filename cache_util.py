@@ -0,0 +1,340 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+
+def content_key(*parts: str) -> str:
+    """sha256 over the given strings (length-prefixed so parts can't collide)."""
+    h = hashlib.sha256()
+    for part in parts:
+        data = (part or "").encode("utf-8")
+        h.update(str(len(data)).encode() + b":" + data)
+    return h.hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """sha256 over the bytes of a file (read in 1 MiB blocks)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class SqliteCache:
+    """
+    Single-file SQLite key/value cache with a byte budget.
+
+    Keys are content hashes (see content_key). When the stored payload
+    grows past max_bytes the least recently used entries are evicted.
+    Subclasses define how values are encoded (_encode / _decode).
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Shared by worker threads, guarded by _lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_last_used ON entries(last_used)"
+        )
+        self._conn.commit()
+        self._total = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+
+    def _encode(self, value):
+        return value
+
+    def _decode(self, raw):
+        return raw
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Returns {key: value} for the keys that are cached."""
+        found = {}
+        with self._lock:
+            # stay under SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    "SELECT key, value FROM entries WHERE key IN (%s)"
+                    % ",".join("?" * len(batch)),
+                    batch,
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE entries SET last_used = ? WHERE key = ?",
+                    [(now, k) for k in found],
+                )
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return {k: self._decode(v) for k, v in found.items()}
+
+    def put(self, key: str, value):
+        self.put_many({key: value})
+
+    def put_many(self, items):
+        rows = []
+        for key, value in items.items():
+            payload = self._encode(value)
+            rows.append((key, payload, len(payload)))
+        with self._lock:
+            now = time.time()
+            for key, payload, size in rows:
+                old = self._conn.execute(
+                    "SELECT size FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, last_used) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, payload, size, now),
+                )
+                self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Drop least recently used entries until we are back under budget
+        rows = self._conn.execute(
+            "SELECT key, size FROM entries ORDER BY last_used ASC"
+        )
+        doomed = []
+        for key, size in rows:
+            if self._total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            self._total -= size
+        rows.close()
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", doomed)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._total}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ExtractionCache(SqliteCache):
+    """Cache of LLM extraction results (JSON values)."""
+
+    def _encode(self, value):
+        return json.dumps(value)
+
+    def _decode(self, raw):
+        return json.loads(raw)
+
+
+class EmbeddingCache(SqliteCache):
+    """Cache of embedding vectors (raw float32 bytes)."""
+
+    def _encode(self, value):
+        return np.asarray(value, dtype=np.float32).tobytes()
+
+    def _decode(self, raw):
+        return np.frombuffer(raw, dtype=np.float32)
+
+
+def normalize_question(question: str) -> str:
+    """Case / whitespace folding, trailing punctuation dropped."""
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+
+class AnswerCache:
+    """
+    In-memory semantic cache of final answers.
+
+    A question is first looked up by its normalized text (no embedding
+    needed). Otherwise it is embedded with embedding_function and matched
+    against the cached questions in a small inner-product FAISS index; the
+    closest one is a hit when their cosine similarity is >= threshold.
+
+    Entries expire ttl seconds after they were stored, and at most
+    max_entries are kept (least recently used are dropped first).
+
+    Every get / put names the graph / index version the answer belongs
+    to, and each version has its own entries and FAISS index, so sessions
+    on different versions never see each other's answers. At most
+    max_versions versions are kept; the least recently used one is
+    dropped as a whole.
+    """
+
+    def __init__(
+        self,
+        embedding_function,
+        threshold: float = 0.93,
+        max_entries: int = 1000,
+        ttl: float = 24 * 3600,
+        max_versions: int = 4,
+    ):
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_versions = max_versions
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # entry id -> {"question", "version", "key", "value", "created"}, in LRU order
+        self._entries = OrderedDict()
+        # (version, normalized question) -> entry id
+        self._by_key = {}
+        # version -> FAISS index of its questions, in LRU order
+        self._indexes = OrderedDict()
+        self._next_id = 0
+
+    def _embed(self, question: str) -> np.ndarray:
+        vec = np.asarray([self.embedding_function.embed_query(question)], dtype=np.float32)
+        faiss.normalize_L2(vec)
+        return vec
+
+    def _drop(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        version = entry["version"]
+        del self._by_key[(version, entry["key"])]
+        index = self._indexes[version]
+        index.remove_ids(np.asarray([entry_id], dtype=np.int64))
+        if not index.ntotal:
+            del self._indexes[version]
+
+    def _drop_version(self, version):
+        doomed = [i for i, e in self._entries.items() if e["version"] == version]
+        for entry_id in doomed:
+            self._drop(entry_id)
+        self._indexes.pop(version, None)
+
+    def _expire(self, now):
+        doomed = [i for i, e in self._entries.items() if now - e["created"] > self.ttl]
+        for entry_id in doomed:
+            self._drop(entry_id)
+
+    def _hit(self, entry_id, similarity, exact):
+        self._entries.move_to_end(entry_id)
+        entry = self._entries[entry_id]
+        if exact:
+            self.exact_hits += 1
+        else:
+            self.semantic_hits += 1
+        return {
+            **entry["value"],
+            "cached_question": entry["question"],
+            "similarity": similarity,
+            "exact": exact,
+        }
+
+    def get(self, question: str, version=None):
+        """
+        Cached value for question under index version (plus
+        cached_question, similarity and exact), or None on a miss.
+        """
+        key = normalize_question(question)
+        with self._lock:
+            self._expire(time.time())
+            entry_id = self._by_key.get((version, key))
+            if entry_id is not None:
+                self._indexes.move_to_end(version)
+                return self._hit(entry_id, 1.0, exact=True)
+            if version not in self._indexes:
+                self.misses += 1
+                return None
+
+        vec = self._embed(question)
+        with self._lock:
+            index = self._indexes.get(version)
+            if index is not None:
+                scores, ids = index.search(vec, 1)
+                entry_id = int(ids[0, 0])
+                if entry_id in self._entries and scores[0, 0] >= self.threshold:
+                    self._indexes.move_to_end(version)
+                    return self._hit(entry_id, float(scores[0, 0]), exact=False)
+            self.misses += 1
+            return None
+
+    def put(self, question: str, answer: str, version=None, **extra):
+        """
+        Store answer (and any extra JSON-like fields) for question, as
+        computed on index version.
+        """
+        key = normalize_question(question)
+        vec = self._embed(question)
+        with self._lock:
+            if (version, key) in self._by_key:
+                self._drop(self._by_key[(version, key)])
+            if version not in self._indexes:
+                while len(self._indexes) >= self.max_versions:
+                    self._drop_version(next(iter(self._indexes)))
+                self._indexes[version] = faiss.IndexIDMap2(faiss.IndexFlatIP(vec.shape[1]))
+            self._indexes.move_to_end(version)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._indexes[version].add_with_ids(vec, np.asarray([entry_id], dtype=np.int64))
+            self._entries[entry_id] = {
+                "question": question,
+                "version": version,
+                "key": key,
+                "value": {"answer": answer, **extra},
+                "created": time.time(),
+            }
+            self._by_key[(version, key)] = entry_id
+
+            self._expire(time.time())
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        hits = self.exact_hits + self.semantic_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def reset_stats(self):
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
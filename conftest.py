@@ -0,0 +1,2 @@
+# test_graph.py is a manual end-to-end run (real model, local PDF), not a pytest module
+collect_ignore = ["test_graph.py"]
@@ -0,0 +1,446 @@
+import json
+import os
+import re
+import unicodedata
+from itertools import islice
+from typing import Dict, List
+
+import faiss
+import numpy as np
+
+from persist_util import IndexFormatError, check_version
+
+# Version written to aliases.json / entities.json
+FORMAT_VERSION = 1
+
+_SEPARATORS = re.compile(r"[-_/]+")
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_ARTICLES = {"the", "a", "an"}
+
+
+def _lemma(token: str) -> str:
+    # Light plural stripping; good enough to fold "tectonics" / "tectonic"
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if token.endswith("sses"):
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    return token
+
+
+def normalize_entity(name: str) -> str:
+    """
+    Case / whitespace / punctuation folding plus light lemmatization:
+    "Plate-Tectonics" and "plate tectonic" both become "plate tectonic".
+    """
+    text = unicodedata.normalize("NFKC", name).lower()
+    text = _SEPARATORS.sub(" ", text)
+    text = _PUNCTUATION.sub("", text)
+    tokens = [_lemma(t) for t in text.split()]
+    while len(tokens) > 1 and tokens[0] in _ARTICLES:
+        tokens = tokens[1:]
+    return " ".join(tokens)
+
+
+class EntityResolver:
+    """
+    Maps entity surface forms to one canonical name.
+
+    Names are first folded with normalize_entity(). With an
+    embedding_function (rag_util.Encoder().embedding_function), a name
+    whose normalized form is new is also merged into the closest existing
+    canonical entity when their cosine similarity is >= threshold.
+
+    The canonical name is the first surface form seen, so results are
+    deterministic for a given chunk order.
+    """
+
+    def __init__(self, embedding_function=None, threshold: float = 0.9):
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        # normalized alias -> canonical name
+        self.aliases: Dict[str, str] = {}
+        # canonical name -> unit vector (only with embedding_function)
+        self._canonicals: List[str] = []
+        self._vectors: List[np.ndarray] = []
+        self._matrix = None
+
+    def _embed(self, names: List[str]) -> np.ndarray:
+        vecs = np.asarray(self.embedding_function.embed_documents(names), dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        return vecs / np.maximum(norms, 1e-12)
+
+    def _nearest(self, vec: np.ndarray):
+        if not self._vectors:
+            return None
+        if self._matrix is None or len(self._matrix) != len(self._vectors):
+            self._matrix = np.vstack(self._vectors)
+        sims = self._matrix @ vec
+        best = int(np.argmax(sims))
+        if sims[best] >= self.threshold:
+            return self._canonicals[best]
+        return None
+
+    def lookup(self, name: str):
+        """Canonical name for name, or None if it is unknown (never inserts)."""
+        key = normalize_entity(name)
+        if key in self.aliases:
+            return self.aliases[key]
+        if self.embedding_function is not None and key:
+            return self._nearest(self._embed([name])[0])
+        return None
+
+    def resolve(self, name: str, vec: np.ndarray = None) -> str:
+        """
+        Canonical name for name, registering it as a new entity if needed.
+        vec: precomputed unit embedding of name (see canonicalize_triples)
+        """
+        name = " ".join(name.split())
+        key = normalize_entity(name)
+        if not key:
+            return name
+        canonical = self.aliases.get(key)
+        if canonical is not None:
+            return canonical
+
+        if self.embedding_function is not None:
+            if vec is None:
+                vec = self._embed([name])[0]
+            canonical = self._nearest(vec)
+
+        if canonical is None:
+            canonical = name
+            if vec is not None:
+                self._canonicals.append(canonical)
+                self._vectors.append(vec)
+        self.aliases[key] = canonical
+        return canonical
+
+    def canonicalize_triples(self, triples):
+        vecs = {}
+        if self.embedding_function is not None:
+            # One embedding call per chunk for all names not seen before
+            new = sorted({
+                " ".join(t[k].split())
+                for t in triples for k in ("subject", "object")
+                if normalize_entity(t[k]) not in self.aliases
+            })
+            if new:
+                vecs = dict(zip(new, self._embed(new)))
+
+        def canon(name):
+            return self.resolve(name, vecs.get(" ".join(name.split())))
+
+        return [
+            {**t, "subject": canon(t["subject"]), "object": canon(t["object"])}
+            for t in triples
+        ]
+
+    def aliases_of(self, canonical: str) -> List[str]:
+        return [alias for alias, c in self.aliases.items() if c == canonical]
+
+    def save(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"version": FORMAT_VERSION, "threshold": self.threshold,
+                       "aliases": self.aliases}, f)
+
+    def _embed_canonicals(self):
+        if self.embedding_function is not None:
+            canonicals = sorted(set(self.aliases.values()))
+            if canonicals:
+                self._canonicals = canonicals
+                self._vectors = list(self._embed(canonicals))
+
+    @classmethod
+    def load(cls, path: str, embedding_function=None):
+        """Restore the alias index (canonical names are re-embedded if needed)."""
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        check_version("alias index", data.get("version"), (FORMAT_VERSION,))
+        resolver = cls(embedding_function=embedding_function, threshold=data["threshold"])
+        resolver.aliases = data["aliases"]
+        resolver._embed_canonicals()
+        return resolver
+
+    @classmethod
+    def from_graph(cls, graph, embedding_function=None, threshold: float = 0.9):
+        """
+        Alias index with every Entity / Concept node of graph as its own
+        canonical name, for when the saved one cannot be loaded. Aliases
+        merged away at build time are lost.
+        """
+        resolver = cls(embedding_function=embedding_function, threshold=threshold)
+        for node_type in ("Entity", "Concept"):
+            for name in graph.nodes_of_type(node_type):
+                key = normalize_entity(name)
+                if key:
+                    resolver.aliases.setdefault(key, name)
+        resolver._embed_canonicals()
+        return resolver
+
+
+class EntityMatcher:
+    """
+    Aho-Corasick automaton over normalized entity names and aliases.
+
+    Patterns and questions are both run through normalize_entity() and
+    matched token by token, so matches always fall on word boundaries and
+    one pass over the question finds every pattern. Patterns can be added
+    and removed at any time; failure links are recomputed lazily before the
+    next match.
+    """
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._own: List[List[str]] = [[]]
+        self._fail: List[int] = [0]
+        self._dict_link: List[int] = [0]
+        self._dirty = False
+        # value -> states reporting it, so remove() needs no trie walk
+        self._states: Dict[str, set] = {}
+        # state of the last sync()
+        self._graph = None
+        self._revision = None
+        self._resolver = None
+        self._num_aliases = 0
+        self._aliases: Dict[str, List[str]] = {}   # canonical -> aliases
+        self._values = set()                        # values currently matched
+
+    def add(self, name: str, value: str):
+        """Report value whenever the normalized form of name occurs."""
+        tokens = normalize_entity(name).split()
+        if not tokens:
+            return
+        state = 0
+        for tok in tokens:
+            nxt = self._goto[state].get(tok)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][tok] = nxt
+                self._goto.append({})
+                self._own.append([])
+                self._fail.append(0)
+                self._dict_link.append(0)
+            state = nxt
+        if value not in self._own[state]:
+            self._own[state].append(value)
+            self._states.setdefault(value, set()).add(state)
+            self._dirty = True
+
+    def remove(self, value: str):
+        """Stop reporting value, under every name it was added with."""
+        for state in self._states.pop(value, ()):
+            self._own[state].remove(value)
+            self._dirty = True
+
+    def _link(self):
+        # BFS over the trie: fail = longest proper suffix that is a trie path,
+        # dict_link = nearest state on the fail chain that reports a value
+        queue = []
+        for nxt in self._goto[0].values():
+            self._fail[nxt] = 0
+            self._dict_link[nxt] = 0
+            queue.append(nxt)
+        for state in queue:
+            for tok, nxt in self._goto[state].items():
+                f = self._fail[state]
+                while f and tok not in self._goto[f]:
+                    f = self._fail[f]
+                f = self._goto[f].get(tok, 0)
+                self._fail[nxt] = f
+                self._dict_link[nxt] = f if self._own[f] else self._dict_link[f]
+                queue.append(nxt)
+        self._dirty = False
+
+    def find(self, text: str) -> List[str]:
+        """Values of every pattern found in text, in order of first match."""
+        if self._dirty:
+            self._link()
+        found = []
+        state = 0
+        for tok in normalize_entity(text).split():
+            while state and tok not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(tok, 0)
+            s = state
+            while s:
+                for value in self._own[s]:
+                    if value not in found:
+                        found.append(value)
+                s = self._dict_link[s]
+        return found
+
+    def sync(self, graph, resolver: EntityResolver = None):
+        """
+        Match the Entity nodes of graph plus the resolver aliases of any
+        node in graph. Only the difference to the last sync is applied:
+        nothing is done while graph.revision and the alias count are
+        unchanged, new aliases are added and entities that left the graph
+        are removed.
+        """
+        if resolver is not self._resolver:
+            self.__init__()
+            self._resolver = resolver
+        aliases = resolver.aliases if resolver is not None else {}
+        revision = getattr(graph, "revision", None)
+        graph_changed = (
+            graph is not self._graph or revision is None or revision != self._revision
+        )
+        if not graph_changed and len(aliases) == self._num_aliases:
+            return self
+
+        # The resolver only ever adds aliases
+        new_aliases = list(islice(aliases.items(), self._num_aliases, None))
+        for alias, canonical in new_aliases:
+            self._aliases.setdefault(canonical, []).append(alias)
+        self._num_aliases = len(aliases)
+
+        if graph_changed:
+            entities = graph.nodes_of_type("Entity")
+            values = set(entities)
+            values.update(c for c in self._aliases if c in graph.nodes)
+            for value in self._values - values:
+                self.remove(value)
+            for value in entities:
+                if value not in self._values:
+                    self.add(value, value)
+            for value in values - self._values:
+                for alias in self._aliases.get(value, ()):
+                    self.add(alias, value)
+            self._values = values
+            self._graph = graph
+            self._revision = revision
+        for alias, canonical in new_aliases:
+            if canonical in graph.nodes:
+                self._values.add(canonical)
+                self.add(alias, canonical)
+        return self
+
+
+_WORD = re.compile(r"\w+(?:[-']\w+)*")
+_STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "by", "with", "and",
+    "or", "is", "are", "was", "were", "be", "been", "do", "does", "did", "what",
+    "why", "how", "when", "where", "which", "who", "whom", "whose", "it", "its",
+    "this", "that", "these", "those", "as", "from", "can", "could", "would",
+    "should", "about", "between", "considered", "explain", "describe",
+}
+
+
+def question_ngrams(question: str, max_n: int = 3) -> List[str]:
+    """Word n-grams of the question that neither start nor end with a stopword."""
+    words = _WORD.findall(question)
+    grams = []
+    for n in range(1, max_n + 1):
+        for i in range(len(words) - n + 1):
+            span = words[i:i + n]
+            if span[0].lower() in _STOPWORDS or span[-1].lower() in _STOPWORDS:
+                continue
+            gram = " ".join(span)
+            if gram not in grams:
+                grams.append(gram)
+    return grams
+
+
+class EntityLinker:
+    """
+    Local query -> entity linking without an LLM call.
+
+    All Entity names of the graph are embedded once (same encoder as the
+    chunk index) into a dedicated inner-product FAISS index over unit
+    vectors. A question is split into n-grams, embedded in one batch, and
+    every n-gram whose nearest entity has cosine >= threshold links to it.
+    """
+
+    def __init__(self, embedding_function, threshold: float = 0.75, max_ngram: int = 3):
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.max_ngram = max_ngram
+        self.names: List[str] = []
+        self.index = None
+        self._graph = None
+        self._revision = None
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        vecs = np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+        faiss.normalize_L2(vecs)
+        return vecs
+
+    def _add(self, names: List[str]):
+        if not names:
+            return
+        vecs = self._embed(names)
+        if self.index is None:
+            self.index = faiss.IndexFlatIP(vecs.shape[1])
+        self.index.add(vecs)
+        self.names.extend(names)
+
+    def sync(self, graph):
+        """
+        Embed entities added to graph since the last sync and drop the
+        vectors of removed ones. Nothing is done while graph.revision is
+        unchanged.
+        """
+        revision = getattr(graph, "revision", None)
+        if graph is self._graph and revision is not None and revision == self._revision:
+            return self
+
+        entities = graph.nodes_of_type("Entity")
+        current = set(entities)
+        gone = [i for i, name in enumerate(self.names) if name not in current]
+        if gone:
+            # IndexFlat.remove_ids keeps the order of the remaining vectors
+            self.index.remove_ids(np.asarray(gone, dtype=np.int64))
+            self.names = [name for name in self.names if name in current]
+        known = set(self.names)
+        self._add([e for e in entities if e not in known])
+
+        self._graph = graph
+        self._revision = revision
+        return self
+
+    def link(self, question: str, max_entities: int = 5) -> List[str]:
+        """Graph entities mentioned in the question, best match first."""
+        if self.index is None or self.index.ntotal == 0:
+            return []
+        grams = question_ngrams(question, self.max_ngram)
+        if not grams:
+            return []
+
+        scores, ids = self.index.search(self._embed(grams), 1)
+        best = {}
+        for score, idx in zip(scores[:, 0], ids[:, 0]):
+            if idx >= 0 and score >= self.threshold:
+                name = self.names[idx]
+                best[name] = max(best.get(name, 0.0), float(score))
+        ranked = sorted(best.items(), key=lambda kv: kv[1], reverse=True)
+        return [name for name, _ in ranked[:max_entities]]
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        if self.index is not None:
+            faiss.write_index(self.index, os.path.join(path, "entities.faiss"))
+        with open(os.path.join(path, "entities.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": FORMAT_VERSION, "threshold": self.threshold,
+                       "max_ngram": self.max_ngram, "names": self.names}, f)
+
+    @classmethod
+    def load(cls, path: str, embedding_function):
+        with open(os.path.join(path, "entities.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        check_version("entity index", data.get("version"), (FORMAT_VERSION,))
+        linker = cls(embedding_function, data["threshold"], data["max_ngram"])
+        linker.names = data["names"]
+        index_file = os.path.join(path, "entities.faiss")
+        if os.path.exists(index_file):
+            linker.index = faiss.read_index(index_file)
+        ntotal = linker.index.ntotal if linker.index is not None else 0
+        if ntotal != len(linker.names):
+            raise IndexFormatError(
+                f"Entity index has {ntotal} vectors for {len(linker.names)} names"
+            )
+        return linker
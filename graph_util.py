@@ -1,22 +1,521 @@
+from array import array
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import List, Dict
 import json
 import re
+import time
+
+from cache_util import content_key
+from entity_util import EntityResolver, EntityMatcher, EntityLinker
+from llm_util import deadline as llm_deadline
+from trace_util import span, count, propagate
 
 class GraphStore:
     def __init__(self):
         self.nodes: Dict[str,dict]={}
         self.edges:List[tuple]=[]
         self.chunk_entity_map=defaultdict(list)
+        # adjacency indexes so traversal only touches a node's neighbours
+        self.out_edges: Dict[str,List[tuple]]=defaultdict(list)
+        self.in_edges: Dict[str,List[tuple]]=defaultdict(list)
+        self.relation_index: Dict[str,List[tuple]]=defaultdict(list)
+        # chunk each edge was extracted from (parallel to edges, None = unknown)
+        self.edge_chunks: List[str]=[]
+        # bumped whenever nodes are added or removed (see EntityMatcher.sync)
+        self.revision=0
+
     def add_node(self,node_id:str,node_type:str,**metadata):
         if node_id not in self.nodes:
             self.nodes[node_id]={
                 "type":node_type,
                 **metadata
             }
+            self.revision+=1
 
-    def add_edge(self,source:str,relation:str,target:str):
+    def add_edge(self,source:str,relation:str,target:str,chunk_id:str=None):
         self.edges.append((source,relation,target))
+        self.edge_chunks.append(chunk_id)
+        self._index_edge(source,relation,target)
+
+    def add_entity_chunk(self,entity:str,chunk_id:str):
+        """Append chunk_id to chunk_entity_map[entity]."""
+        self.chunk_entity_map[entity].append(chunk_id)
+
+    def _index_edge(self,source,relation,target):
+        self.out_edges[source].append((relation,target))
+        self.in_edges[target].append((relation,source))
+        self.relation_index[relation].append((source,target))
+
+    def remove_chunks(self,chunk_ids):
+        """
+        Drop chunk nodes, the edges extracted from them and their
+        chunk_entity_map entries. Entities left without any edge are
+        removed too. Returns the removed entity ids.
+        """
+        chunk_ids=set(chunk_ids)
+        touched=set()
+        edges,edge_chunks=[],[]
+        for edge,cid in zip(self.edges,self.edge_chunks):
+            if cid in chunk_ids or edge[0] in chunk_ids:
+                touched.add(edge[0])
+                touched.add(edge[2])
+            else:
+                edges.append(edge)
+                edge_chunks.append(cid)
+        self.edges,self.edge_chunks=edges,edge_chunks
+
+        # rebuild the adjacency indexes from the surviving edges
+        self.out_edges.clear()
+        self.in_edges.clear()
+        self.relation_index.clear()
+        for s,r,o in self.edges:
+            self._index_edge(s,r,o)
+
+        for entity in list(self.chunk_entity_map):
+            kept=[c for c in self.chunk_entity_map[entity] if c not in chunk_ids]
+            if kept:
+                self.chunk_entity_map[entity]=kept
+            else:
+                del self.chunk_entity_map[entity]
+
+        for cid in chunk_ids:
+            self.nodes.pop(cid,None)
+
+        orphans=[
+            n for n in touched
+            if n not in chunk_ids and n not in self.out_edges and n not in self.in_edges
+        ]
+        for n in orphans:
+            self.nodes.pop(n,None)
+            self.chunk_entity_map.pop(n,None)
+        self.revision+=1
+        return orphans
+
+    def document_chunks(self,source:str):
+        """Ids of the chunk nodes that came from the given source file."""
+        return [
+            node_id for node_id,data in self.nodes.items()
+            if data["type"]=="Chunk" and data.get("source")==source
+        ]
+
+    def document_sources(self):
+        return {
+            data.get("source") for data in self.nodes.values()
+            if data["type"]=="Chunk"
+        }
+
+    def nodes_of_type(self,node_type:str):
+        return [n for n,data in self.nodes.items() if data["type"]==node_type]
+
+    def neighbors(self,node_id:str):
+        """Outgoing (relation, target) pairs of a node."""
+        return self.out_edges.get(node_id,[])
+
+    def predecessors(self,node_id:str):
+        """Incoming (relation, source) pairs of a node."""
+        return self.in_edges.get(node_id,[])
+
+    def edges_by_relation(self,relation:str):
+        """(source, target) pairs connected by the given relation."""
+        return self.relation_index.get(relation,[])
+
+
+class _NodeTable:
+    """Read-only node_id -> metadata mapping over CompactGraphStore columns."""
+
+    def __init__(self, store):
+        self._g = store
+
+    def __len__(self):
+        return self._g.num_nodes
+
+    def __contains__(self, node_id):
+        idx = self._g.ids.get(node_id)
+        return idx is not None and self._g.node_type[idx] >= 0
+
+    def __iter__(self):
+        g = self._g
+        for idx, name in enumerate(g.names):
+            if g.node_type[idx] >= 0:
+                yield name
+
+    def __getitem__(self, node_id):
+        idx = self._g.ids.get(node_id)
+        if idx is None or self._g.node_type[idx] < 0:
+            raise KeyError(node_id)
+        return self._g.node_data(idx)
+
+    def get(self, node_id, default=None):
+        try:
+            return self[node_id]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        g = self._g
+        for idx, name in enumerate(g.names):
+            if g.node_type[idx] >= 0:
+                yield name, g.node_data(idx)
+
+    def values(self):
+        for _, data in self.items():
+            yield data
+
+
+class _EdgeTable:
+    """Sequence of (source, relation, target) tuples over the edge arrays."""
+
+    def __init__(self, store):
+        self._g = store
+
+    def __len__(self):
+        return len(self._g.edge_src)
+
+    def _edge(self, e):
+        g = self._g
+        return (g.names[g.edge_src[e]], g.relations[g.edge_rel[e]], g.names[g.edge_dst[e]])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._edge(e) for e in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self._edge(i)
+
+    def __iter__(self):
+        for e in range(len(self)):
+            yield self._edge(e)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+
+class _EdgeChunkTable:
+    def __init__(self, store):
+        self._g = store
+
+    def __len__(self):
+        return len(self._g.edge_chunk)
+
+    def __iter__(self):
+        names = self._g.names
+        for c in self._g.edge_chunk:
+            yield None if c < 0 else names[c]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+
+class _EntityChunkTable:
+    """Read-only chunk_entity_map: entity -> [chunk_id, ...]."""
+
+    def __init__(self, store):
+        self._g = store
+
+    def get(self, entity, default=None):
+        idx = self._g.ids.get(entity)
+        if idx is None or self._g.cem_head[idx] < 0:
+            return default
+        return self._g.entity_chunks(idx)
+
+    def __getitem__(self, entity):
+        value = self.get(entity)
+        if value is None:
+            raise KeyError(entity)
+        return value
+
+    def __contains__(self, entity):
+        return self.get(entity) is not None
+
+    def __len__(self):
+        return len(self._g.cem_keys)
+
+    def __iter__(self):
+        for idx in self._g.cem_keys:
+            yield self._g.names[idx]
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for idx in self._g.cem_keys:
+            yield self._g.names[idx], self._g.entity_chunks(idx)
+
+    def values(self):
+        for _, chunks in self.items():
+            yield chunks
+
+
+class CompactGraphStore:
+    """
+    Array-backed GraphStore for large graphs.
+
+    Node ids are interned to ints. Edges are parallel int32 arrays with the
+    relation as an int8 enum. Adjacency, the relation index and
+    chunk_entity_map are linked lists threaded through int32 "next"
+    arrays, so adding an edge never allocates a Python object. Chunk text
+    lives in one contiguous utf-8 buffer. nodes, edges and chunk_entity_map
+    are read-only views; mutate through add_node / add_edge /
+    add_entity_chunk / remove_chunks as with GraphStore.
+    """
+
+    def __init__(self):
+        self.ids: Dict[str,int] = {}
+        self.names: List[str] = []
+        self.num_nodes = 0
+
+        # ---- per id columns ----
+        self.node_type = array("b")    # index into self.types, -1 = not a node
+        self.source = array("i")       # index into self.sources, -1 = missing
+        self.page = array("i")         # -1 = missing
+        self.text_off = array("q")     # start of the chunk text in self.text
+        self.text_len = array("i")
+        self.out_head = array("i")     # last outgoing edge, -1 = none
+        self.in_head = array("i")
+        self.cem_head = array("i")     # last chunk_entity_map entry
+        self.cem_tail = array("i")
+        self.types: List[str] = []
+        self.sources: List[str] = []
+        self.text = bytearray()
+        self.extra: Dict[int,dict] = {}
+        self.revision = 0              # bumped when nodes are added / removed
+
+        # ---- per edge columns ----
+        self.edge_src = array("i")
+        self.edge_dst = array("i")
+        self.edge_rel = array("b")     # index into self.relations
+        self.edge_chunk = array("i")   # chunk node id, -1 = unknown
+        self.out_next = array("i")
+        self.in_next = array("i")
+        self.rel_next = array("i")
+        self.relations: List[str] = []
+        self.rel_head = array("i")
+
+        # ---- chunk_entity_map entries (linked per entity, insertion order) ----
+        self.cem_chunk = array("i")
+        self.cem_next = array("i")
+        self.cem_keys: List[int] = []
+
+        self.nodes = _NodeTable(self)
+        self.edges = _EdgeTable(self)
+        self.edge_chunks = _EdgeChunkTable(self)
+        self.chunk_entity_map = _EntityChunkTable(self)
+
+    # ------------------------------------------------------------------
+    # interning
+    # ------------------------------------------------------------------
+    def _intern(self, name: str) -> int:
+        idx = self.ids.get(name)
+        if idx is None:
+            idx = self.ids[name] = len(self.names)
+            self.names.append(name)
+            for col in (self.node_type, self.source, self.page, self.out_head,
+                        self.in_head, self.cem_head, self.cem_tail):
+                col.append(-1)
+            self.text_off.append(0)
+            self.text_len.append(0)
+        return idx
+
+    @staticmethod
+    def _code(value, values: List[str]) -> int:
+        try:
+            return values.index(value)
+        except ValueError:
+            values.append(value)
+            return len(values) - 1
+
+    # ------------------------------------------------------------------
+    # GraphStore API
+    # ------------------------------------------------------------------
+    def add_node(self, node_id: str, node_type: str, **metadata):
+        idx = self._intern(node_id)
+        if self.node_type[idx] >= 0:
+            return
+        self.node_type[idx] = self._code(node_type, self.types)
+        self.num_nodes += 1
+        self.revision += 1
+
+        text = metadata.pop("text", None)
+        if text is not None:
+            data = text.encode("utf-8")
+            self.text_off[idx] = len(self.text)
+            self.text_len[idx] = len(data)
+            self.text += data
+        source = metadata.pop("source", None)
+        if source is not None:
+            self.source[idx] = self._code(source, self.sources)
+        page = metadata.pop("page", None)
+        if page is not None:
+            self.page[idx] = page
+        if metadata:
+            self.extra[idx] = metadata
+
+    def add_edge(self, source: str, relation: str, target: str, chunk_id: str = None):
+        s = self._intern(source)
+        o = self._intern(target)
+        r = self._code(relation, self.relations)
+        if r == len(self.rel_head):
+            self.rel_head.append(-1)
+        e = len(self.edge_src)
+
+        self.edge_src.append(s)
+        self.edge_dst.append(o)
+        self.edge_rel.append(r)
+        self.edge_chunk.append(-1 if chunk_id is None else self._intern(chunk_id))
+
+        self.out_next.append(self.out_head[s])
+        self.out_head[s] = e
+        self.in_next.append(self.in_head[o])
+        self.in_head[o] = e
+        self.rel_next.append(self.rel_head[r])
+        self.rel_head[r] = e
+
+    def add_entity_chunk(self, entity: str, chunk_id: str):
+        """Append chunk_id to chunk_entity_map[entity]."""
+        idx = self._intern(entity)
+        c = self._intern(chunk_id)
+        entry = len(self.cem_chunk)
+        self.cem_chunk.append(c)
+        self.cem_next.append(-1)
+        # append at the tail so entity_chunks() keeps insertion order
+        if self.cem_head[idx] < 0:
+            self.cem_head[idx] = entry
+            self.cem_keys.append(idx)
+        else:
+            self.cem_next[self.cem_tail[idx]] = entry
+        self.cem_tail[idx] = entry
+
+    def node_data(self, idx: int) -> dict:
+        data = {"type": self.types[self.node_type[idx]]}
+        if self.types[self.node_type[idx]] == "Chunk" or self.text_len[idx]:
+            start = self.text_off[idx]
+            data["text"] = self.text[start:start + self.text_len[idx]].decode("utf-8")
+        if self.source[idx] >= 0:
+            data["source"] = self.sources[self.source[idx]]
+        if self.page[idx] >= 0:
+            data["page"] = self.page[idx]
+        data.update(self.extra.get(idx, {}))
+        return data
+
+    def entity_chunks(self, idx: int) -> List[str]:
+        chunks = []
+        entry = self.cem_head[idx]
+        while entry >= 0:
+            chunks.append(self.names[self.cem_chunk[entry]])
+            entry = self.cem_next[entry]
+        return chunks
+
+    def _walk(self, head, nxt, idx):
+        # linked lists are newest-first; reverse for insertion order
+        edge_ids = []
+        e = head[idx]
+        while e >= 0:
+            edge_ids.append(e)
+            e = nxt[e]
+        edge_ids.reverse()
+        return edge_ids
+
+    def neighbors(self, node_id: str):
+        """Outgoing (relation, target) pairs of a node."""
+        idx = self.ids.get(node_id)
+        if idx is None:
+            return []
+        return [
+            (self.relations[self.edge_rel[e]], self.names[self.edge_dst[e]])
+            for e in self._walk(self.out_head, self.out_next, idx)
+        ]
+
+    def predecessors(self, node_id: str):
+        """Incoming (relation, source) pairs of a node."""
+        idx = self.ids.get(node_id)
+        if idx is None:
+            return []
+        return [
+            (self.relations[self.edge_rel[e]], self.names[self.edge_src[e]])
+            for e in self._walk(self.in_head, self.in_next, idx)
+        ]
+
+    def edges_by_relation(self, relation: str):
+        """(source, target) pairs connected by the given relation."""
+        if relation not in self.relations:
+            return []
+        r = self.relations.index(relation)
+        return [
+            (self.names[self.edge_src[e]], self.names[self.edge_dst[e]])
+            for e in self._walk(self.rel_head, self.rel_next, r)
+        ]
+
+    def document_chunks(self, source: str):
+        """Ids of the chunk nodes that came from the given source file."""
+        if source not in self.sources:
+            return []
+        code = self.sources.index(source)
+        return [self.names[i] for i, s in enumerate(self.source) if s == code]
+
+    def document_sources(self):
+        return set(self.sources)
+
+    def nodes_of_type(self, node_type: str):
+        if node_type not in self.types:
+            return []
+        code = self.types.index(node_type)
+        return [self.names[i] for i, t in enumerate(self.node_type) if t == code]
+
+    def remove_chunks(self, chunk_ids):
+        """
+        Same contract as GraphStore.remove_chunks. The arrays are rebuilt
+        from the surviving nodes and edges, so this is O(graph size).
+        """
+        chunk_ids = set(chunk_ids)
+        removed = {self.ids[c] for c in chunk_ids if c in self.ids}
+        touched = set()
+        degree = defaultdict(int)
+        kept_edges = []
+        for e in range(len(self.edge_src)):
+            s, o = self.edge_src[e], self.edge_dst[e]
+            if self.edge_chunk[e] in removed or s in removed:
+                touched.add(s)
+                touched.add(o)
+            else:
+                kept_edges.append(e)
+                degree[s] += 1
+                degree[o] += 1
+        orphans = {n for n in touched if n not in removed and not degree[n]}
+        orphan_names = [self.names[n] for n in orphans]
+        dropped = removed | orphans
+
+        fresh = CompactGraphStore()
+        for idx, name in enumerate(self.names):
+            if self.node_type[idx] >= 0 and idx not in dropped:
+                data = self.node_data(idx)
+                fresh.add_node(name, data.pop("type"), **data)
+        for e in kept_edges:
+            c = self.edge_chunk[e]
+            fresh.add_edge(
+                self.names[self.edge_src[e]],
+                self.relations[self.edge_rel[e]],
+                self.names[self.edge_dst[e]],
+                chunk_id=None if c < 0 else self.names[c],
+            )
+        for idx in self.cem_keys:
+            if idx in orphans:
+                continue
+            entity = self.names[idx]
+            for cid in self.entity_chunks(idx):
+                if cid not in chunk_ids:
+                    fresh.add_entity_chunk(entity, cid)
+
+        revision = self.revision
+        self.__dict__.update(fresh.__dict__)
+        self.revision = revision + 1
+        for view in (self.nodes, self.edges, self.edge_chunks, self.chunk_entity_map):
+            view._g = self
+        return orphan_names
 
 
 ALLOWED_RELATIONS={
@@ -53,83 +552,614 @@ Text:
 {chunk}
 """
 
+# Several chunks per request; {chunks} is a sequence of
+# <chunk id="c1">...</chunk> blocks (see GraphExtractor.extract_packed)
+PACKED_EXTRACTION_PROMPT = """
+You are an information extraction system.
+
+Extract factual knowledge from each text below. Every text is wrapped in
+<chunk id="..."> tags.
+
+Rules:
+- Only extract facts explicitly stated in that text.
+- Use short, canonical names.
+- Do NOT guess or infer, and do NOT mix facts between texts.
+- Use ONLY the allowed relations.
+- Output VALID JSON ONLY (no explanation, no markdown).
+
+Allowed relations:
+MENTIONS, DESCRIBES, USED_FOR, RELATED_TO, PART_OF, IMPROVES, CAUSES
+
+Output format: one key per chunk id, [] if a text states no facts:
+{{
+  "c1": [{{"subject": "...", "relation": "...", "object": "..."}}],
+  "c2": []
+}}
+
+Texts:
+{chunks}
+"""
+
+_ARRAY_START = re.compile(r"\[\s*[{\]]")
+_DECODER = json.JSONDecoder()
+
+# Output schemas for servers that constrain decoding (ChatModel.generate_json)
+TRIPLE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "subject": {"type": "string"},
+        "relation": {"type": "string", "enum": sorted(ALLOWED_RELATIONS)},
+        "object": {"type": "string"},
+    },
+    "required": ["subject", "relation", "object"],
+}
+TRIPLES_SCHEMA = {"type": "array", "items": TRIPLE_SCHEMA}
+
+
+def packed_schema(tags):
+    """Schema of a PACKED_EXTRACTION_PROMPT answer for the given chunk ids."""
+    return {
+        "type": "object",
+        "properties": {tag: TRIPLES_SCHEMA for tag in tags},
+        "required": list(tags),
+    }
+
+
+def strip_reasoning(text: str) -> str:
+    """
+    The part of text after its reasoning: after the last </think> (the
+    opening tag may be part of the chat template), and nothing of an
+    unfinished <think> section.
+    """
+    end = text.rfind("</think>")
+    if end >= 0:
+        text = text[end + len("</think>"):]
+    return text.split("<think>", 1)[0]
+
+
+def _skip(text, pos, chars=" \t\r\n"):
+    while pos < len(text) and text[pos] in chars:
+        pos += 1
+    return pos
+
+
+def parse_json_array(text: str):
+    """
+    Items of the first JSON array of objects in text, decoded one at a time.
+
+    Tolerates prose or a markdown fence around the array, malformed items
+    (skipped up to the next object) and an array cut off by max_tokens
+    (its complete items are kept). Returns (items, complete); complete is
+    False when the array is missing, truncated or had an item skipped.
+    """
+    match = _ARRAY_START.search(text)
+    if match is None:
+        return [], False
+    items, complete, pos = [], True, match.start() + 1
+    while True:
+        pos = _skip(text, pos, " \t\r\n,")
+        if pos >= len(text):
+            return items, False
+        if text[pos] == "]":
+            return items, complete
+        try:
+            item, pos = _DECODER.raw_decode(text, pos)
+            items.append(item)
+        except ValueError:
+            complete = False
+            pos = text.find("{", pos + 1)
+            if pos < 0:
+                return items, False
+
+
+def parse_json_object(text: str):
+    """
+    Entries of the first JSON object in text, decoded one value at a time,
+    so an object cut off by max_tokens keeps its complete entries.
+    Returns (entries, complete).
+    """
+    start = text.find("{")
+    if start < 0:
+        return {}, False
+    entries, pos = {}, start + 1
+    try:
+        while True:
+            pos = _skip(text, pos, " \t\r\n,")
+            if text[pos:pos + 1] == "}":
+                return entries, True
+            key, pos = _DECODER.raw_decode(text, pos)
+            pos = _skip(text, pos)
+            if not isinstance(key, str) or text[pos:pos + 1] != ":":
+                return entries, False
+            entries[key], pos = _DECODER.raw_decode(text, _skip(text, pos + 1))
+    except ValueError:
+        return entries, False
+
+
+def valid_triples(triples):
+    """
+    Triples with a non-empty string subject / object and an allowed relation
+    (case and spacing normalized: "used for" -> USED_FOR). The others are
+    dropped and counted as extraction_rejected_triples.
+    """
+    if not isinstance(triples, list):
+        return []
+    valid = []
+    for t in triples:
+        if not isinstance(t, dict):
+            continue
+        subject, relation, obj = t.get("subject"), t.get("relation"), t.get("object")
+        if isinstance(relation, str):
+            relation = "_".join(relation.upper().split())
+        if (
+            isinstance(subject, str) and subject.strip()
+            and isinstance(obj, str) and obj.strip()
+            and relation in ALLOWED_RELATIONS
+        ):
+            valid.append({**t, "subject": subject.strip(), "relation": relation,
+                          "object": obj.strip()})
+    if len(valid) < len(triples):
+        count("extraction_rejected_triples", len(triples) - len(valid))
+    return valid
+
+
+def token_counter(llm):
+    """Token count function from llm.tokenizer (~4 chars per token without one)."""
+    try:
+        tokenizer = getattr(llm, "tokenizer", None)
+    except Exception:
+        # e.g. ChatModel cannot download its tokenizer
+        tokenizer = None
+    if tokenizer is None:
+        return lambda text: len(text) // 4 + 1
+
+    # The same chunks are counted again for every question that retrieves them
+    @lru_cache(maxsize=8192)
+    def count_tokens(text):
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    return count_tokens
+
+
+def pack_chunks(chunk_texts, count_tokens, max_tokens: int, max_chunks: int = 16):
+    """
+    Group consecutive chunk indexes so that each group's packed prompt
+    stays within max_tokens (a chunk over budget gets a group of its own).
+    """
+    overhead = count_tokens(PACKED_EXTRACTION_PROMPT)
+    groups, group, used = [], [], overhead
+    for i, text in enumerate(chunk_texts):
+        # tag + newline around each chunk
+        cost = count_tokens(text) + 12
+        if group and (used + cost > max_tokens or len(group) >= max_chunks):
+            groups.append(group)
+            group, used = [], overhead
+        group.append(i)
+        used += cost
+    if group:
+        groups.append(group)
+    return groups
+
 
 class GraphExtractor:
-    def __init__(self, llm):
+    def __init__(self, llm, cache=None, max_new_tokens: int = 250):
+        """
+        llm: object with generate(prompt) -> str (e.g. model.ChatModel);
+             its generate_json(prompt, schema=...) is used when it has one
+        cache: optional cache_util.ExtractionCache; results are keyed by the
+               chunk text, the prompt template that produced them
+               (EXTRACTION_PROMPT or PACKED_EXTRACTION_PROMPT) and the
+               llm's model id
+        max_new_tokens: completion budget of a one-chunk request
+        """
         self.llm = llm
+        self.cache = cache
+        self.max_new_tokens = max_new_tokens
+        self.model_id = getattr(llm, "model_id", type(llm).__name__)
+
+    def cache_key(self, chunk_text: str, prompt: str = EXTRACTION_PROMPT) -> str:
+        return content_key(chunk_text, prompt, self.model_id)
 
     def extract_triples(self, chunk_text: str):
-    
+        with span("extract_triples", chunk_chars=len(chunk_text)) as attrs:
+            triples = self._extract_triples(chunk_text, attrs)
+            attrs["triples"] = len(triples)
+            return triples
+
+    def _complete(self, prompt: str, schema: dict, max_new_tokens: int):
+        # JSON-only mode skips the reasoning trace (and its tokens)
+        generate_json = getattr(self.llm, "generate_json", None)
+        if generate_json is not None:
+            return generate_json(prompt, schema=schema, max_new_tokens=max_new_tokens)
+        return self.llm.generate(prompt, max_new_tokens=max_new_tokens)
+
+    def _extract_triples(self, chunk_text: str, attrs: dict):
+        if self.cache is not None:
+            key = self.cache_key(chunk_text)
+            cached = self.cache.get(key)
+            attrs["cache_hit"] = cached is not None
+            count("extraction_cache_hits" if cached is not None else "extraction_cache_misses")
+            if cached is not None:
+                return cached
+
         prompt = EXTRACTION_PROMPT.format(chunk=chunk_text)
-        response = self.llm.generate(prompt)
-        print("RAM LLM OUTPUT:\n ",response)
+        response = self._complete(prompt, TRIPLES_SCHEMA, self.max_new_tokens)
+        attrs["prompt_chars"] = len(prompt)
+        attrs["completion_chars"] = len(response)
 
-        # 🔥 Extract JSON array from LLM output
-        match = re.search(r"\[\s*{.*?}\s*\]", response, re.DOTALL)
+        items, complete = parse_json_array(strip_reasoning(response))
+        valid = valid_triples(items)
+        attrs["rejected"] = len(items) - len(valid)
 
-        if not match:
-            return []
+        if not complete:
+            # Truncated or partly malformed: keep what was recovered, but
+            # leave it uncached so a later build can do better
+            attrs["partial"] = True
+            count("extraction_partial_responses")
+        elif self.cache is not None:
+            self.cache.put(key, valid)
+        return valid
+
+    def cached_triples(self, chunk_texts):
+        """
+        {index: triples} for the chunks whose triples are cached, from a
+        one-chunk request or else from a packed one.
+        """
+        if self.cache is None:
+            return {}
+        keys = [
+            (self.cache_key(text), self.cache_key(text, PACKED_EXTRACTION_PROMPT))
+            for text in chunk_texts
+        ]
+        found = self.cache.get_many(list({k for pair in keys for k in pair}))
+        results = {}
+        for i, pair in enumerate(keys):
+            key = next((k for k in pair if k in found), None)
+            if key is not None:
+                results[i] = found[key]
+        count("extraction_cache_hits", len(results))
+        count("extraction_cache_misses", len(keys) - len(results))
+        return results
+
+    def extract_packed(self, chunk_texts, tokens_per_chunk: int = 250):
+        """
+        Triples for several chunks from one request. Chunk i is sent as
+        <chunk id="c{i+1}"> and the model answers with a JSON object keyed
+        by those ids.
 
+        Returns a list aligned with chunk_texts. An entry is None when the
+        answer for that chunk is missing or malformed (all None if the
+        response is not a JSON object), so the caller can fall back to
+        extract_triples for it.
+        """
+        tags = [f"c{i + 1}" for i in range(len(chunk_texts))]
+        blocks = "\n".join(
+            f'<chunk id="{tag}">\n{text}\n</chunk>' for tag, text in zip(tags, chunk_texts)
+        )
+        prompt = PACKED_EXTRACTION_PROMPT.format(chunks=blocks)
+
+        with span("extract_packed", chunks=len(chunk_texts), prompt_chars=len(prompt)) as attrs:
+            response = self._complete(
+                prompt, packed_schema(tags), tokens_per_chunk * len(chunk_texts)
+            )
+            attrs["completion_chars"] = len(response)
+
+            results = [None] * len(chunk_texts)
+            # A truncated answer keeps the chunks it completed
+            parsed, complete = parse_json_object(strip_reasoning(response))
+            if not parsed:
+                attrs["malformed"] = True
+                return results
+            if not complete:
+                attrs["partial"] = True
+                count("extraction_partial_responses")
+
+            # Keys the prompt did not ask for are ignored, never guessed
+            for i, tag in enumerate(tags):
+                if isinstance(parsed.get(tag), list):
+                    results[i] = valid_triples(parsed[tag])
+            attrs["missing"] = results.count(None)
+
+        if self.cache is not None:
+            self.cache.put_many({
+                self.cache_key(text, PACKED_EXTRACTION_PROMPT): triples
+                for text, triples in zip(chunk_texts, results)
+                if triples is not None
+            })
+        return results
+
+
+def _call_with_timeout(fn, arg, timeout):
+    if timeout is None:
+        return fn(arg)
+
+    def call(arg):
+        # LLMClient retries stop at the same deadline, so an abandoned call
+        # does not keep sending requests next to the caller's new attempt
+        with llm_deadline(timeout):
+            return fn(arg)
+
+    # A blocked thread cannot be killed, but we stop waiting for it
+    pool = ThreadPoolExecutor(max_workers=1)
+    try:
+        return pool.submit(propagate(call), arg).result(timeout=timeout)
+    finally:
+        pool.shutdown(wait=False)
+
+
+def _should_retry(error) -> bool:
+    # llm_util.LLMError: permanent (e.g. a 401), or LLMClient already
+    # retried it; retrying here as well would multiply the requests
+    return getattr(error, "retryable", True) and not getattr(error, "exhausted", False)
+
+
+def extract_with_retry(
+    extractor: GraphExtractor,
+    chunk_text: str,
+    max_retries: int = 2,
+    backoff: float = 1.0,
+    timeout: float = None
+):
+    """
+    extract_triples with a per-call timeout and exponential backoff.
+    LLMErrors that are not retryable (e.g. a 401) or that LLMClient has
+    already retried (exhausted) are not retried again. Returns [] once all
+    attempts have failed, counted as extraction_failures.
+    """
+    for attempt in range(max_retries + 1):
         try:
-            triples = json.loads(match.group())
+            return _call_with_timeout(extractor.extract_triples, chunk_text, timeout)
+        except Exception as e:
+            if attempt == max_retries or not _should_retry(e):
+                print(f"⚠️ Extraction failed after {attempt+1} attempts: {e!r}")
+                count("extraction_failures")
+                return []
+            count("extraction_retries")
+            time.sleep(backoff * (2 ** attempt))
 
-            valid = []
-            for t in triples:
-                if (
-                    isinstance(t, dict)
-                    and "subject" in t
-                    and "relation" in t
-                    and "object" in t
-                    and t["relation"] in ALLOWED_RELATIONS
-                ):
-                    valid.append(t)
 
-            return valid
+def extract_packed_with_retry(
+    extractor: GraphExtractor,
+    chunk_texts,
+    max_retries: int = 2,
+    backoff: float = 1.0,
+    timeout: float = None
+):
+    """
+    extract_packed with retries on errors. Chunks the packed answer did
+    not cover (or a malformed answer) fall back to one extract_with_retry
+    request each. Returns one triples list per chunk.
+    """
+    results = [None] * len(chunk_texts)
+    if len(chunk_texts) > 1:
+        for attempt in range(max_retries + 1):
+            try:
+                results = _call_with_timeout(extractor.extract_packed, chunk_texts, timeout)
+                break
+            except Exception as e:
+                if attempt == max_retries or not _should_retry(e):
+                    print(f"⚠️ Packed extraction failed after {attempt+1} attempts: {e!r}")
+                    break
+                count("extraction_retries")
+                time.sleep(backoff * (2 ** attempt))
+
+    fallback = [i for i, triples in enumerate(results) if triples is None]
+    if len(chunk_texts) > 1:
+        count("packed_fallback_chunks", len(fallback))
+    for i in fallback:
+        results[i] = extract_with_retry(
+            extractor, chunk_texts[i], max_retries=max_retries, backoff=backoff, timeout=timeout
+        )
+    return results
 
-        except Exception:
-            return []
 
+def chunk_id_for(chunk, occurrence: int = 0) -> str:
+    """Stable id derived from a chunk's source, page and text."""
+    key = content_key(
+        str(chunk.metadata.get("source")),
+        str(chunk.metadata.get("page")),
+        chunk.page_content,
+        str(occurrence)
+    )
+    return f"chunk_{key[:16]}"
 
-def build_graph_from_chunks(chunks, extractor: GraphExtractor) -> GraphStore:
+
+def assign_chunk_ids(chunks):
+    """
+    Store a stable id in chunk.metadata["chunk_id"] (kept if already set).
+    Identical chunks on the same page are told apart by occurrence count.
+    Returns the ids in chunk order.
+    """
+    seen = defaultdict(int)
+    ids = []
+    for chunk in chunks:
+        if "chunk_id" not in chunk.metadata:
+            base = chunk_id_for(chunk)
+            chunk.metadata["chunk_id"] = chunk_id_for(chunk, seen[base])
+            seen[base] += 1
+        ids.append(chunk.metadata["chunk_id"])
+    return ids
+
+
+def build_graph_from_chunks(
+    chunks,
+    extractor: GraphExtractor,
+    max_workers: int = 1,
+    max_retries: int = 2,
+    backoff: float = 1.0,
+    timeout: float = None,
+    graph: GraphStore = None,
+    resolver: EntityResolver = None,
+    pack_tokens: int = None,
+    max_chunks_per_prompt: int = 16
+) -> GraphStore:
     """
     chunks: output of load_and_split_pdfs()
     extractor: GraphExtractor instance
+    max_workers: number of concurrent LLM calls (1 = sequential)
+    max_retries / backoff / timeout: see extract_with_retry()
+    graph: empty store to fill, e.g. CompactGraphStore() for large corpora
+           (defaults to a new GraphStore)
+    resolver: optional EntityResolver used to canonicalize entity names
+    pack_tokens / max_chunks_per_prompt: see add_documents_to_graph()
+
+    Results are applied in chunk order, so chunk ids and chunk_entity_map
+    are the same whatever order the LLM calls finish in.
     """
 
-    graph = GraphStore()
+    if graph is None:
+        graph = GraphStore()
+    add_documents_to_graph(
+        graph,
+        chunks,
+        extractor,
+        max_workers=max_workers,
+        max_retries=max_retries,
+        backoff=backoff,
+        timeout=timeout,
+        resolver=resolver,
+        pack_tokens=pack_tokens,
+        max_chunks_per_prompt=max_chunks_per_prompt
+    )
+    return graph
+
+
+def add_documents_to_graph(
+    graph: GraphStore,
+    chunks,
+    extractor: GraphExtractor,
+    max_workers: int = 1,
+    max_retries: int = 2,
+    backoff: float = 1.0,
+    timeout: float = None,
+    resolver: EntityResolver = None,
+    pack_tokens: int = None,
+    max_chunks_per_prompt: int = 16
+):
+    """
+    Extract and add new chunks to an existing graph. Chunks whose id is
+    already in the graph are skipped. Returns the ids of the added chunks.
+    resolver: optional EntityResolver; subjects / objects are replaced by
+              their canonical names before they reach the graph
+    pack_tokens: if set, uncached chunks are packed several per request
+                 (PACKED_EXTRACTION_PROMPT) up to this many prompt tokens,
+                 counted with extractor.llm.tokenizer
+    max_chunks_per_prompt: upper bound on chunks per packed request
+    """
+    chunk_ids = assign_chunk_ids(chunks)
+    pending = [
+        (cid, chunk) for cid, chunk in zip(chunk_ids, chunks)
+        if cid not in graph.nodes
+    ]
+    texts = [chunk.page_content for _, chunk in pending]
 
-    for idx, chunk in enumerate(chunks):
-        print(f"Processing chunk {idx+1}/{len(chunks)}")
-        chunk_id = f"chunk_{idx}"
+    def extract(text):
+        return extract_with_retry(
+            extractor,
+            text,
+            max_retries=max_retries,
+            backoff=backoff,
+            timeout=timeout
+        )
 
-        # Add chunk node
-        graph.add_node(
-            node_id=chunk_id,
-            node_type="Chunk",
-            text=chunk.page_content,
-            source=chunk.metadata.get("source"),
-            page=chunk.metadata.get("page")
+    def extract_group(group):
+        return extract_packed_with_retry(
+            extractor,
+            [texts[i] for i in group],
+            max_retries=max_retries,
+            backoff=backoff,
+            timeout=timeout
         )
 
-        # Extract triples from chunk
-        triples = extractor.extract_triples(chunk.page_content)
-        for triple in triples:
-            subj = triple["subject"]
-            rel = triple["relation"]
-            obj = triple["object"]
+    if pack_tokens:
+        cached = extractor.cached_triples(texts)
+        misses = [i for i in range(len(texts)) if i not in cached]
+        groups = [
+            [misses[j] for j in group]
+            for group in pack_chunks(
+                [texts[i] for i in misses],
+                token_counter(extractor.llm),
+                pack_tokens,
+                max_chunks_per_prompt
+            )
+        ]
+        print(f"Packed {len(misses)} chunks into {len(groups)} requests")
+        work, items = extract_group, groups
+    else:
+        work, items = extract, texts
 
-            # Add entity & concept nodes
-            graph.add_node(subj, "Entity")
-            graph.add_node(obj, "Concept")
+    if max_workers > 1:
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        # map() yields in submission order, not completion order
+        results = pool.map(propagate(work), items)
+    else:
+        pool = None
+        results = (work(item) for item in items)
 
-            # Add edges
-            graph.add_edge(subj, rel, obj)
-            graph.add_edge(chunk_id, "MENTIONS", subj)
+    if pack_tokens:
+        results = _in_chunk_order(len(texts), cached, zip(groups, results))
 
-            # Map entity to chunk
-            graph.chunk_entity_map[subj].append(chunk_id)
+    try:
+        for idx, ((chunk_id, chunk), triples) in enumerate(zip(pending, results)):
+            print(f"Processing chunk {idx+1}/{len(pending)}")
+            if resolver is not None:
+                triples = resolver.canonicalize_triples(triples)
+            add_chunk_to_graph(graph, chunk_id, chunk, triples)
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
-    return graph
+    if extractor.cache is not None:
+        stats = extractor.cache.stats()
+        print(f"Extraction cache: {stats['hits']} hits, {stats['misses']} misses")
+
+    return [chunk_id for chunk_id, _ in pending]
+
+
+def _in_chunk_order(n, done, group_results):
+    # Groups cover the uncached chunks in increasing order, so pulling the
+    # next group whenever chunk i is not known yet keeps chunk order
+    done = dict(done)
+    for i in range(n):
+        while i not in done:
+            group, triples = next(group_results)
+            done.update(zip(group, triples))
+        yield done.pop(i)
+
+
+def remove_document_from_graph(graph: GraphStore, source: str):
+    """Remove every chunk of a source file; returns the removed chunk ids."""
+    chunk_ids = graph.document_chunks(source)
+    graph.remove_chunks(chunk_ids)
+    return chunk_ids
+
+
+def add_chunk_to_graph(graph: GraphStore, chunk_id: str, chunk, triples):
+    """Add a chunk node plus its extracted triples to the graph."""
+    # Add chunk node
+    graph.add_node(
+        node_id=chunk_id,
+        node_type="Chunk",
+        text=chunk.page_content,
+        source=chunk.metadata.get("source"),
+        page=chunk.metadata.get("page")
+    )
+
+    for triple in triples:
+        subj = triple["subject"]
+        rel = triple["relation"]
+        obj = triple["object"]
+
+        # Add entity & concept nodes
+        graph.add_node(subj, "Entity")
+        graph.add_node(obj, "Concept")
+
+        # Add edges
+        graph.add_edge(subj, rel, obj, chunk_id=chunk_id)
+        graph.add_edge(chunk_id, "MENTIONS", subj, chunk_id=chunk_id)
+
+        # Map entity to chunk
+        graph.add_entity_chunk(subj, chunk_id)
 
 
 #now this is addition for fidning the entity to start from ,from the query asked by the user
@@ -151,30 +1181,93 @@ Question:
 """
 
 class QueryEntityExtractor:
-    def __init__(self, llm):
+    def __init__(
+        self,
+        llm=None,
+        resolver: EntityResolver = None,
+        linker: EntityLinker = None,
+        llm_fallback: bool = True
+    ):
+        """
+        resolver: the EntityResolver used while building the graph; query
+                  entities are mapped to the same canonical names
+        linker: optional EntityLinker. When set, entities are first linked
+                locally (exact alias matches + embedding nearest neighbours)
+                and the LLM is only asked if nothing was found
+        llm_fallback: set False to never call the LLM when a linker is set
+        """
         self.llm = llm
+        self.resolver = resolver
+        self.linker = linker
+        self.llm_fallback = llm_fallback
+        self._matcher = EntityMatcher()
+
+    def matcher(self, graph) -> EntityMatcher:
+        """Aho-Corasick matcher over graph entities, kept in sync with graph."""
+        return self._matcher.sync(graph, self.resolver)
+
+    def _canonical(self, entities):
+        if self.resolver is None:
+            return entities
+        resolved = []
+        for e in entities:
+            c = self.resolver.lookup(e) or e
+            if c not in resolved:
+                resolved.append(c)
+        return resolved
+
+    def link_locally(self, question: str, graph):
+        """Exact matches first, then embedding matches; no LLM call."""
+        entities = [
+            entity for entity in self.matcher(graph).find(question)
+            if entity in graph.nodes
+        ]
+        for entity in self.linker.sync(graph).link(question):
+            if entity not in entities:
+                entities.append(entity)
+        return entities
 
     def extract(self, question: str, graph=None):
+        with span("query_entities") as attrs:
+            entities = self._extract(question, graph, attrs)
+            attrs["entities"] = len(entities)
+            return entities
+
+    def _extract(self, question: str, graph, attrs: dict):
+        # 0️⃣ Local entity linking (saves an LLM round trip per question)
+        if self.linker is not None and graph:
+            attrs["method"] = "local"
+            entities = self.link_locally(question, graph)
+            if entities or not self.llm_fallback or self.llm is None:
+                return entities
+
         prompt = QUERY_ENTITY_PROMPT.format(question=question)
-        response = self.llm.generate(prompt)
+        try:
+            response = self.llm.generate(prompt)
+        except Exception as e:
+            # The matcher below still answers without the LLM
+            print(f"⚠️ Query entity extraction failed: {e!r}")
+            count("query_entity_llm_errors")
+            response = ""
+        attrs["prompt_chars"] = len(prompt)
+        attrs["completion_chars"] = len(response)
 
         # 1️⃣ Try strict JSON
         try:
             entities = json.loads(response)
             if isinstance(entities, list) and entities:
-                return entities
+                attrs["method"] = "llm"
+                return self._canonical(entities)
         except Exception:
             pass
 
-        # 2️⃣ FALLBACK: string match from graph entities
+        # 2️⃣ FALLBACK: match graph entities / aliases in the question
         if graph:
-            lowered_q = question.lower()
-            matched = []
-            for node, data in graph.nodes.items():
-                if data["type"] == "Entity" and node.lower() in lowered_q:
-                    matched.append(node)
-
-            return matched
+            attrs["method"] = "matcher"
+            return [
+                entity for entity in self.matcher(graph).find(question)
+                if entity in graph.nodes
+            ]
 
         return []
 
@@ -184,30 +1277,197 @@ class GraphRetriever:
     def __init__(self, graph):
         self.graph = graph
 
-    def retrieve_chunks(self, query_entities, max_hops=1):
-        relevant_chunks = set()
-        visited_entities = set(query_entities)
-
-        for entity in query_entities:
-            # Direct chunk grounding
-            for chunk_id in self.graph.chunk_entity_map.get(entity, []):
-                relevant_chunks.add(chunk_id)
-
-            # Graph traversal (1-hop)
-            for s, r, o in self.graph.edges:
-                if s == entity and o not in visited_entities:
-                    visited_entities.add(o)
-                    for chunk_id in self.graph.chunk_entity_map.get(s, []):
-                        relevant_chunks.add(chunk_id)
-
-        return list(relevant_chunks)
-def build_context_from_chunks(graph, chunk_ids, max_chars=2000):
-    context = ""
+    def retrieve_scored_chunks(
+        self,
+        query_entities,
+        max_hops=1,
+        max_fanout=50,
+        max_visited=500,
+        hop_decay=0.5
+    ):
+        """
+        Bounded BFS from the query entities.
+
+        An entity reached at hop h adds hop_decay**h to the score of every
+        chunk it is grounded in. Returns (chunk_id, score) pairs, best first.
+        """
+        with span("graph_retrieval", entities=len(query_entities)) as attrs:
+            scores = {}
+            visited = set()
+            frontier = []
+            for entity in query_entities:
+                if entity not in visited and len(visited) < max_visited:
+                    visited.add(entity)
+                    frontier.append(entity)
+
+            for hop in range(max_hops + 1):
+                weight = hop_decay ** hop
+                next_frontier = []
+
+                for entity in frontier:
+                    # Direct chunk grounding
+                    for chunk_id in self.graph.chunk_entity_map.get(entity, []):
+                        scores[chunk_id] = scores.get(chunk_id, 0.0) + weight
+
+                    if hop == max_hops:
+                        continue
+
+                    # Expand to (at most max_fanout) unseen neighbours
+                    expanded = 0
+                    for r, o in self.graph.neighbors(entity):
+                        if expanded >= max_fanout or len(visited) >= max_visited:
+                            break
+                        if o in visited:
+                            continue
+                        visited.add(o)
+                        next_frontier.append(o)
+                        expanded += 1
+
+                if not next_frontier:
+                    break
+                frontier = next_frontier
+
+            # dicts keep discovery order, so equal scores stay deterministic
+            ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+            attrs["visited"] = len(visited)
+            attrs["chunks"] = len(ranked)
+            return ranked
+
+    def retrieve_chunks(self, query_entities, max_hops=1, **kwargs):
+        return [
+            chunk_id
+            for chunk_id, _ in self.retrieve_scored_chunks(
+                query_entities, max_hops=max_hops, **kwargs
+            )
+        ]
+
+
+def graph_chunks(graph, chunk_ids):
+    """Chunk dicts (chunk_id, text, source, page) for pack_context."""
+    chunks = []
     for cid in chunk_ids:
-        text = graph.nodes[cid]["text"]
-        context += text + "\n"
+        data = graph.nodes[cid]
+        chunks.append({
+            "chunk_id": cid,
+            "text": data["text"],
+            "source": data.get("source"),
+            "page": data.get("page"),
+        })
+    return chunks
+
+
+def document_chunks(docs):
+    """
+    Chunk dicts for LangChain documents, or (document, score) pairs as
+    returned by FaissDb.similarity_search_with_score.
+    """
+    chunks = []
+    for doc in docs:
+        score = None
+        if isinstance(doc, tuple):
+            doc, score = doc
+        chunks.append({
+            "chunk_id": doc.metadata.get("chunk_id"),
+            "text": doc.page_content,
+            "source": doc.metadata.get("source"),
+            "page": doc.metadata.get("page"),
+            "score": score,
+        })
+    return chunks
+
+
+def _overlap(head: str, tail: str, min_overlap: int) -> int:
+    """Length of the longest suffix of head that is a prefix of tail."""
+    probe = tail[:min_overlap]
+    if len(probe) < min_overlap:
+        return 0
+    pos = head.find(probe)
+    while pos >= 0:
+        if tail.startswith(head[pos:]):
+            return len(head) - pos
+        pos = head.find(probe, pos + 1)
+    return 0
+
 
-        if len(context) >= max_chars:
-            break
+def strip_overlap(text: str, neighbours, min_overlap: int = 20) -> str:
+    """
+    text without the spans it shares with neighbouring chunks of the same
+    page: the splitter repeats the end of one chunk at the start of the next.
+    Returns "" when text is contained in a neighbour.
+    """
+    for other in neighbours:
+        if text in other:
+            return ""
+        cut = _overlap(other, text, min_overlap)
+        if cut:
+            text = text[cut:].lstrip()
+        cut = _overlap(text, other, min_overlap)
+        if cut:
+            text = text[:-cut].rstrip()
+    return text
+
+
+def pack_context(chunks, max_tokens: int, count_tokens=None, min_overlap: int = 20):
+    """
+    Fill a token budget with chunks ranked best first (dicts with text and
+    optionally chunk_id / source / page, see graph_chunks / document_chunks).
+
+    Duplicates (same chunk_id, or same source, page and text) are dropped,
+    text overlapping an already packed chunk of the same source / page is
+    cut off, and a chunk that would overflow max_tokens is skipped so a
+    smaller, lower-ranked one can still use the remaining budget.
+
+    count_tokens: e.g. token_counter(llm); characters are counted without it.
+    Returns (context, packed chunk dicts with the text actually used).
+    """
+    count_tokens = count_tokens or len
+    packed = []
+    seen = set()
+    by_page = defaultdict(list)
+    used = 0
+    duplicates = trimmed = 0
+
+    for chunk in chunks:
+        text = chunk["text"].strip()
+        page = (chunk.get("source"), chunk.get("page"))
+        keys = {(page, text)}
+        if chunk.get("chunk_id"):
+            keys.add(chunk["chunk_id"])
+        if keys & seen:
+            duplicates += 1
+            continue
+        seen |= keys
+
+        kept = strip_overlap(text, by_page[page], min_overlap)
+        if not kept:
+            duplicates += 1
+            continue
+        # +1 for the newline joining chunks
+        cost = count_tokens(kept) + 1
+        if used + cost > max_tokens:
+            continue
+        if len(kept) < len(text):
+            trimmed += len(text) - len(kept)
+        # overlap is checked against the full text, as the splitter produced it
+        by_page[page].append(text)
+        packed.append({**chunk, "text": kept, "tokens": cost})
+        used += cost
+
+    count("context_duplicate_chunks", duplicates)
+    count("context_overlap_chars", trimmed)
+    return "\n".join(c["text"] for c in packed), packed
 
-    return context.strip()
+
+def build_context_from_chunks(graph, chunk_ids, max_chars=2000, max_tokens=None, count_tokens=None):
+    """
+    chunk_ids: chunk ids ranked best first (as returned by retrieve_chunks).
+    Packed with pack_context into max_tokens tokens when given, otherwise
+    into max_chars characters.
+    """
+    with span("build_context") as attrs:
+        if max_tokens is None:
+            max_tokens, count_tokens = max_chars, None
+        context, packed = pack_context(graph_chunks(graph, chunk_ids), max_tokens, count_tokens)
+        attrs["chunks"] = len(packed)
+        attrs["tokens" if count_tokens else "chars"] = sum(c["tokens"] for c in packed)
+        return context
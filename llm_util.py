@@ -0,0 +1,407 @@
+"""
+Resilient transport for ChatModel.
+
+    client = LLMClient(InferenceClient(model=model_id, token=token), rate=4, burst=8)
+    client = LLMClient(HTTPChatClient("http://localhost:8080"), rate=20)
+    client.chat_completion(model=model_id, messages=[...], max_tokens=300)
+
+LLMClient wraps any object with the InferenceClient methods ChatModel uses
+(chat_completion, text_generation) and adds:
+
+    rate limiting   one token bucket shared by every thread; a 429 with
+                    Retry-After holds back every thread, with or without
+                    a bucket
+    retries         exponential backoff with jitter for retryable failures
+                    (408 / 429 / 5xx, timeouts, connection errors)
+    LLMError        status, retryable and retry_after instead of whatever
+                    the transport raised
+    coalescing      identical non-streaming requests in flight share one call
+    async           achat_completion / atext_generation on a bounded pool
+
+HTTPChatClient talks to an OpenAI-compatible server (/v1/chat/completions;
+TGI, vLLM, llama.cpp or a local stub) and TGI's /generate over a pool of
+keep-alive connections, using only the standard library.
+"""
+import asyncio
+import contextvars
+import http.client
+import json
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from urllib.parse import urlsplit
+
+from trace_util import count, record
+
+RETRYABLE_STATUS = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+
+_deadline = contextvars.ContextVar("llm_deadline", default=None)
+
+
+class LLMError(Exception):
+    """
+    A failed LLM request.
+
+    status: HTTP status (None for connection errors / timeouts)
+    retryable: whether the same request may succeed later
+    retry_after: seconds the server asked us to wait, if it said so
+    exhausted: LLMClient already spent its retries (or its deadline) on
+               it; callers should not add retries of their own
+    """
+
+    def __init__(self, message: str, status: int = None, retryable: bool = False,
+                 retry_after: float = None, exhausted: bool = False):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.exhausted = exhausted
+
+    def __reduce__(self):
+        return (type(self), (str(self), self.status, self.retryable, self.retry_after,
+                             self.exhausted))
+
+
+@contextmanager
+def deadline(seconds: float = None):
+    """
+    LLMClient requests made inside the block (same thread / context) start
+    no new attempt or backoff once seconds have passed, so a caller that
+    stops waiting does not leave retries running in the background.
+    """
+    if seconds is None:
+        yield
+        return
+    end = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(end if outer is None else min(outer, end))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _retry_after(headers):
+    value = headers.get("Retry-After") if headers is not None else None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def as_llm_error(exc: Exception) -> LLMError:
+    """
+    Classify any transport exception. HTTP errors of requests /
+    huggingface_hub carry the response (status code, Retry-After);
+    timeouts and connection errors (all OSError) are retryable.
+    """
+    if isinstance(exc, LLMError):
+        return exc
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return LLMError(
+            f"HTTP {status}: {exc}",
+            status=status,
+            retryable=status in RETRYABLE_STATUS,
+            retry_after=_retry_after(getattr(response, "headers", None)),
+        )
+    retryable = isinstance(exc, (OSError, TimeoutError))
+    return LLMError(f"{type(exc).__name__}: {exc}", retryable=retryable)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: rate tokens per second, at most capacity
+    stored. Callers reserve a token and sleep until it is theirs, so
+    waiting callers are served roughly in arrival order.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, tokens: float = 1) -> float:
+        """Take tokens; returns the seconds to wait before using them."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, tokens: float = 1) -> float:
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens: float = 1) -> float:
+        wait = self.reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """Hand out nothing for the next seconds (e.g. after a 429)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class HTTPChatClient:
+    """
+    Minimal InferenceClient stand-in for self-hosted endpoints.
+
+    base_url: server root, e.g. "http://localhost:8080" (a trailing /v1 is
+              accepted). At most pool_size connections are open at once;
+              idle ones are kept alive and reused.
+    """
+
+    def __init__(self, base_url: str, token: str = None, pool_size: int = 16,
+                 timeout: float = 120):
+        parts = urlsplit(base_url)
+        self._connection_class = (
+            http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        )
+        self._host = parts.hostname
+        self._port = parts.port
+        self._prefix = parts.path.rstrip("/")
+        if self._prefix.endswith("/v1"):
+            self._prefix = self._prefix[:-3]
+        self.token = token
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _connection(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connection_class(self._host, self._port, timeout=self.timeout)
+
+    def _release(self, conn, reuse: bool):
+        if reuse:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def _post(self, path: str, payload: dict):
+        """(connection, response) for a 2xx answer; raises LLMError otherwise."""
+        body = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        conn = self._connection()
+        try:
+            conn.request("POST", self._prefix + path, body=body, headers=headers)
+            response = conn.getresponse()
+        except Exception:
+            # The server may have closed an idle keep-alive connection
+            self._release(conn, reuse=False)
+            raise
+        if response.status >= 300:
+            text = response.read().decode("utf-8", "replace")
+            self._release(conn, reuse=not response.will_close)
+            raise LLMError(
+                f"HTTP {response.status}: {text[:200]}",
+                status=response.status,
+                retryable=response.status in RETRYABLE_STATUS,
+                retry_after=_retry_after(response.headers),
+            )
+        return conn, response
+
+    def _json(self, path, payload):
+        conn, response = self._post(path, payload)
+        try:
+            data = json.loads(response.read())
+        except Exception:
+            self._release(conn, reuse=False)
+            raise
+        self._release(conn, reuse=not response.will_close)
+        return data
+
+    def _events(self, conn, response):
+        # Server-sent events: one "data: {...}" line per chunk
+        done = False
+        try:
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                yield json.loads(data)
+            response.read()
+            done = True
+        finally:
+            # A stream abandoned half way leaves unread data: drop the connection
+            self._release(conn, reuse=done and not response.will_close)
+
+    def chat_completion(self, messages, model: str = None, max_tokens: int = None,
+                        stream: bool = False, **params):
+        payload = {"model": model or "tgi", "messages": messages, "stream": stream, **params}
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+        if not stream:
+            return self._json("/v1/chat/completions", payload)
+        # The request is sent now, so connection / status errors surface here
+        return self._events(*self._post("/v1/chat/completions", payload))
+
+    def text_generation(self, prompt: str, max_new_tokens: int = None, stream: bool = False,
+                        **params):
+        parameters = dict(params)
+        if max_new_tokens is not None:
+            parameters["max_new_tokens"] = max_new_tokens
+        payload = {"inputs": prompt, "parameters": parameters}
+        if not stream:
+            data = self._json("/generate", payload)
+            if isinstance(data, list):
+                data = data[0]
+            return data.get("generated_text", "")
+        events = self._events(*self._post("/generate_stream", payload))
+        return (event.get("token", {}).get("text", "") for event in events)
+
+
+class LLMClient:
+    """
+    Rate limiting, retries, structured errors and coalescing around a
+    transport (InferenceClient, HTTPChatClient or a test fake).
+
+    rate / burst: requests per second and bucket size (None = unlimited)
+    max_retries: extra attempts for retryable errors
+    backoff / max_backoff: base and cap of the exponential backoff (s)
+    coalesce: share identical non-streaming requests that are in flight
+    max_workers: threads behind the async methods
+    """
+
+    def __init__(
+        self,
+        transport,
+        rate: float = None,
+        burst: float = None,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        coalesce: bool = True,
+        max_workers: int = 16,
+    ):
+        self.transport = transport
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.coalesce = coalesce
+        self.max_workers = max_workers
+        self.requests = 0
+        self.retries = 0
+        self.coalesced = 0
+        self._not_before = 0.0  # monotonic time before which nothing is sent
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _send(self, method, args, kwargs):
+        end = _deadline.get()
+        for attempt in range(self.max_retries + 1):
+            if end is not None and time.monotonic() >= end:
+                count("llm_errors")
+                raise LLMError("Deadline passed before the request was sent",
+                               retryable=True, exhausted=True)
+            waited = max(0.0, self._not_before - time.monotonic())
+            if waited:
+                time.sleep(waited)
+            if self.bucket is not None:
+                waited += self.bucket.acquire()
+            if waited:
+                record("llm_rate_limit_wait", waited)
+            with self._lock:
+                self.requests += 1
+            try:
+                return getattr(self.transport, method)(*args, **kwargs)
+            except Exception as e:
+                error = as_llm_error(e)
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * (0.5 + random.random() / 2)
+                if error.retry_after is not None:
+                    delay = max(delay, error.retry_after)
+                out_of_time = end is not None and time.monotonic() + delay >= end
+                if not error.retryable or attempt == self.max_retries or out_of_time:
+                    error.exhausted = error.retryable
+                    count("llm_errors")
+                    raise error from e
+                if error.retry_after is not None:
+                    # Every thread waits, not only the one that got the 429
+                    with self._lock:
+                        self._not_before = max(
+                            self._not_before, time.monotonic() + error.retry_after
+                        )
+                with self._lock:
+                    self.retries += 1
+                count("llm_retries")
+                time.sleep(delay)
+
+    def _call(self, method, *args, **kwargs):
+        if kwargs.get("stream") or not self.coalesce:
+            return self._send(method, args, kwargs)
+
+        key = json.dumps([method, args, kwargs], sort_keys=True, default=str)
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            count("llm_coalesced")
+            return future.result()
+        try:
+            result = self._send(method, args, kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def chat_completion(self, *args, **kwargs):
+        return self._call("chat_completion", *args, **kwargs)
+
+    def text_generation(self, *args, **kwargs):
+        return self._call("text_generation", *args, **kwargs)
+
+    async def run_async(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the client's bounded thread pool."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="llm")
+        loop = asyncio.get_running_loop()
+        # A copy of the caller's context: the active Trace and any
+        # deadline() apply inside fn as they do for a synchronous call
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self._executor, partial(context.run, fn, *args, **kwargs)
+        )
+
+    async def achat_completion(self, *args, **kwargs):
+        return await self.run_async(self.chat_completion, *args, **kwargs)
+
+    async def atext_generation(self, *args, **kwargs):
+        return await self.run_async(self.text_generation, *args, **kwargs)
+
+    def stats(self):
+        return {"requests": self.requests, "retries": self.retries, "coalesced": self.coalesced}
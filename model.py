@@ -1,85 +1,418 @@
 
 from multiprocessing import context
 import os
+import time
 import traceback
 from dotenv import load_dotenv
 from huggingface_hub import InferenceClient
 from transformers import AutoTokenizer
+from llm_util import LLMClient, LLMError, HTTPChatClient
+from trace_util import record, span
 
 env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
 load_dotenv(dotenv_path=env_path)
 
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+THINK_MODES = ("show", "collapse", "hide")
+THINK_PLACEHOLDER = "💭 *Reasoning…*\n\n"
+
+# generate_json: the output is parsed, never read, so no reasoning or prose
+JSON_SYSTEM_PROMPT = (
+    "Reply with the requested JSON only. Do not think step by step, do not "
+    "write a <think> section, markdown or any explanation."
+)
+
+
+class ThinkFilter:
+    """
+    Incremental filter for <think>...</think> sections in streamed text.
+
+    mode: "show" passes everything through, "hide" drops the reasoning and
+          "collapse" replaces each reasoning section with THINK_PLACEHOLDER.
+    Tags split across chunks are handled by holding back a possible tag
+    prefix until the next chunk. The reasoning and answer text are kept
+    separately in self.reasoning / self.answer.
+    """
+
+    def __init__(self, mode: str = "collapse"):
+        if mode not in THINK_MODES:
+            raise ValueError(f"Unknown think mode {mode!r}, expected one of {THINK_MODES}")
+        self.mode = mode
+        self.reasoning = ""
+        self.answer = ""
+        self.in_think = False
+        self._buf = ""
+
+    def _emit(self, text, out):
+        if not text:
+            return
+        if self.in_think:
+            self.reasoning += text
+            if self.mode == "show":
+                out.append(text)
+            return
+        if self.mode == "show":
+            out.append(text)
+        if not self.answer:
+            # Drop the blank lines that follow </think>
+            text = text.lstrip()
+        self.answer += text
+        if self.mode != "show" and text:
+            out.append(text)
+
+    def feed(self, text: str) -> str:
+        """Visible part of the next chunk."""
+        self._buf += text
+        out = []
+        while True:
+            tag = THINK_CLOSE if self.in_think else THINK_OPEN
+            i = self._buf.find(tag)
+            if i < 0:
+                break
+            self._emit(self._buf[:i], out)
+            self._buf = self._buf[i + len(tag):]
+            if self.mode == "show":
+                out.append(tag)
+            elif self.mode == "collapse" and not self.in_think:
+                out.append(THINK_PLACEHOLDER)
+            self.in_think = not self.in_think
+
+        # Hold back a trailing partial tag ("<thi")
+        keep = 0
+        for n in range(min(len(tag) - 1, len(self._buf)), 0, -1):
+            if tag.startswith(self._buf[-n:]):
+                keep = n
+                break
+        self._emit(self._buf[:len(self._buf) - keep], out)
+        self._buf = self._buf[len(self._buf) - keep:]
+        return "".join(out)
+
+    def flush(self) -> str:
+        out = []
+        self._emit(self._buf, out)
+        self._buf = ""
+        return "".join(out)
+
+
+class ChatStream:
+    """
+    Iterator over the visible text pieces of one streamed answer.
+
+    Timings (seconds since the request was sent) are filled in while it is
+    consumed: ttft (first token from the model, reasoning included),
+    first_answer (first visible answer text) and elapsed (stream done).
+    """
+
+    def __init__(self, pieces, think: str = "collapse", prompt_chars: int = 0):
+        self._pieces = pieces
+        self.prompt_chars = prompt_chars
+        self.filter = ThinkFilter(think)
+        self.ttft = None
+        self.first_answer = None
+        self.elapsed = None
+        self.chunks = 0
+        self.error = None
+        self._separate_reasoning = False
+
+    @property
+    def answer(self) -> str:
+        return self.filter.answer
+
+    @property
+    def reasoning(self) -> str:
+        return self.filter.reasoning
+
+    def __iter__(self):
+        start = time.perf_counter()
+        try:
+            for piece, is_reasoning in self._pieces:
+                if not piece:
+                    continue
+                if self.ttft is None:
+                    self.ttft = time.perf_counter() - start
+                self.chunks += 1
+                if is_reasoning != self._separate_reasoning:
+                    # Provider sends reasoning in its own field: wrap it in tags
+                    piece = (THINK_OPEN if is_reasoning else THINK_CLOSE) + piece
+                    self._separate_reasoning = is_reasoning
+                visible = self.filter.feed(piece)
+                if visible:
+                    if self.first_answer is None and self.filter.answer:
+                        self.first_answer = time.perf_counter() - start
+                    yield visible
+            if self._separate_reasoning:
+                self.filter.feed(THINK_CLOSE)
+            visible = self.filter.flush()
+            if visible:
+                yield visible
+        except Exception as e:
+            traceback.print_exc()
+            self.error = str(e)
+            yield f"⚠️ Error: {str(e)}"
+        finally:
+            self.elapsed = time.perf_counter() - start
+            record(
+                "llm_stream",
+                self.elapsed,
+                prompt_chars=self.prompt_chars,
+                completion_chars=len(self.reasoning) + len(self.answer),
+                chunks=self.chunks,
+                ttft=self.ttft,
+                error=self.error,
+            )
+
 
 class ChatModel:
     """
     Chat model wrapper using Hugging Face Inference API instead of Google Gemini.
+
+    Requests go through an LLMClient (llm_util): rate limited, retried on
+    429 / 5xx / connection errors, identical concurrent prompts coalesced.
+    Failures raise LLMError instead of returning an error string.
     """
 
-    def __init__(self, model_id: str = "deepseek-ai/DeepSeek-R1"):
+    def __init__(
+        self,
+        model_id: str = "deepseek-ai/DeepSeek-R1",
+        client=None,
+        base_url: str = None,
+        rate_limit: float = None,
+        burst: float = None,
+        max_retries: int = 3,
+        pool_size: int = 16,
+        structured_output: str = None,
+    ):
         """
         Initialize the Hugging Face inference client.
         Args:
             model_id: Hugging Face model name that supports text generation/chat.
                       (You can replace this with any other text-generation model)
+            client: optional stand-in for InferenceClient (e.g. a local fake
+                    for tests); no HF token is needed then
+            base_url: OpenAI-compatible server to use instead of the HF API
+                      (default: LLM_BASE_URL from .env), e.g. a local TGI
+                      or vLLM server, or a stub server for tests
+            rate_limit / burst: requests per second and burst size (None = off)
+            max_retries: retries of retryable errors per request
+            pool_size: keep-alive connections to base_url
+            structured_output: how generate_json asks the server to follow a
+                      JSON schema: "tgi" (grammar), "openai" (json_schema) or
+                      None for the prompt alone (default: LLM_STRUCTURED_OUTPUT)
         """
         self.hf_token = os.getenv("HF_API_TOKEN")
-        print("HF_API_TOKEN found?", bool(self.hf_token))
+        self.model_id = model_id
+        self._tokenizer = None
+        self.structured_output = structured_output or os.getenv("LLM_STRUCTURED_OUTPUT")
+        base_url = base_url or os.getenv("LLM_BASE_URL")
 
-        if not self.hf_token:
-            raise ValueError(
-                "❌ HF_API_TOKEN not found in .env. Please add HF_API_TOKEN=your_token"
-            )
+        if client is None and base_url:
+            client = HTTPChatClient(base_url, token=self.hf_token, pool_size=pool_size)
 
-       
-        self.client = InferenceClient(model=model_id, token=self.hf_token)
-        self.tokenizer = AutoTokenizer.from_pretrained(model_id, token=self.hf_token)
-        self.model_id = model_id
+        if client is None:
+            print("HF_API_TOKEN found?", bool(self.hf_token))
 
+            if not self.hf_token:
+                raise ValueError(
+                    "❌ HF_API_TOKEN not found in .env. Please add HF_API_TOKEN=your_token"
+                )
 
+            client = InferenceClient(model=model_id, token=self.hf_token)
+            self._tokenizer = AutoTokenizer.from_pretrained(model_id, token=self.hf_token)
 
-    def generate(self, question: str, context: str = None, max_new_tokens: int = 250):
-        if not question or question.strip() == "":
-            return "❌ Please provide a valid question."
+        if not isinstance(client, LLMClient):
+            client = LLMClient(
+                client,
+                rate=rate_limit,
+                burst=burst,
+                max_retries=max_retries,
+                max_workers=pool_size,
+            )
+        self.client = client
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_id, token=self.hf_token)
+        return self._tokenizer
 
+    def _is_chat(self):
+        return "deepseek" in self.model_id.lower() or "chat" in self.model_id.lower()
 
+    @staticmethod
+    def build_prompt(question: str, context: str = None):
         if context:
-            prompt = f"""You are a helpful AI assistant.
+            return f"""You are a helpful AI assistant.
             Use the following context to answer the question.
 
             Context: {context}
             Question: {question}"""
-        else:
-            prompt = f"""You are a helpful AI assistant.
+        return f"""You are a helpful AI assistant.
             Question: {question}"""
 
+    def generate(self, question: str, context: str = None, max_new_tokens: int = 250):
+        """Answer text; raises LLMError when the request fails."""
+        with span("llm_generate") as attrs:
+            answer = self._generate(question, context, max_new_tokens)
+            attrs["prompt_chars"] = len(self.build_prompt(question, context))
+            attrs["completion_chars"] = len(answer)
+            return answer
+
+    def _generate(self, question: str, context: str, max_new_tokens: int):
+        if not question or question.strip() == "":
+            return "❌ Please provide a valid question."
+
+        prompt = self.build_prompt(question, context)
+
+        if self._is_chat():
+            response = self.client.chat_completion(
+                model=self.model_id,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_new_tokens,
+            )
+
+            content = self._content(response)
+
+        else:
+            content = self.client.text_generation(
+                prompt,
+                max_new_tokens=max_new_tokens,
+                stream=False
+            )
+
+        if not content or not content.strip():
+            raise LLMError("Empty response", retryable=True)
+        return content.strip()
+
+    @staticmethod
+    def _content(response):
         try:
-           
-            if "deepseek" in self.model_id.lower() or "chat" in self.model_id.lower():
+            if hasattr(response, "choices"):
+                return response.choices[0].message["content"]
+            if isinstance(response, dict):
+                return response["choices"][0]["message"]["content"]
+            return str(response)
+        except (KeyError, IndexError, TypeError) as e:
+            raise LLMError(f"Malformed chat completion: {e!r}") from e
+
+    def _response_format(self, schema):
+        if schema is None or not self.structured_output:
+            return None
+        if self.structured_output == "openai":
+            return {"type": "json_schema", "json_schema": {"name": "output", "schema": schema}}
+        return {"type": "json", "value": schema}
+
+    def generate_json(self, prompt: str, schema: dict = None, max_new_tokens: int = 250):
+        """
+        Completion of a JSON-only prompt (graph extraction). The prompt is
+        sent as is, without the answer template, after a system message that
+        rules out reasoning and prose. With structured_output set, the server
+        is also asked to constrain decoding to schema. Raises LLMError.
+        """
+        with span("llm_generate_json") as attrs:
+            content = self._generate_json(prompt, schema, max_new_tokens, attrs)
+            attrs["prompt_chars"] = len(prompt)
+            attrs["completion_chars"] = len(content)
+            return content
+
+    def _generate_json(self, prompt: str, schema: dict, max_new_tokens: int, attrs: dict):
+        if not self._is_chat():
+            content = self.client.text_generation(
+                prompt,
+                max_new_tokens=max_new_tokens,
+                stream=False
+            )
+        else:
+            params = {}
+            response_format = self._response_format(schema)
+            if response_format is not None:
+                params["response_format"] = response_format
+                attrs["constrained"] = True
+            messages = [
+                {"role": "system", "content": JSON_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ]
+            try:
                 response = self.client.chat_completion(
                     model=self.model_id,
-                    messages=[{"role": "user", "content": prompt}],
+                    messages=messages,
                     max_tokens=max_new_tokens,
+                    **params
                 )
-            
-                if hasattr(response, "choices"):
-                    return response.choices[0].message["content"].strip()
-                elif isinstance(response, dict):
-                    return response["choices"][0]["message"]["content"].strip()
-                else:
-                    return str(response)
-
-         
-            else:
-                response = self.client.text_generation(
-                    prompt,
-                    max_new_tokens=max_new_tokens,
-                    stream=False
+            except LLMError as e:
+                if not params or e.status not in (400, 422):
+                    raise
+                # The endpoint has no constrained decoding: prompt alone from now on
+                print(f"⚠️ {self.structured_output} structured output rejected, disabling it: {e}")
+                self.structured_output = None
+                attrs["constrained"] = False
+                response = self.client.chat_completion(
+                    model=self.model_id,
+                    messages=messages,
+                    max_tokens=max_new_tokens,
                 )
-                return response.strip() if response else "⚠️ No response."
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            return f"⚠️ Error: {str(e)}"
+            content = self._content(response)
+
+        if not content or not content.strip():
+            raise LLMError("Empty response", retryable=True)
+        return content.strip()
+
+    async def agenerate(self, question: str, context: str = None, max_new_tokens: int = 250):
+        """
+        generate() for asyncio code. Runs on the client's bounded thread pool,
+        so many answers can be awaited concurrently with asyncio.gather().
+        """
+        return await self.client.run_async(self.generate, question, context, max_new_tokens)
+
+    def _stream_pieces(self, prompt: str, max_new_tokens: int):
+        # (text, is_reasoning) pairs as they arrive from the endpoint
+        if self._is_chat():
+            for chunk in self.client.chat_completion(
+                model=self.model_id,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_new_tokens,
+                stream=True,
+            ):
+                if isinstance(chunk, dict):
+                    choices = chunk.get("choices") or [{}]
+                    delta = choices[0].get("delta") or {}
+                    content = delta.get("content")
+                    reasoning = delta.get("reasoning_content")
+                else:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    content = getattr(delta, "content", None)
+                    reasoning = getattr(delta, "reasoning_content", None)
+                if reasoning:
+                    yield reasoning, True
+                if content:
+                    yield content, False
+        else:
+            for token in self.client.text_generation(
+                prompt,
+                max_new_tokens=max_new_tokens,
+                stream=True
+            ):
+                yield token, False
+
+    def stream(
+        self,
+        question: str,
+        context: str = None,
+        max_new_tokens: int = 250,
+        think: str = "collapse"
+    ) -> ChatStream:
+        """
+        Streaming variant of generate(). Iterate the returned ChatStream (or
+        pass it to st.write_stream) to get the answer text as it arrives.
+        Args:
+            think: "show", "collapse" or "hide" the <think> reasoning
+        """
+        if not question or question.strip() == "":
+            return ChatStream(iter([("❌ Please provide a valid question.", False)]), think)
+        prompt = self.build_prompt(question, context)
+        return ChatStream(self._stream_pieces(prompt, max_new_tokens), think, len(prompt))
 
 
 
@@ -0,0 +1,569 @@
+"""
+Save / load a built GraphStore in a compact, memory-mappable layout.
+
+Layout of a saved graph directory:
+
+    meta.json                  vocabularies (relations, node types, sources), counts
+                               and a build_id that changes on every save
+    names.bin / names_off.npy  interned node ids (utf-8 blob + offsets), insertion order
+    name_order.npy             permutation that sorts the names (for id -> index lookup)
+    node_type.npy              int8 index into meta["types"], -1 = only seen on edges
+    text.bin / text_off.npy    chunk text, one contiguous blob
+    source.npy / page.npy      int32 chunk metadata, -1 = missing
+    edge_src / edge_rel / edge_dst.npy   parallel edge arrays (insertion order)
+    edge_chunk.npy             chunk each edge was extracted from, -1 = unknown
+    out_indptr / out_eids.npy  CSR adjacency over outgoing edges
+    in_indptr / in_eids.npy    CSR adjacency over incoming edges
+    cem_keys / cem_indptr / cem_vals.npy   chunk_entity_map as CSR
+
+Every array is opened with mmap_mode="r", so loading is O(1) in the size of
+the graph and several processes share the same pages through the OS cache.
+
+Each save goes to a fresh version directory, path/v<time>-<id>/, and the
+CURRENT file in path names the version to load (see write_version). Files
+another process has mapped are therefore never truncated or rewritten.
+"""
+import bisect
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+FORMAT_VERSION = 2
+
+POINTER_FILE = "CURRENT"
+# Versions kept on disk: the current one and the one readers may still be opening
+KEEP_VERSIONS = 2
+
+
+class IndexFormatError(ValueError):
+    """A saved index part has a format version this code cannot read."""
+
+
+def check_version(what: str, version, readable):
+    """Raise IndexFormatError unless version is one of readable."""
+    if version not in readable:
+        raise IndexFormatError(f"Unsupported {what} format version {version!r}")
+
+
+@contextmanager
+def write_version(path: str):
+    """
+    Write a new version of the directory path.
+
+        with write_version("index/faiss") as target:
+            faiss.write_index(index, os.path.join(target, "index.faiss"))
+
+    Yields a fresh, empty path/<version> directory. When the block succeeds,
+    path/CURRENT is switched to it with os.replace (atomic) and older
+    versions beyond KEEP_VERSIONS are deleted where the OS allows it.
+    """
+    os.makedirs(path, exist_ok=True)
+    version = f"v{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+    target = os.path.join(path, version)
+    os.makedirs(target)
+    try:
+        yield target
+    except BaseException:
+        shutil.rmtree(target, ignore_errors=True)
+        raise
+
+    pointer = os.path.join(path, POINTER_FILE)
+    tmp = f"{pointer}.{version}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp, pointer)
+
+    versions = sorted(
+        name for name in os.listdir(path)
+        if name.startswith("v") and name != version
+        and os.path.isdir(os.path.join(path, name))
+    )
+    # Mapped files stay readable after unlinking on POSIX; Windows refuses,
+    # and the version is retried on the next save
+    for name in versions[:max(0, len(versions) - (KEEP_VERSIONS - 1))]:
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def current_version(path: str) -> str:
+    """
+    Directory holding the current version of path: the one CURRENT names,
+    or path itself when it was saved before versioning.
+    """
+    try:
+        with open(os.path.join(path, POINTER_FILE), encoding="utf-8") as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return path
+    return os.path.join(path, version)
+
+# Node metadata stored in dedicated columns; anything else goes to meta.json
+_COLUMN_FIELDS = {"type", "text", "source", "page"}
+
+
+def _write_strings(path_bin, path_off, strings):
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    with open(path_bin, "wb") as f:
+        pos = 0
+        for i, s in enumerate(strings):
+            data = s.encode("utf-8")
+            f.write(data)
+            pos += len(data)
+            offsets[i + 1] = pos
+    np.save(path_off, offsets)
+
+
+def _csr(keys, n):
+    """Group edge ids by key; returns (indptr, ids) with ids stable per key."""
+    order = np.argsort(keys, kind="stable").astype(np.int32)
+    counts = np.bincount(keys, minlength=n)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, order
+
+
+def save_graph(graph, path: str):
+    """
+    Write graph (GraphStore or MappedGraphStore) as a new version of
+    directory path; a graph loaded from path stays valid.
+    """
+    with write_version(path) as target:
+        _write_graph(graph, target)
+
+
+def _write_graph(graph, path: str):
+    # ---- intern node ids (nodes first, then edge / map-only ids) ----
+    index = {}
+    names = []
+
+    def intern(name):
+        idx = index.get(name)
+        if idx is None:
+            idx = index[name] = len(names)
+            names.append(name)
+        return idx
+
+    for node_id in graph.nodes:
+        intern(node_id)
+    num_nodes = len(names)
+
+    edges = list(graph.edges)
+    edge_chunks = list(graph.edge_chunks)
+    for s, r, o in edges:
+        intern(s)
+        intern(o)
+    for cid in edge_chunks:
+        if cid is not None:
+            intern(cid)
+    for entity, chunk_ids in graph.chunk_entity_map.items():
+        intern(entity)
+        for cid in chunk_ids:
+            intern(cid)
+    n = len(names)
+
+    # ---- node columns ----
+    types, sources, relations = [], [], []
+    type_idx, source_idx, relation_idx = {}, {}, {}
+
+    def vocab(value, table, values):
+        if value not in table:
+            table[value] = len(values)
+            values.append(value)
+        return table[value]
+
+    node_type = np.full(n, -1, dtype=np.int8)
+    source = np.full(n, -1, dtype=np.int32)
+    page = np.full(n, -1, dtype=np.int32)
+    texts = [""] * n
+    extra = {}
+
+    for i, (node_id, data) in enumerate(graph.nodes.items()):
+        node_type[i] = vocab(data["type"], type_idx, types)
+        if data.get("text") is not None:
+            texts[i] = data["text"]
+        if data.get("source") is not None:
+            source[i] = vocab(data["source"], source_idx, sources)
+        if data.get("page") is not None:
+            page[i] = data["page"]
+        rest = {k: v for k, v in data.items() if k not in _COLUMN_FIELDS}
+        if rest:
+            extra[str(i)] = rest
+
+    # ---- edges + CSR adjacency ----
+    edge_src = np.fromiter((index[s] for s, _, _ in edges), dtype=np.int32, count=len(edges))
+    edge_dst = np.fromiter((index[o] for _, _, o in edges), dtype=np.int32, count=len(edges))
+    edge_rel = [vocab(r, relation_idx, relations) for _, r, _ in edges]
+    if len(relations) > 127 or len(types) > 127:
+        raise ValueError("Too many distinct relations / node types for int8 columns")
+    edge_rel = np.array(edge_rel, dtype=np.int8)
+    edge_chunk = np.array(
+        [-1 if cid is None else index[cid] for cid in edge_chunks], dtype=np.int32
+    )
+    out_indptr, out_eids = _csr(edge_src, n)
+    in_indptr, in_eids = _csr(edge_dst, n)
+
+    # ---- chunk_entity_map as CSR over its keys ----
+    cem_keys = np.array([index[e] for e in graph.chunk_entity_map], dtype=np.int32)
+    cem_indptr = np.zeros(len(cem_keys) + 1, dtype=np.int64)
+    vals = []
+    for i, chunk_ids in enumerate(graph.chunk_entity_map.values()):
+        vals.extend(index[c] for c in chunk_ids)
+        cem_indptr[i + 1] = len(vals)
+    cem_vals = np.array(vals, dtype=np.int32)
+
+    _write_strings(os.path.join(path, "names.bin"), os.path.join(path, "names_off.npy"), names)
+    _write_strings(os.path.join(path, "text.bin"), os.path.join(path, "text_off.npy"), texts)
+
+    arrays = {
+        "name_order": np.array(sorted(range(n), key=names.__getitem__), dtype=np.int32),
+        "node_type": node_type,
+        "source": source,
+        "page": page,
+        "edge_src": edge_src,
+        "edge_rel": edge_rel,
+        "edge_dst": edge_dst,
+        "edge_chunk": edge_chunk,
+        "out_indptr": out_indptr,
+        "out_eids": out_eids,
+        "in_indptr": in_indptr,
+        "in_eids": in_eids,
+        "cem_keys": cem_keys,
+        "cem_indptr": cem_indptr,
+        "cem_vals": cem_vals,
+    }
+    for name, arr in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), arr)
+
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "version": FORMAT_VERSION,
+            "build_id": uuid.uuid4().hex,
+            "num_ids": n,
+            "num_nodes": num_nodes,
+            "num_edges": len(edges),
+            "types": types,
+            "relations": relations,
+            "sources": sources,
+            "extra": extra,
+        }, f)
+
+
+class _StringTable:
+    """Read-only sequence of strings backed by a utf-8 blob + offsets."""
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._off = offsets
+
+    def __len__(self):
+        return len(self._off) - 1
+
+    def __getitem__(self, i):
+        return bytes(self._blob[self._off[i]:self._off[i + 1]]).decode("utf-8")
+
+
+class _SortedView:
+    def __init__(self, names, order):
+        self._names = names
+        self._order = order
+
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, i):
+        return self._names[int(self._order[i])]
+
+
+class _NodeView:
+    """Mapping node_id -> metadata dict, decoded lazily."""
+
+    def __init__(self, store):
+        self._g = store
+
+    def __len__(self):
+        return self._g.num_nodes
+
+    def __contains__(self, node_id):
+        idx = self._g.lookup(node_id)
+        return idx is not None and idx < self._g.num_nodes
+
+    def __iter__(self):
+        for i in range(self._g.num_nodes):
+            yield self._g.names[i]
+
+    def __getitem__(self, node_id):
+        idx = self._g.lookup(node_id)
+        if idx is None or idx >= self._g.num_nodes:
+            raise KeyError(node_id)
+        return self._g.node_data(idx)
+
+    def get(self, node_id, default=None):
+        try:
+            return self[node_id]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for i in range(self._g.num_nodes):
+            yield self._g.names[i], self._g.node_data(i)
+
+    def values(self):
+        for i in range(self._g.num_nodes):
+            yield self._g.node_data(i)
+
+
+class _EdgeView:
+    """Sequence of (source, relation, target) tuples over the edge arrays."""
+
+    def __init__(self, store):
+        self._g = store
+
+    def __len__(self):
+        return len(self._g.edge_src)
+
+    def _edge(self, e):
+        g = self._g
+        return (
+            g.names[int(g.edge_src[e])],
+            g.relations[g.edge_rel[e]],
+            g.names[int(g.edge_dst[e])],
+        )
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._edge(e) for e in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self._edge(i)
+
+    def __iter__(self):
+        for e in range(len(self)):
+            yield self._edge(e)
+
+
+class _EdgeChunkView:
+    """Sequence parallel to edges: chunk id an edge came from, or None."""
+
+    def __init__(self, store):
+        self._g = store
+
+    def __len__(self):
+        return len(self._g.edge_chunk)
+
+    def __iter__(self):
+        names = self._g.names
+        for c in self._g.edge_chunk:
+            yield None if c < 0 else names[int(c)]
+
+
+class _ChunkEntityView:
+    """Read-only chunk_entity_map: entity -> [chunk_id, ...]."""
+
+    def __init__(self, store):
+        self._g = store
+        self._pos = None
+
+    def _positions(self):
+        # entity index -> row in the CSR, built on first use
+        if self._pos is None:
+            self._pos = {int(k): i for i, k in enumerate(self._g.cem_keys)}
+        return self._pos
+
+    def _row(self, i):
+        g = self._g
+        a, b = g.cem_indptr[i], g.cem_indptr[i + 1]
+        return [g.names[int(c)] for c in g.cem_vals[a:b]]
+
+    def get(self, entity, default=None):
+        idx = self._g.lookup(entity)
+        row = None if idx is None else self._positions().get(idx)
+        if row is None:
+            return default
+        return self._row(row)
+
+    def __getitem__(self, entity):
+        value = self.get(entity)
+        if value is None:
+            raise KeyError(entity)
+        return value
+
+    def __contains__(self, entity):
+        return self.get(entity) is not None
+
+    def __len__(self):
+        return len(self._g.cem_keys)
+
+    def __iter__(self):
+        for k in self._g.cem_keys:
+            yield self._g.names[int(k)]
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for i, k in enumerate(self._g.cem_keys):
+            yield self._g.names[int(k)], self._row(i)
+
+
+class MappedGraphStore:
+    """
+    Read-only GraphStore backed by memory-mapped arrays (see save_graph).
+
+    Exposes the same read API as GraphStore: nodes, edges, chunk_entity_map,
+    neighbors(), predecessors() and edges_by_relation(). Use
+    to_graph_store() to get a mutable copy.
+    """
+
+    def __init__(self, path: str):
+        path = current_version(path)
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        check_version("graph", meta.get("version"), (FORMAT_VERSION,))
+
+        def arr(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+        def blob(name):
+            file = os.path.join(path, name)
+            # np.memmap cannot map an empty file
+            if os.path.getsize(file) == 0:
+                return np.zeros(0, dtype=np.uint8)
+            return np.memmap(file, dtype=np.uint8, mode="r")
+
+        self.path = path
+        self.num_nodes = meta["num_nodes"]
+        self.revision = 0              # read-only, never changes
+        self.types = meta["types"]
+        self.relations = meta["relations"]
+        self.sources = meta["sources"]
+        self._extra = meta["extra"]
+
+        self.names = _StringTable(blob("names.bin"), arr("names_off"))
+        self._texts = _StringTable(blob("text.bin"), arr("text_off"))
+        self._sorted = _SortedView(self.names, arr("name_order"))
+        self.node_type = arr("node_type")
+        self.source = arr("source")
+        self.page = arr("page")
+        self.edge_src = arr("edge_src")
+        self.edge_rel = arr("edge_rel")
+        self.edge_dst = arr("edge_dst")
+        self.edge_chunk = arr("edge_chunk")
+        self.out_indptr = arr("out_indptr")
+        self.out_eids = arr("out_eids")
+        self.in_indptr = arr("in_indptr")
+        self.in_eids = arr("in_eids")
+        self.cem_keys = arr("cem_keys")
+        self.cem_indptr = arr("cem_indptr")
+        self.cem_vals = arr("cem_vals")
+
+        self.nodes = _NodeView(self)
+        self.edges = _EdgeView(self)
+        self.chunk_entity_map = _ChunkEntityView(self)
+        self.edge_chunks = _EdgeChunkView(self)
+
+    def lookup(self, node_id):
+        """Interned index of node_id, or None (binary search over sorted names)."""
+        i = bisect.bisect_left(self._sorted, node_id)
+        if i < len(self._sorted) and self._sorted[i] == node_id:
+            return int(self._sorted._order[i])
+        return None
+
+    def node_data(self, idx):
+        data = {"type": self.types[self.node_type[idx]]}
+        text = self._texts[idx]
+        if text or data["type"] == "Chunk":
+            data["text"] = text
+        if self.source[idx] >= 0:
+            data["source"] = self.sources[self.source[idx]]
+        if self.page[idx] >= 0:
+            data["page"] = int(self.page[idx])
+        data.update(self._extra.get(str(idx), {}))
+        return data
+
+    def _adjacent(self, node_id, indptr, eids, other):
+        idx = self.lookup(node_id)
+        if idx is None:
+            return []
+        return [
+            (self.relations[self.edge_rel[e]], self.names[int(other[e])])
+            for e in eids[indptr[idx]:indptr[idx + 1]]
+        ]
+
+    def neighbors(self, node_id):
+        """Outgoing (relation, target) pairs of a node."""
+        return self._adjacent(node_id, self.out_indptr, self.out_eids, self.edge_dst)
+
+    def predecessors(self, node_id):
+        """Incoming (relation, source) pairs of a node."""
+        return self._adjacent(node_id, self.in_indptr, self.in_eids, self.edge_src)
+
+    def edges_by_relation(self, relation):
+        """(source, target) pairs connected by the given relation."""
+        if relation not in self.relations:
+            return []
+        code = self.relations.index(relation)
+        return [
+            (self.names[int(self.edge_src[e])], self.names[int(self.edge_dst[e])])
+            for e in np.flatnonzero(self.edge_rel == code)
+        ]
+
+    def document_chunks(self, source):
+        """Ids of the chunk nodes that came from the given source file."""
+        if source not in self.sources:
+            return []
+        code = self.sources.index(source)
+        return [
+            self.names[int(i)]
+            for i in np.flatnonzero(np.asarray(self.source[:self.num_nodes]) == code)
+        ]
+
+    def document_sources(self):
+        return set(self.sources)
+
+    def nodes_of_type(self, node_type):
+        if node_type not in self.types:
+            return []
+        code = self.types.index(node_type)
+        ids = np.flatnonzero(np.asarray(self.node_type[:self.num_nodes]) == code)
+        return [self.names[int(i)] for i in ids]
+
+    def to_graph_store(self, compact: bool = False):
+        """Copy into a mutable GraphStore (or CompactGraphStore)."""
+        # Imported here: graph_util imports entity_util, which saves through this module
+        from graph_util import GraphStore, CompactGraphStore
+
+        graph = CompactGraphStore() if compact else GraphStore()
+        for node_id, data in self.nodes.items():
+            graph.add_node(node_id, data.pop("type"), **data)
+        for (s, r, o), cid in zip(self.edges, self.edge_chunks):
+            graph.add_edge(s, r, o, chunk_id=cid)
+        for entity, chunk_ids in self.chunk_entity_map.items():
+            for cid in chunk_ids:
+                graph.add_entity_chunk(entity, cid)
+        return graph
+
+
+def load_graph(path: str) -> MappedGraphStore:
+    return MappedGraphStore(path)
+
+
+def graph_exists(path: str) -> bool:
+    return os.path.exists(os.path.join(current_version(path), "meta.json"))
+
+
+def graph_version(path: str):
+    """Id of the last save_graph() into path (None if nothing is saved)."""
+    meta_file = os.path.join(current_version(path), "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, encoding="utf-8") as f:
+        meta = json.load(f)
+    # Graphs saved before build_id existed: fall back to the save time
+    return meta.get("build_id") or str(os.stat(meta_file).st_mtime_ns)
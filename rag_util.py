@@ -1,52 +1,524 @@
 import os
+import pickle
+import threading
+import time
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import faiss
+import numpy as np
+import torch
+from langchain_core.embeddings import Embeddings
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
 from transformers import AutoTokenizer
+from ann_util import (
+    build_index,
+    choose_index_type,
+    index_type_of,
+    reconstruct_all,
+    set_search_params,
+)
+from cache_util import EmbeddingCache, content_key
+from graph_util import assign_chunk_ids
+from persist_util import write_version, current_version, check_version, IndexFormatError
+from trace_util import Trace, current, record, span, count, tracing
 
 
 CACHE_DIR = os.path.normpath(
     os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models")
 )
 
+class CachedEmbeddings(Embeddings):
+    """
+    LangChain embedding function with explicit batching and caching.
+
+    Documents are looked up in an optional on-disk EmbeddingCache (keyed by
+    model name + text hash); only misses are encoded, batch_size texts at
+    a time. Query embeddings go through a small in-memory LRU.
+    """
+
+    def __init__(
+        self,
+        model,
+        model_name: str,
+        batch_size: int = 64,
+        cache: EmbeddingCache = None,
+        query_cache_size: int = 256,
+    ):
+        self.model = model
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache = cache
+        self.query_cache_size = query_cache_size
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, texts, batch_size: int = None) -> np.ndarray:
+        """Encode texts with the model (no caching), batch_size at a time."""
+        return np.asarray(
+            self.model.encode(
+                list(texts),
+                batch_size=batch_size or self.batch_size,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            ),
+            dtype=np.float32,
+        )
+
+    def embed_documents(self, texts):
+        with span("embed", texts=len(texts)) as attrs:
+            if self.cache is None:
+                return self.encode(texts).tolist()
+
+            keys = [content_key(self.model_name, t) for t in texts]
+            found = self.cache.get_many(list(set(keys)))
+            missing = list(dict.fromkeys(k for k in keys if k not in found))
+            attrs["cache_hits"] = len(found)
+            attrs["encoded"] = len(missing)
+            count("embedding_cache_hits", len(found))
+            count("embedding_cache_misses", len(missing))
+            if missing:
+                first = {}
+                for key, text in zip(keys, texts):
+                    first.setdefault(key, text)
+                vecs = self.encode([first[k] for k in missing])
+                new = dict(zip(missing, vecs))
+                self.cache.put_many(new)
+                found.update(new)
+            return [found[k].tolist() for k in keys]
+
+    def embed_query(self, text):
+        with self._lock:
+            if text in self._queries:
+                self._queries.move_to_end(text)
+                return list(self._queries[text])
+        vec = self.encode([text])[0].tolist()
+        with self._lock:
+            self._queries[text] = vec
+            if len(self._queries) > self.query_cache_size:
+                self._queries.popitem(last=False)
+        return list(vec)
+
+    def embed_queries(self, texts) -> np.ndarray:
+        """Batched embed_query for many questions (not written to the disk cache)."""
+        texts = list(texts)
+        with self._lock:
+            cached = {t: self._queries[t] for t in texts if t in self._queries}
+        missing = list(dict.fromkeys(t for t in texts if t not in cached))
+        if missing:
+            cached.update(zip(missing, self.encode(missing)))
+        return np.asarray([cached[t] for t in texts], dtype=np.float32)
+
+
 class Encoder:
     def __init__(
-        self, model_name: str = "sentence-transformers/all-MiniLM-L12-v2", device="cpu"
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L12-v2",
+        device="cpu",
+        batch_size: int = 64,
+        num_threads: int = None,
+        cache_path: str = None,
+        query_cache_size: int = 256,
     ):
-        self.embedding_function = HuggingFaceEmbeddings(
+        """
+        batch_size: texts per forward pass
+        num_threads: torch intra-op threads (None = torch default)
+        cache_path: SQLite file for cached document embeddings (None = off)
+        """
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.hf_embeddings = HuggingFaceEmbeddings(
             model_name=model_name,
             cache_folder=CACHE_DIR,
             model_kwargs={"device": device},
         )
-    
+        self.embedding_function = CachedEmbeddings(
+            self.hf_embeddings.client,
+            model_name,
+            batch_size=batch_size,
+            cache=EmbeddingCache(cache_path) if cache_path else None,
+            query_cache_size=query_cache_size,
+        )
+
+
+# docstore.pkl: {"version", "docstore", "index_to_docstore_id", "config"}
+DOCSTORE_VERSION = 1
+
+
+def graph_documents(graph):
+    """LangChain documents for the Chunk nodes of graph, under their chunk ids."""
+    docs = []
+    for cid in graph.nodes_of_type("Chunk"):
+        data = graph.nodes[cid]
+        docs.append(Document(
+            page_content=data.get("text") or "",
+            metadata={"source": data.get("source"), "page": data.get("page"), "chunk_id": cid},
+        ))
+    return docs
+
 
 class FaissDb:
-    def __init__(self, docs, embedding_function):
-        self.db = FAISS.from_documents(
-            docs, embedding_function, distance_strategy=DistanceStrategy.COSINE
+    def __init__(
+        self,
+        docs,
+        embedding_function,
+        index_type: str = "auto",
+        nprobe: int = 16,
+        ef_search: int = 64,
+        **index_kwargs,
+    ):
+        """
+        index_type: "flat", "hnsw", "ivf_flat", "ivf_pq" or "auto" (picked
+                    from the number of chunks, see ann_util.choose_index_type)
+        nprobe / ef_search: search-time recall / latency knobs for IVF / HNSW
+        index_kwargs: passed to ann_util.build_index (nlist, pq_m, ...)
+        """
+        # Vectors are stored under the chunk ids so they can be removed later
+        ids = assign_chunk_ids(docs)
+        vectors = np.asarray(
+            embedding_function.embed_documents([d.page_content for d in docs]),
+            dtype=np.float32,
+        )
+        # Unit vectors + inner product = cosine similarity
+        faiss.normalize_L2(vectors)
+        with span("faiss_build", vectors=len(docs)) as attrs:
+            index, self.index_type = build_index(vectors, index_type, **index_kwargs)
+            attrs["index_type"] = self.index_type
+        set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+        self.auto = index_type == "auto"
+        self.index_kwargs = index_kwargs
+        self.db = self._wrap(
+            embedding_function,
+            index,
+            InMemoryDocstore(dict(zip(ids, docs))),
+            dict(enumerate(ids)),
+        )
+
+    @staticmethod
+    def _wrap(embedding_function, index, docstore, index_to_docstore_id):
+        with warnings.catch_warnings():
+            # LangChain warns about normalize_L2 with inner product, but that
+            # combination is exactly cosine similarity
+            warnings.simplefilter("ignore")
+            return FAISS(
+                embedding_function,
+                index,
+                docstore,
+                index_to_docstore_id,
+                normalize_L2=True,
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            )
+
+    def set_search_params(self, nprobe: int = None, ef_search: int = None):
+        set_search_params(self.db.index, nprobe=nprobe, ef_search=ef_search)
+
+    def add_documents(self, docs):
+        """Embed and append only the chunks that are not indexed yet."""
+        ids = assign_chunk_ids(docs)
+        indexed = set(self.db.index_to_docstore_id.values())
+        new = [(i, d) for i, d in zip(ids, docs) if i not in indexed]
+        if new:
+            self._positions = None
+            with span("faiss_add", vectors=len(new)):
+                self.db.add_documents([d for _, d in new], ids=[i for i, _ in new])
+                if self.auto:
+                    self._maybe_switch_index_type()
+        return [i for i, _ in new]
+
+    def _maybe_switch_index_type(self):
+        # An "auto" index that outgrew its type is rebuilt from its own vectors
+        wanted = choose_index_type(self.db.index.ntotal)
+        if wanted == self.index_type:
+            return
+        params = self._search_params()
+        index, self.index_type = build_index(
+            reconstruct_all(self.db.index), wanted, **self.index_kwargs
         )
+        set_search_params(index, **params)
+        self.db.index = index
+
+    def remove(self, chunk_ids):
+        """Drop the vectors of the given chunk ids (needs a writable index)."""
+        indexed = set(self.db.index_to_docstore_id.values())
+        chunk_ids = [i for i in chunk_ids if i in indexed]
+        if not chunk_ids:
+            return chunk_ids
+        self._positions = None
+        if self.index_type == "hnsw":
+            # HNSW cannot remove vectors: rebuild from the stored vectors
+            doomed = set(chunk_ids)
+            positions = sorted(self.db.index_to_docstore_id)
+            kept = [p for p in positions if self.db.index_to_docstore_id[p] not in doomed]
+            vectors = reconstruct_all(self.db.index)[kept]
+            params = self._search_params()
+            new_index, _ = build_index(vectors, "hnsw", **self.index_kwargs)
+            set_search_params(new_index, **params)
+            self.db.docstore.delete(chunk_ids)
+            self.db.index = new_index
+            self.db.index_to_docstore_id = {
+                i: self.db.index_to_docstore_id[p] for i, p in enumerate(kept)
+            }
+        else:
+            self.db.delete(chunk_ids)
+        return chunk_ids
+
+    def _search_params(self):
+        index = self.db.index
+        ivf = faiss.try_extract_index_ivf(index)
+        return {
+            "nprobe": ivf.nprobe if ivf is not None else 16,
+            "ef_search": index.hnsw.efSearch if hasattr(index, "hnsw") else 64,
+        }
+
+    def save(self, path: str):
+        """
+        Write the index with FAISS's native serializer + the docstore, as a
+        new version of path (see persist_util.write_version): an index
+        memory-mapped from path by another session is never overwritten.
+        """
+        with write_version(path) as target:
+            self._write(target)
+
+    def _write(self, path: str):
+        faiss.write_index(self.db.index, os.path.join(path, "index.faiss"))
+        with open(os.path.join(path, "docstore.pkl"), "wb") as f:
+            config = {
+                **self._search_params(),
+                "auto": self.auto,
+                "index_kwargs": self.index_kwargs,
+            }
+            pickle.dump({
+                "version": DOCSTORE_VERSION,
+                "docstore": self.db.docstore,
+                "index_to_docstore_id": self.db.index_to_docstore_id,
+                "config": config,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, embedding_function, mmap: bool = True):
+        """
+        Load an index written by save(). With mmap=True the vectors are
+        memory-mapped read-only, so several processes share one copy.
+        Use mmap=False when the index will be modified (add_documents/remove).
+        A docstore of another format version, or one that does not match
+        the index, raises persist_util.IndexFormatError.
+        """
+        path = current_version(path)
+        index_file = os.path.join(path, "index.faiss")
+        index = None
+        if mmap:
+            try:
+                index = faiss.read_index(
+                    index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+                )
+            except RuntimeError:
+                # Not every index type supports mmap; read it normally
+                index = None
+        if index is None:
+            index = faiss.read_index(index_file)
+
+        with open(os.path.join(path, "docstore.pkl"), "rb") as f:
+            data = pickle.load(f)
+        version = data.get("version") if isinstance(data, dict) else None
+        check_version("FAISS docstore", version, (DOCSTORE_VERSION,))
+        docstore = data["docstore"]
+        index_to_docstore_id = data["index_to_docstore_id"]
+        config = data["config"]
+        if index.ntotal != len(index_to_docstore_id):
+            raise IndexFormatError(
+                f"FAISS index has {index.ntotal} vectors for "
+                f"{len(index_to_docstore_id)} docstore ids"
+            )
+
+        self = cls.__new__(cls)
+        self.index_type = index_type_of(index)
+        self.auto = config["auto"]
+        self.index_kwargs = config["index_kwargs"]
+        set_search_params(index, nprobe=config["nprobe"], ef_search=config["ef_search"])
+        self.db = cls._wrap(embedding_function, index, docstore, index_to_docstore_id)
+        return self
 
     def similarity_search(self, question: str, k: int = 3):
-        retrieved_docs = self.db.similarity_search(question, k=k)
+        with span("faiss_search", k=k):
+            retrieved_docs = self.db.similarity_search(question, k=k)
         context = "".join(doc.page_content + "\n" for doc in retrieved_docs)
         return context
 
+    def chunk_vectors(self, chunk_ids):
+        """
+        (found chunk ids, vectors) read back from the index, for reranking
+        without re-embedding. Vectors of ivf_pq indexes are approximate.
+        """
+        positions = getattr(self, "_positions", None)
+        if positions is None:
+            positions = self._positions = {
+                cid: pos for pos, cid in self.db.index_to_docstore_id.items()
+            }
+        found = [cid for cid in chunk_ids if cid in positions]
+        if not found:
+            return [], np.zeros((0, self.db.index.d), dtype=np.float32)
+        keys = np.asarray([positions[cid] for cid in found], dtype=np.int64)
+        ivf = faiss.try_extract_index_ivf(self.db.index)
+        if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+            # Hashtable (unlike the array map) still allows remove_ids
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        try:
+            return found, self.db.index.reconstruct_batch(keys)
+        except RuntimeError:
+            # Index type without reconstruction: the caller embeds instead
+            return [], np.zeros((0, self.db.index.d), dtype=np.float32)
 
-def load_and_split_pdfs(file_paths: list, chunk_size: int = 256):
-    loaders = [PyPDFLoader(file_path) for file_path in file_paths]
-    pages = []
-    for loader in loaders:
-        pages.extend(loader.load())
+    def similarity_search_with_score(self, question: str, k: int = 3):
+        """(document, cosine similarity) pairs, best first."""
+        with span("faiss_search", k=k):
+            return self.db.similarity_search_with_score(question, k=k)
 
-    text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
-        tokenizer=AutoTokenizer.from_pretrained(
-            "sentence-transformers/all-MiniLM-L12-v2"
-        ),
-        chunk_size=chunk_size,
-        chunk_overlap=int(chunk_size / 10),
-        strip_whitespace=True,
+    def batch_similarity_search_with_score(self, questions, k: int = 3):
+        """
+        similarity_search_with_score for many questions: one batched
+        embedding call and one index.search over the whole query matrix.
+        Returns one list of (document, score) pairs per question, in order.
+        """
+        if not questions:
+            return []
+        embedding_function = self.db.embedding_function
+        if hasattr(embedding_function, "embed_queries"):
+            vectors = embedding_function.embed_queries(questions)
+        else:
+            vectors = embedding_function.embed_documents(list(questions))
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        with span("faiss_search", k=k, queries=len(vectors)):
+            scores, positions = self.db.index.search(vectors, k)
+
+        return [
+            [
+                (self.db.docstore.search(self.db.index_to_docstore_id[int(p)]), float(s))
+                for p, s in zip(row, row_scores) if p >= 0
+            ]
+            for row, row_scores in zip(positions, scores)
+        ]
+
+    def batch_similarity_search(self, questions, k: int = 3):
+        """
+        similarity_search for many questions. Returns one context string per
+        question, in order.
+        """
+        return [
+            "".join(doc.page_content + "\n" for doc, _ in hits)
+            for hits in self.batch_similarity_search_with_score(questions, k)
+        ]
+
+
+def load_cross_encoder(
+    model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+    device="cpu",
+):
+    """Local sentence-transformers CrossEncoder for Reranker (optional)."""
+    from sentence_transformers import CrossEncoder
+
+    # sentence-transformers 2.5 has no cache_folder argument for CrossEncoder
+    return CrossEncoder(
+        model_name,
+        device=device,
+        tokenizer_args={"cache_dir": CACHE_DIR},
+        automodel_args={"cache_dir": CACHE_DIR},
     )
-    docs = text_splitter.split_documents(pages)
+
+
+# One tokenizer / splitter per process (and per chunk size)
+_TOKENIZER = None
+_SPLITTERS = {}
+
+
+def get_text_splitter(chunk_size: int = 256):
+    global _TOKENIZER
+    if chunk_size not in _SPLITTERS:
+        if _TOKENIZER is None:
+            _TOKENIZER = AutoTokenizer.from_pretrained(
+                "sentence-transformers/all-MiniLM-L12-v2"
+            )
+        _SPLITTERS[chunk_size] = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            tokenizer=_TOKENIZER,
+            chunk_size=chunk_size,
+            chunk_overlap=int(chunk_size / 10),
+            strip_whitespace=True,
+        )
+    return _SPLITTERS[chunk_size]
+
+
+def split_pdf(file_path: str, chunk_size: int = 256):
+    """Parse one PDF page by page and split each page as it is read."""
+    splitter = get_text_splitter(chunk_size)
+    docs = []
+    load_seconds = split_seconds = 0.0
+    pages = 0
+    start = time.perf_counter()
+    for page in PyPDFLoader(file_path).lazy_load():
+        split_start = time.perf_counter()
+        load_seconds += split_start - start
+        docs.extend(splitter.split_documents([page]))
+        start = time.perf_counter()
+        split_seconds += start - split_start
+        pages += 1
+    load_seconds += time.perf_counter() - start
+    assign_chunk_ids(docs)
+    file_name = os.path.basename(file_path)
+    record("pdf_load", load_seconds, file=file_name, pages=pages)
+    record("split", split_seconds, file=file_name, chunks=len(docs))
+    return docs
+
+
+def _split_pdf_traced(file_path: str, chunk_size: int):
+    # Worker processes trace into their own Trace and ship it back
+    trace = Trace("split_pdf")
+    with tracing(trace):
+        docs = split_pdf(file_path, chunk_size)
+    return docs, trace
+
+
+def iter_split_pdfs(file_paths: list, chunk_size: int = 256, max_workers: int = 1):
+    """
+    Yield the chunks of each PDF (one list per file, in file order) as soon
+    as that file is parsed.
+
+    max_workers > 1 parses files in a process pool; at most max_workers
+    files are in flight, so memory depends on a few documents rather
+    than the whole corpus. Scripts using max_workers > 1 need an
+    `if __name__ == "__main__":` guard on platforms that spawn workers.
+    """
+    if max_workers <= 1:
+        for file_path in file_paths:
+            yield split_pdf(file_path, chunk_size)
+        return
+
+    parse = _split_pdf_traced if current() is not None else split_pdf
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        paths = iter(file_paths)
+        for file_path in paths:
+            pending.append(pool.submit(parse, file_path, chunk_size))
+            if len(pending) >= max_workers:
+                break
+        while pending:
+            docs = pending.popleft().result()
+            if parse is _split_pdf_traced:
+                docs, worker_trace = docs
+                current().merge(worker_trace)
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append(pool.submit(parse, next_path, chunk_size))
+            yield docs
+
+
+def load_and_split_pdfs(file_paths: list, chunk_size: int = 256, max_workers: int = 1):
+    docs = []
+    for file_docs in iter_split_pdfs(file_paths, chunk_size, max_workers):
+        docs.extend(file_docs)
     return docs
\ No newline at end of file
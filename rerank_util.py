@@ -0,0 +1,166 @@
+"""
+Reranking of retrieved chunks against the question, within a time budget.
+
+    reranker = Reranker(encoder.embedding_function, vectors=faiss_db.chunk_vectors)
+    chunks = reranker.rerank(question, chunks)   # best top_k, "rerank_score" added
+
+Candidates are scored by the cosine similarity of their chunk vector and
+the question vector (one matrix-vector product). Chunk vectors come from a
+local LRU cache, then from the FAISS index (vectors=...), and only then
+from the embedding function, so reranking normally embeds nothing but the
+question (itself cached by CachedEmbeddings). An optional cross-encoder
+rescores the best candidates while the budget lasts.
+
+When the budget runs out the remaining work is skipped: chunks that could
+not be scored keep their retrieval order after the scored ones.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from trace_util import span
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class Reranker:
+    """
+    embedding_function: LangChain embeddings (embed_query / embed_documents)
+    vectors: optional callable chunk_ids -> (found chunk ids, matrix), e.g.
+             FaissDb.chunk_vectors
+    cross_encoder: optional object with predict([(question, text), ...]),
+                   e.g. rag_util.load_cross_encoder(...)
+    top_k: chunks kept
+    budget_ms: time budget of one rerank() call
+    cross_encoder_k: candidates (best by cosine) sent to the cross-encoder
+    cache_size: chunk vectors kept in memory
+    """
+
+    def __init__(
+        self,
+        embedding_function,
+        vectors=None,
+        cross_encoder=None,
+        top_k: int = 8,
+        budget_ms: float = 150,
+        cross_encoder_k: int = 16,
+        cross_encoder_batch: int = 8,
+        cache_size: int = 50_000,
+    ):
+        self.embedding_function = embedding_function
+        self.vectors = vectors
+        self.cross_encoder = cross_encoder
+        self.top_k = top_k
+        self.budget_ms = budget_ms
+        self.cross_encoder_k = cross_encoder_k
+        self.cross_encoder_batch = cross_encoder_batch
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # chunk id -> unit vector
+        self._lock = threading.Lock()
+
+    def _cached(self, chunk_ids):
+        with self._lock:
+            found = {}
+            for cid in chunk_ids:
+                vec = self._cache.get(cid)
+                if vec is not None:
+                    self._cache.move_to_end(cid)
+                    found[cid] = vec
+            return found
+
+    def _store(self, chunk_ids, matrix):
+        with self._lock:
+            for cid, vec in zip(chunk_ids, matrix):
+                self._cache[cid] = vec
+                self._cache.move_to_end(cid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def chunk_vectors(self, chunks, deadline=None):
+        """
+        {chunk id: unit vector} for the given chunk dicts: cache, then the
+        vectors callable, then embed_documents (skipped past deadline).
+        Returns (vectors, counts per source).
+        """
+        ids = [c["chunk_id"] for c in chunks if c.get("chunk_id")]
+        found = self._cached(ids)
+        stats = {"cached": len(found), "index": 0, "embedded": 0}
+
+        missing = [cid for cid in ids if cid not in found]
+        if missing and self.vectors is not None:
+            got, matrix = self.vectors(missing)
+            if len(got):
+                matrix = _normalize(np.asarray(matrix, dtype=np.float32))
+                self._store(got, matrix)
+                found.update(zip(got, matrix))
+                stats["index"] = len(got)
+
+        missing = [c for c in chunks if c.get("chunk_id") and c["chunk_id"] not in found]
+        if missing and (deadline is None or time.perf_counter() < deadline):
+            matrix = _normalize(np.asarray(
+                self.embedding_function.embed_documents([c["text"] for c in missing]),
+                dtype=np.float32,
+            ))
+            got = [c["chunk_id"] for c in missing]
+            self._store(got, matrix)
+            found.update(zip(got, matrix))
+            stats["embedded"] = len(got)
+        return found, stats
+
+    def rerank(self, question: str, chunks, top_k: int = None):
+        """
+        chunks: chunk dicts in retrieval order (see graph_util.pack_context).
+        Returns the best top_k, each with "rerank_score" (cosine, or the
+        cross-encoder score when it got that far).
+        """
+        top_k = top_k or self.top_k
+        if not chunks:
+            return []
+        deadline = time.perf_counter() + self.budget_ms / 1000
+
+        with span("rerank", candidates=len(chunks)) as attrs:
+            query = _normalize(np.asarray(
+                self.embedding_function.embed_query(question), dtype=np.float32
+            ))
+            vectors, stats = self.chunk_vectors(chunks, deadline)
+            attrs.update(stats)
+
+            scored = [c for c in chunks if c.get("chunk_id") in vectors]
+            unscored = [c for c in chunks if c.get("chunk_id") not in vectors]
+            if scored:
+                cosine = np.stack([vectors[c["chunk_id"]] for c in scored]) @ query
+                order = np.argsort(-cosine, kind="stable")
+                # Only the chunks that can still make the top_k are copied
+                keep = top_k if self.cross_encoder is None else max(top_k, self.cross_encoder_k)
+                scored = [
+                    {**scored[i], "rerank_score": float(cosine[i])} for i in order[:keep]
+                ]
+
+            if self.cross_encoder is not None and scored:
+                scored = self._cross_encode(question, scored, deadline, attrs)
+
+            attrs["over_budget"] = time.perf_counter() > deadline
+            attrs["kept"] = min(top_k, len(scored) + len(unscored))
+            return (scored + unscored)[:top_k]
+
+    def _cross_encode(self, question, scored, deadline, attrs):
+        # Best cosine candidates first, one batch at a time, until the deadline
+        head = scored[:self.cross_encoder_k]
+        done = []
+        for i in range(0, len(head), self.cross_encoder_batch):
+            if time.perf_counter() >= deadline:
+                break
+            batch = head[i:i + self.cross_encoder_batch]
+            scores = self.cross_encoder.predict([(question, c["text"]) for c in batch])
+            done.extend(
+                {**c, "rerank_score": float(s), "cross_encoded": True}
+                for c, s in zip(batch, scores)
+            )
+        attrs["cross_encoded"] = len(done)
+        done.sort(key=lambda c: c["rerank_score"], reverse=True)
+        return done + scored[len(done):]
@@ -0,0 +1,181 @@
+"""
+Hybrid retrieval: graph traversal and FAISS similarity search run
+concurrently, optionally with a BM25 lexical search (bm25_util), and
+their ranked chunk lists are fused into one.
+
+    retriever = HybridRetriever(graph, faiss_db, query_extractor, lexical=bm25)
+    chunks, entities = retriever.retrieve(question)
+    context, packed = pack_context(chunks, max_tokens, count_tokens)
+
+Fusion is reciprocal-rank fusion by default ("rrf": a chunk scores
+weight / (rrf_k + rank) per list it appears in), or a weighted sum of
+min-max normalized scores ("score").
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from graph_util import GraphRetriever, graph_chunks, document_chunks
+from trace_util import span, propagate
+
+FUSION_METHODS = ("rrf", "score")
+
+
+def reciprocal_rank_fusion(rankings, weights=None, rrf_k: int = 60):
+    """
+    rankings: {signal: [(key, score), ...] best first}.
+    Returns [(key, fused score)] best first; ties keep first-seen order.
+    """
+    weights = weights or {}
+    fused = {}
+    for signal, ranking in rankings.items():
+        weight = weights.get(signal, 1.0)
+        for rank, (key, _) in enumerate(ranking, start=1):
+            fused[key] = fused.get(key, 0.0) + weight / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
+
+
+def score_fusion(rankings, weights=None):
+    """
+    Like reciprocal_rank_fusion, but sums the weighted scores of each list
+    after scaling them to [0, 1] (a single-item list scores 1).
+    """
+    weights = weights or {}
+    fused = {}
+    for signal, ranking in rankings.items():
+        if not ranking:
+            continue
+        weight = weights.get(signal, 1.0)
+        scores = [score for _, score in ranking]
+        low, high = min(scores), max(scores)
+        for key, score in ranking:
+            scaled = (score - low) / (high - low) if high > low else 1.0
+            fused[key] = fused.get(key, 0.0) + weight * scaled
+    return sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
+
+
+def fuse(rankings, method: str = "rrf", weights=None, rrf_k: int = 60):
+    if method == "rrf":
+        return reciprocal_rank_fusion(rankings, weights, rrf_k)
+    if method == "score":
+        return score_fusion(rankings, weights)
+    raise ValueError(f"Unknown fusion method {method!r}, expected one of {FUSION_METHODS}")
+
+
+def fused_chunks(graph, rankings, documents=None, method: str = "rrf", weights=None, rrf_k: int = 60):
+    """
+    Chunk dicts (see graph_util.pack_context) in fused order, each with its
+    fused "score" and its 1-based "ranks" per signal.
+
+    rankings: {signal: [(chunk_id, score), ...] best first}
+    documents: {chunk_id: chunk dict} for hits that may not be in graph
+    """
+    documents = documents or {}
+    ranks = {}
+    for signal, ranking in rankings.items():
+        for rank, (chunk_id, _) in enumerate(ranking, start=1):
+            ranks.setdefault(chunk_id, {})[signal] = rank
+
+    chunks = []
+    for chunk_id, score in fuse(rankings, method, weights, rrf_k):
+        if chunk_id in graph.nodes:
+            chunk = graph_chunks(graph, [chunk_id])[0]
+        elif chunk_id in documents:
+            chunk = dict(documents[chunk_id])
+        else:
+            continue
+        chunk["score"] = score
+        chunk["ranks"] = ranks[chunk_id]
+        chunks.append(chunk)
+    return chunks
+
+
+def faiss_ranking(hits):
+    """(chunk_id, score) list and {chunk_id: chunk dict} for FAISS hits."""
+    chunks = [c for c in document_chunks(hits) if c["chunk_id"]]
+    return (
+        [(c["chunk_id"], c["score"]) for c in chunks],
+        {c["chunk_id"]: c for c in chunks},
+    )
+
+
+class HybridRetriever:
+    """
+    Graph + FAISS (+ BM25) retrieval for one graph / index pair.
+
+    The FAISS search (question embedding + index search) runs on a worker
+    thread while the calling thread extracts the query entities and walks
+    the graph, so a question costs max(graph, FAISS) rather than their sum.
+    The BM25 search (lexical: a BM25Index) is cheap enough to run inline.
+    """
+
+    def __init__(
+        self,
+        graph,
+        faiss_db,
+        query_extractor=None,
+        faiss_k: int = 8,
+        max_hops: int = 1,
+        method: str = "rrf",
+        weights=None,
+        rrf_k: int = 60,
+        lexical=None,
+        lexical_k: int = 8,
+    ):
+        if method not in FUSION_METHODS:
+            raise ValueError(f"Unknown fusion method {method!r}, expected one of {FUSION_METHODS}")
+        self.graph = graph
+        self.faiss_db = faiss_db
+        self.query_extractor = query_extractor
+        self.graph_retriever = GraphRetriever(graph)
+        self.faiss_k = faiss_k
+        self.max_hops = max_hops
+        self.method = method
+        self.weights = weights
+        self.rrf_k = rrf_k
+        self.lexical = lexical
+        self.lexical_k = lexical_k
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hybrid")
+
+    def _faiss(self, question):
+        return self.faiss_db.similarity_search_with_score(question, k=self.faiss_k)
+
+    def retrieve(self, question: str, query_entities=None):
+        """
+        Returns (chunks, query_entities): fused chunk dicts best first (see
+        fused_chunks) and the entities used for the graph walk. Entities are
+        taken from query_extractor unless given.
+        """
+        with span("hybrid_retrieval", method=self.method) as attrs:
+            faiss_future = self._pool.submit(propagate(self._faiss), question)
+            rankings = {}
+            try:
+                if self.lexical is not None:
+                    with span("bm25_search", k=self.lexical_k):
+                        rankings["bm25"] = self.lexical.search(question, k=self.lexical_k)
+                if query_entities is None:
+                    query_entities = self.query_extractor.extract(question, graph=self.graph)
+                graph_hits = self.graph_retriever.retrieve_scored_chunks(
+                    query_entities, max_hops=self.max_hops
+                )
+            finally:
+                faiss_hits = faiss_future.result()
+
+            faiss_hits, documents = faiss_ranking(faiss_hits)
+            rankings["graph"] = graph_hits
+            rankings["faiss"] = faiss_hits
+            chunks = fused_chunks(
+                self.graph,
+                rankings,
+                documents,
+                self.method,
+                self.weights,
+                self.rrf_k,
+            )
+            attrs["graph_chunks"] = len(graph_hits)
+            attrs["faiss_chunks"] = len(faiss_hits)
+            if "bm25" in rankings:
+                attrs["bm25_chunks"] = len(rankings["bm25"])
+            attrs["chunks"] = len(chunks)
+            return chunks, query_entities
+
+    def close(self):
+        self._pool.shutdown(wait=False)
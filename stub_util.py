@@ -0,0 +1,146 @@
+"""
+Local stand-ins for the LLM endpoints, shared by the tests and benchmark.py.
+
+FakeStreamingClient replaces huggingface_hub.InferenceClient in-process;
+StubChatServer is a real HTTP server (OpenAI-compatible) for
+llm_util.HTTPChatClient. Neither needs a network or an HF token.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+
+class FakeStreamingClient:
+    """
+    Local stand-in for huggingface_hub.InferenceClient that streams a
+    DeepSeek-R1 style answer (<think> reasoning, then the answer) one word
+    per chunk. Pass it as ChatModel(client=FakeStreamingClient()).
+
+    reasoning_words: 0 streams the answer without a <think> block
+    chunk_chars: stream chunks of this many characters instead of words,
+                 so tags can be split across chunks
+    """
+
+    def __init__(self, reasoning_words=200, answer_words=80,
+                 first_token_latency=0.3, token_latency=0.005, chunk_chars=None):
+        self.reasoning = " ".join(f"thought_{i}" for i in range(reasoning_words))
+        self.answer = " ".join(f"word_{i}" for i in range(answer_words))
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.chunk_chars = chunk_chars
+
+    def _chunks(self):
+        text = self.answer
+        if self.reasoning:
+            text = f"<think>\n{self.reasoning}\n</think>\n\n{text}"
+        if self.chunk_chars:
+            return [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)]
+        words = text.split(" ")
+        return words[:1] + [" " + word for word in words[1:]]
+
+    def _tokens(self):
+        time.sleep(self.first_token_latency)
+        for i, chunk in enumerate(self._chunks()):
+            if i:
+                time.sleep(self.token_latency)
+            yield chunk
+
+    def chat_completion(self, messages, model=None, max_tokens=250, stream=False):
+        if not stream:
+            content = "".join(self._tokens())
+            return SimpleNamespace(choices=[SimpleNamespace(message={"content": content})])
+        return (
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+            for token in self._tokens()
+        )
+
+    def text_generation(self, prompt, max_new_tokens=250, stream=False):
+        return self._tokens() if stream else "".join(self._tokens())
+
+
+class StubChatServer:
+    """
+    Local OpenAI-compatible endpoint (POST /v1/chat/completions, plain or
+    streamed) for exercising llm_util.HTTPChatClient without a network.
+
+        with StubChatServer(latency=0.05, fail_every=10) as server:
+            client = LLMClient(HTTPChatClient(server.url))
+
+    latency: seconds per request
+    fail_every: answer the first request of every Nth distinct prompt with
+                a 429 and Retry-After (0 = never); retries of that prompt
+                succeed, so the number of 429s does not depend on timing
+    error_status: answer every request with this HTTP status (e.g. 503)
+    """
+
+    def __init__(self, latency=0.05, fail_every=0, retry_after=0.05, error_status=None):
+        stub = self
+        self.latency = latency
+        self.fail_every = fail_every
+        self.retry_after = retry_after
+        self.error_status = error_status
+        self.requests = 0
+        self.rejected = 0
+        self._prompts = set()
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, as real servers do
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, headers=()):
+                self.send_response(status)
+                for key, value in headers:
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                prompt = json.dumps(payload.get("messages") or payload.get("inputs"))
+                with stub._lock:
+                    stub.requests += 1
+                    reject = False
+                    if prompt not in stub._prompts:
+                        stub._prompts.add(prompt)
+                        reject = bool(stub.fail_every) and len(stub._prompts) % stub.fail_every == 0
+                    stub.rejected += reject
+                if reject:
+                    return self._send(429, b'{"error": "rate limited"}',
+                                      [("Retry-After", str(stub.retry_after))])
+                if stub.error_status is not None:
+                    return self._send(stub.error_status, b'{"error": "stub error"}')
+                if self.path != "/v1/chat/completions":
+                    return self._send(404, b'{"error": "not found"}')
+
+                time.sleep(stub.latency)
+                content = "Answer to: " + payload["messages"][-1]["content"][:40]
+                if not payload.get("stream"):
+                    body = {"choices": [{"message": {"role": "assistant", "content": content}}]}
+                    return self._send(200, json.dumps(body).encode(),
+                                      [("Content-Type", "application/json")])
+
+                events = [
+                    {"choices": [{"delta": {"content": word if i == 0 else " " + word}}]}
+                    for i, word in enumerate(content.split(" "))
+                ]
+                body = "".join(f"data: {json.dumps(e)}\n\n" for e in events) + "data: [DONE]\n\n"
+                self._send(200, body.encode(), [("Content-Type", "text/event-stream")])
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
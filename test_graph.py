@@ -6,6 +6,7 @@ from graph_util import (
     GraphRetriever,
     build_context_from_chunks
 )
+from entity_util import EntityResolver, EntityLinker
 from model import ChatModel
 from visualize_graph import visualize_graph
 
@@ -43,7 +44,8 @@ faiss_db = rag_util.FaissDb(
 # 4. Build Knowledge Graph (PHASE 2)
 # =====================================
 extractor = GraphExtractor(llm=model)
-graph = build_graph_from_chunks(docs, extractor)
+resolver = EntityResolver(embedding_function=encoder.embedding_function)
+graph = build_graph_from_chunks(docs, extractor, max_workers=8, resolver=resolver)
 
 print("\n--- GRAPH STATS ---")
 print("Total Nodes:", len(graph.nodes))
@@ -94,7 +96,11 @@ print("User Question:", user_question)
 # ---------------------------------
 # 8. Extract Query Entities
 # ---------------------------------
-query_entity_extractor = QueryEntityExtractor(llm=model)
+query_entity_extractor = QueryEntityExtractor(
+    llm=model,
+    resolver=resolver,
+    linker=EntityLinker(encoder.embedding_function)
+)
 query_entities = query_entity_extractor.extract(
     user_question,
     graph=graph   # IMPORTANT: graph-aware fallback
@@ -108,8 +114,8 @@ print(query_entities)
 # 9. Graph Reasoning Path (Explainability)
 # ---------------------------------
 print("\n================ GRAPH REASONING PATH =================")
-for s, r, o in graph.edges:
-    if s in query_entities:
+for s in query_entities:
+    for r, o in graph.neighbors(s):
         print(f"{s} --{r}--> {o}")
 
 
@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+from llm_util import LLMClient, LLMError, HTTPChatClient, TokenBucket
+from stub_util import StubChatServer
+
+
+def ask(client, prompt="What is plate tectonics?"):
+    response = client.chat_completion(messages=[{"role": "user", "content": prompt}])
+    return response["choices"][0]["message"]["content"]
+
+
+def test_retry_after_pauses_then_retries():
+    with StubChatServer(latency=0, fail_every=1, retry_after=0.3) as server:
+        client = LLMClient(HTTPChatClient(server.url), backoff=0.01)
+        start = time.monotonic()
+        answer = ask(client)
+        elapsed = time.monotonic() - start
+
+    assert answer.startswith("Answer to:")
+    assert elapsed >= 0.3
+    assert server.requests == 2 and server.rejected == 1
+    assert client.stats()["retries"] == 1
+
+
+def test_retry_after_holds_back_other_threads():
+    with StubChatServer(latency=0, fail_every=1, retry_after=0.4) as server:
+        client = LLMClient(HTTPChatClient(server.url), backoff=0.01)
+        ask(client, "first")
+        # The 429 of "second" makes a request sent right after it wait too
+        started = threading.Event()
+
+        def second():
+            started.set()
+            ask(client, "second")
+
+        thread = threading.Thread(target=second)
+        thread.start()
+        started.wait()
+        time.sleep(0.1)
+        start = time.monotonic()
+        ask(client, "first")
+        waited = time.monotonic() - start
+        thread.join()
+
+    assert waited >= 0.2
+
+
+def test_error_after_retries_run_out():
+    with StubChatServer(latency=0, error_status=503) as server:
+        client = LLMClient(HTTPChatClient(server.url), max_retries=2, backoff=0.01)
+        with pytest.raises(LLMError) as info:
+            ask(client)
+
+    assert info.value.status == 503
+    assert info.value.retryable and info.value.exhausted
+    assert server.requests == 3
+    assert client.stats()["retries"] == 2
+
+
+def test_non_retryable_error_is_not_retried():
+    with StubChatServer(latency=0, error_status=400) as server:
+        client = LLMClient(HTTPChatClient(server.url), max_retries=3, backoff=0.01)
+        with pytest.raises(LLMError) as info:
+            ask(client)
+
+    assert not info.value.retryable and not info.value.exhausted
+    assert server.requests == 1
+
+
+def test_identical_concurrent_requests_are_coalesced():
+    with StubChatServer(latency=0.3) as server:
+        client = LLMClient(HTTPChatClient(server.url))
+        barrier = threading.Barrier(8)
+        answers = []
+
+        def worker():
+            barrier.wait()
+            answers.append(ask(client))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(set(answers)) == 1 and len(answers) == 8
+    assert server.requests == 1
+    assert client.stats()["coalesced"] == 7
+
+
+def test_token_bucket_paces_after_burst():
+    bucket = TokenBucket(rate=20, capacity=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    burst = time.monotonic() - start
+    for _ in range(4):
+        bucket.acquire()
+    paced = time.monotonic() - start - burst
+
+    assert burst < 0.05
+    # 4 more tokens at 20 per second
+    assert 0.18 <= paced < 0.5
+
+
+def test_rate_limited_client_against_stub():
+    with StubChatServer(latency=0) as server:
+        client = LLMClient(HTTPChatClient(server.url), rate=20, burst=1, coalesce=False)
+        start = time.monotonic()
+        for i in range(5):
+            ask(client, f"question {i}")
+        elapsed = time.monotonic() - start
+
+    assert server.requests == 5
+    assert elapsed >= 0.18
+
+
+def test_async_calls_keep_trace_and_deadline():
+    import asyncio
+    from llm_util import deadline
+    from trace_util import Trace, tracing
+
+    async def run(client):
+        return await asyncio.gather(*(client.achat_completion(
+            messages=[{"role": "user", "content": f"q{i}"}]) for i in range(4)))
+
+    with StubChatServer(latency=0, fail_every=1, retry_after=0.05) as server:
+        client = LLMClient(HTTPChatClient(server.url), backoff=0.01)
+        trace = Trace("test")
+        with tracing(trace):
+            asyncio.run(run(client))
+        assert trace.counters.get("llm_retries") == 4
+
+        with deadline(0.01), pytest.raises(LLMError) as info:
+            time.sleep(0.02)
+            asyncio.run(run(client))
+        assert info.value.exhausted
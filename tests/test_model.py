@@ -0,0 +1,80 @@
+import pytest
+
+from model import ChatModel, ThinkFilter, THINK_PLACEHOLDER
+from stub_util import FakeStreamingClient
+
+
+def fake_model(model_id="deepseek-ai/DeepSeek-R1", **kwargs):
+    kwargs.setdefault("first_token_latency", 0)
+    kwargs.setdefault("token_latency", 0)
+    client = FakeStreamingClient(**kwargs)
+    return ChatModel(model_id=model_id, client=client), client
+
+
+def test_think_filter_tags_split_across_chunks():
+    f = ThinkFilter("collapse")
+    out = [f.feed(piece) for piece in ["<thi", "nk>plan", " it</th", "ink>\n\nThe ", "answer"]]
+    out.append(f.flush())
+
+    assert "".join(out) == THINK_PLACEHOLDER + "The answer"
+    assert f.reasoning == "plan it"
+    assert f.answer == "The answer"
+    # Nothing of a partial tag leaks out while it is held back
+    assert out[0] == ""
+
+
+def test_think_filter_modes():
+    text = "<think>why</think>\n\nbecause"
+    for mode, visible in [("show", text), ("hide", "because"),
+                          ("collapse", THINK_PLACEHOLDER + "because")]:
+        f = ThinkFilter(mode)
+        assert f.feed(text) + f.flush() == visible
+        assert f.reasoning == "why" and f.answer == "because"
+
+
+def test_think_filter_rejects_unknown_mode():
+    with pytest.raises(ValueError):
+        ThinkFilter("fold")
+
+
+@pytest.mark.parametrize("chunk_chars", [1, 2, 3, 5, 7, 11])
+def test_stream_splits_reasoning_and_answer(chunk_chars):
+    model, client = fake_model(reasoning_words=12, answer_words=9, chunk_chars=chunk_chars)
+    stream = model.stream("Why?", think="hide")
+    visible = "".join(stream)
+
+    assert visible == client.answer
+    assert stream.answer == client.answer
+    assert stream.reasoning.strip() == client.reasoning
+    assert stream.error is None
+
+
+def test_stream_without_think_block():
+    model, client = fake_model(reasoning_words=0, answer_words=9)
+    stream = model.stream("Why?", think="collapse")
+
+    assert "".join(stream) == client.answer
+    assert stream.reasoning == ""
+    # The first token is already answer text
+    assert stream.first_answer == pytest.approx(stream.ttft, abs=0.05)
+
+
+def test_stream_with_text_generation_endpoint():
+    model, client = fake_model(model_id="gpt2", reasoning_words=5, answer_words=4, chunk_chars=4)
+    stream = model.stream("Why?", think="collapse")
+
+    assert "".join(stream) == THINK_PLACEHOLDER + client.answer
+
+
+def test_stream_timings():
+    model, client = fake_model(reasoning_words=10, answer_words=5,
+                          first_token_latency=0.1, token_latency=0.01)
+    stream = model.stream("Why?", think="collapse")
+    pieces = list(stream)
+
+    assert pieces[0] == THINK_PLACEHOLDER
+    assert stream.ttft >= 0.1
+    # The answer starts after the 10 reasoning words (9 token latencies)
+    assert stream.first_answer >= stream.ttft + 0.08
+    assert stream.elapsed >= stream.first_answer
+    assert stream.chunks == len(client._chunks())
@@ -0,0 +1,200 @@
+"""
+Lightweight per-stage tracing for the RAG pipeline.
+
+    trace = Trace("question")
+    with tracing(trace):
+        with span("graph_retrieval") as attrs:
+            ...
+            attrs["chunks"] = len(chunk_ids)
+        count("extraction_cache_hits")
+
+    trace.to_json()        # every span + counters
+    trace.to_prometheus()  # per-stage count / sum / max + counters
+
+The active trace lives in a context variable, so span() / count() / record()
+are no-ops outside tracing() and cost next to nothing when tracing is off.
+Worker threads do not inherit it: wrap the function handed to a thread pool
+with propagate().
+"""
+import contextvars
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("trace", default=None)
+_parent = contextvars.ContextVar("trace_parent", default=None)
+
+
+class Trace:
+    """
+    Spans and counters of one unit of work (a question, a build).
+
+    keep_spans=False only keeps the per-stage aggregates, for a long-lived
+    trace that other traces are merged into.
+    """
+
+    def __init__(self, name: str = "trace", keep_spans: bool = True):
+        self.name = name
+        self.keep_spans = keep_spans
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self.spans = []
+        # stage -> [count, total seconds, max seconds]
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float, start: float = None, parent=None, **attrs):
+        if start is None:
+            start = time.perf_counter() - self._t0 - seconds
+        with self._lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+            if self.keep_spans:
+                self.spans.append({
+                    "name": name,
+                    "start": round(start, 6),
+                    "seconds": round(seconds, 6),
+                    "parent": parent,
+                    "thread": threading.current_thread().name,
+                    **attrs,
+                })
+
+    def __getstate__(self):
+        # Picklable, so process pool workers can return their traces
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other: "Trace"):
+        """Add the stage aggregates and counters (and spans) of other."""
+        with self._lock:
+            for name, (n, total, worst) in other.stages.items():
+                stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+                stage[0] += n
+                stage[1] += total
+                stage[2] = max(stage[2], worst)
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            if self.keep_spans:
+                self.spans.extend(other.spans)
+
+    def summary(self):
+        """stage -> {"count", "seconds", "max_seconds"}, slowest total first."""
+        rows = sorted(self.stages.items(), key=lambda kv: kv[1][1], reverse=True)
+        return {
+            name: {"count": n, "seconds": round(total, 6), "max_seconds": round(worst, 6)}
+            for name, (n, total, worst) in rows
+        }
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started": self.started,
+            "stages": self.summary(),
+            "counters": dict(self.counters),
+            "spans": list(self.spans),
+        }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix: str = "graphrag") -> str:
+        """Prometheus text exposition format."""
+        stages = self.summary()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent per pipeline stage.",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for name, s in stages.items():
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {s["seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {s["count"]}')
+        lines.append(f"# HELP {prefix}_stage_max_seconds Slowest single call per stage.")
+        lines.append(f"# TYPE {prefix}_stage_max_seconds gauge")
+        for name, s in stages.items():
+            lines.append(f'{prefix}_stage_max_seconds{{stage="{name}"}} {s["max_seconds"]}')
+        for name, value in sorted(self.counters.items()):
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def current():
+    """The active Trace, or None."""
+    return _current.get()
+
+
+@contextmanager
+def tracing(trace: Trace):
+    """Make trace the active trace inside the with block."""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Time the with block as one call of stage name. Yields the span's
+    attribute dict, so results (sizes, hits) can be added before it ends.
+    """
+    trace = _current.get()
+    if trace is None:
+        yield attrs
+        return
+    parent = _parent.get()
+    token = _parent.set(name)
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        seconds = time.perf_counter() - start
+        _parent.reset(token)
+        trace.add_span(name, seconds, start=start - trace._t0, parent=parent, **attrs)
+
+
+def record(name: str, seconds: float, **attrs):
+    """Add a span that was timed elsewhere (e.g. accumulated over a loop)."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, seconds, parent=_parent.get(), **attrs)
+
+
+def count(name: str, value: float = 1):
+    trace = _current.get()
+    if trace is not None:
+        trace.count(name, value)
+
+
+def propagate(fn):
+    """fn bound to the active trace, for calls made from other threads."""
+    trace = _current.get()
+    if trace is None:
+        return fn
+    parent = _parent.get()
+
+    def run(*args, **kwargs):
+        token = _current.set(trace)
+        parent_token = _parent.set(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _parent.reset(parent_token)
+            _current.reset(token)
+
+    return run